@@ -1,26 +1,301 @@
 
 from __future__ import annotations
+import asyncio
+import base64
+import bisect
+import cProfile
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import math
+import multiprocessing
 import os
+import pathlib
 import re
 import sqlite3
-from contextlib import closing
-from dataclasses import dataclass
-from datetime import datetime
-from typing import Dict, Any, List, Tuple
-
-from flask import Flask, g, render_template_string, request, redirect, url_for, flash
+import tempfile
+import threading
+import time
+import types
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import closing, contextmanager
+from dataclasses import asdict, astuple, dataclass, field, fields, replace
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from typing import Dict, Any, AsyncIterator, Deque, Iterator, List, Mapping, Optional, Sequence, Set, Tuple
+
+import click
+import numpy as np
+from jinja2 import DictLoader, FileSystemBytecodeCache
+from flask.cli import AppGroup
+from markupsafe import Markup
+from flask import Flask, Response, before_render_template, g, has_request_context, jsonify, render_template, request, redirect, stream_with_context, template_rendered, url_for, flash
 
 # ==============================
 # App Config
 # ==============================
 APP_TITLE = "TuNotebook Pricing"
-DB_PATH = os.path.join(os.path.dirname(__file__), "pricing.db")
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", "200"))  # filas por página en Productos
+MAX_PAGE_SIZE = 2000
+STREAM_CHUNK_SIZE = 500  # filas por bloque en modo ?stream=1
+DB_PATH = os.environ.get("PRICING_DB", os.path.join(os.path.dirname(__file__), "pricing.db"))
 SECRET_KEY = "dev-secret"  # cambia esto en producción
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 
-from functools import wraps
+class StartupAppGroup(AppGroup):
+    """Grupo de `flask <comando>` que corre create_app() antes de cada comando, así la CLI ve
+    el esquema migrado aunque cargue el `app` del módulo (FLASK_APP=app_precios_v2)."""
+    def command(self, *args, **kwargs):
+        register = super().command(*args, **kwargs)
+
+        def decorator(f):
+            @wraps(f)
+            def with_startup(*f_args, **f_kwargs):
+                try:
+                    create_app()
+                except UnknownCssClasses as e:
+                    raise click.ClickException(str(e)) from e
+                return f(*f_args, **f_kwargs)
+            return register(with_startup)
+        return decorator
+
+app.cli = StartupAppGroup(app.name)
+
+@app.before_request
+def ensure_started():
+    # servir el `app` del módulo sin pasar por create_app() (p. ej. gunicorn app_precios_v2:app)
+    # hace el arranque en el primer request
+    create_app()
+
+# ==============================
+# Templating (Tailwind minimal)
+# ==============================
+# Las plantillas se registran por nombre en TEMPLATES (cada página junto a su ruta) y
+# extienden "base.html". Jinja las compila una vez por proceso y guarda el bytecode en
+# JINJA_CACHE_DIR, así un worker nuevo no vuelve a parsearlas.
+TEMPLATES: Dict[str, str] = {}
+JINJA_CACHE_DIR = os.environ.get("JINJA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tunotebook-jinja"))
+
+app.jinja_options = {
+    **app.jinja_options,
+    "loader": DictLoader(TEMPLATES),
+    "bytecode_cache": FileSystemBytecodeCache(JINJA_CACHE_DIR),
+}
+
+TEMPLATES["base.html"] = r"""<!doctype html>
+<html lang="es">
+<head>
+  <meta charset="utf-8" />
+  <meta name="viewport" content="width=device-width, initial-scale=1" />
+  <title>{{ title }}</title>
+  <link rel="stylesheet" href="{{ url_for('static', filename=css_asset) }}" />
+  <style>
+    code { background: #f1f5f9; padding: 2px 6px; border-radius: 6px; }
+    .money { font-variant-numeric: tabular-nums; }
+  </style>
+</head>
+<body class="bg-slate-50 text-slate-900">
+  <nav class="bg-white shadow sticky top-0 z-10">
+    <div class="max-w-7xl mx-auto px-4 py-3 flex gap-4 items-center">
+      <div class="font-bold">{{ app_title }}</div>
+      <a href="{{ url_for('home') }}" class="hover:underline">Productos</a>
+      <a href="{{ url_for('variables') }}" class="hover:underline">Variables</a>
+      <a href="{{ url_for('about') }}" class="hover:underline">Ayuda</a>
+    </div>
+  </nav>
+  <main class="max-w-7xl mx-auto p-4">
+    {% with messages = get_flashed_messages() %}
+      {% if messages %}
+        <div class="mb-4">
+          {% for m in messages %}
+          <div class="p-3 bg-emerald-50 border border-emerald-200 rounded mb-2">{{ m }}</div>
+          {% endfor %}
+        </div>
+      {% endif %}
+    {% endwith %}
+    {% block content %}{% endblock %}
+  </main>
+</body>
+</html>
+"""
+
+def precompile_templates():
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    env = app.jinja_env
+    env.globals.update(app_title=APP_TITLE, money=money, product_row=product_row, css_asset=build_css())
+    for name in TEMPLATES:
+        env.get_template(name)
+
+# ==============================
+# CSS precompilado
+# ==============================
+# En vez del runtime de cdn.tailwindcss.com (compila en el navegador en cada carga y no anda
+# sin internet) se sirve un CSS generado con solo las clases que usan las plantillas: se juntan
+# los class="..." de TEMPLATES (incluido lo que esté dentro de {% if %}), cada clase se traduce
+# con los mismos valores de Tailwind v3 y el resultado va a STATIC_DIR/app.<hash>.css. Se genera
+# al arrancar si falta, o con `flask build-css`. Como el nombre cambia con el contenido, se sirve
+# con caché inmutable.
+STATIC_DIR = os.environ.get("STATIC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+STATIC_MAX_AGE = 365 * 24 * 3600
+app.static_folder = STATIC_DIR
+
+TW_COLORS = {
+    "slate": ("#f8fafc", "#f1f5f9", "#e2e8f0", "#cbd5e1", "#94a3b8", "#64748b", "#475569", "#334155", "#1e293b", "#0f172a"),
+    "emerald": ("#ecfdf5", "#d1fae5", "#a7f3d0", "#6ee7b7", "#34d399", "#10b981", "#059669", "#047857", "#065f46", "#064e3b"),
+    "blue": ("#eff6ff", "#dbeafe", "#bfdbfe", "#93c5fd", "#60a5fa", "#3b82f6", "#2563eb", "#1d4ed8", "#1e40af", "#1e3a8a"),
+    "red": ("#fef2f2", "#fee2e2", "#fecaca", "#fca5a5", "#f87171", "#ef4444", "#dc2626", "#b91c1c", "#991b1b", "#7f1d1d"),
+    "yellow": ("#fefce8", "#fef9c3", "#fef08a", "#fde047", "#facc15", "#eab308", "#ca8a04", "#a16207", "#854d0e", "#713f12"),
+}
+TW_SHADES = ("50", "100", "200", "300", "400", "500", "600", "700", "800", "900")
+TW_FONT_SIZES = {
+    "xs": ("0.75rem", "1rem"), "sm": ("0.875rem", "1.25rem"), "base": ("1rem", "1.5rem"),
+    "lg": ("1.125rem", "1.75rem"), "xl": ("1.25rem", "1.75rem"), "2xl": ("1.5rem", "2rem"),
+}
+TW_MAX_WIDTHS = {
+    "sm": "24rem", "md": "28rem", "lg": "32rem", "xl": "36rem", "2xl": "42rem", "3xl": "48rem",
+    "4xl": "56rem", "5xl": "64rem", "6xl": "72rem", "7xl": "80rem",
+}
+TW_SPACING_PROPS = {
+    "p": ("padding",), "px": ("padding-left", "padding-right"), "py": ("padding-top", "padding-bottom"),
+    "pt": ("padding-top",), "pr": ("padding-right",), "pb": ("padding-bottom",), "pl": ("padding-left",),
+    "m": ("margin",), "mx": ("margin-left", "margin-right"), "my": ("margin-top", "margin-bottom"),
+    "mt": ("margin-top",), "mr": ("margin-right",), "mb": ("margin-bottom",), "ml": ("margin-left",),
+    "gap": ("gap",), "w": ("width",),
+}
+TW_FONT_MONO = 'ui-monospace, SFMono-Regular, Menlo, Monaco, Consolas, "Liberation Mono", "Courier New", monospace'
+TW_STATIC = {
+    "flex": "display: flex", "grid": "display: grid", "hidden": "display: none", "sticky": "position: sticky",
+    "top-0": "top: 0px", "z-10": "z-index: 10", "items-center": "align-items: center",
+    "justify-between": "justify-content: space-between", "justify-end": "justify-content: flex-end",
+    "overflow-x-auto": "overflow-x: auto", "min-w-full": "min-width: 100%", "w-full": "width: 100%",
+    "font-bold": "font-weight: 700", "font-semibold": "font-weight: 600", "font-mono": f"font-family: {TW_FONT_MONO}",
+    "underline": "text-decoration-line: underline", "list-decimal": "list-style-type: decimal",
+    "list-disc": "list-style-type: disc", "text-left": "text-align: left", "text-center": "text-align: center",
+    "text-right": "text-align: right", "border": "border-width: 1px", "border-t": "border-top-width: 1px",
+    "rounded": "border-radius: 0.25rem", "rounded-lg": "border-radius: 0.5rem",
+    "shadow": "box-shadow: 0 1px 3px 0 rgb(0 0 0 / 0.1), 0 1px 2px -1px rgb(0 0 0 / 0.1)",
+}
+# clases propias (definidas en el <style> de base.html): no son de Tailwind
+CUSTOM_CLASSES = {"money"}
+TW_PREFLIGHT = """*,::before,::after{box-sizing:border-box;border-width:0;border-style:solid;border-color:#e5e7eb}
+html{line-height:1.5;-webkit-text-size-adjust:100%;tab-size:4;font-family:ui-sans-serif,system-ui,sans-serif,"Apple Color Emoji","Segoe UI Emoji"}
+body{margin:0;line-height:inherit}
+h1,h2,h3,h4,h5,h6{font-size:inherit;font-weight:inherit}
+a{color:inherit;text-decoration:inherit}
+b,strong{font-weight:bolder}
+code,kbd,samp,pre{font-family:""" + TW_FONT_MONO + """;font-size:1em}
+table{text-indent:0;border-color:inherit;border-collapse:collapse}
+button,input,optgroup,select,textarea{font-family:inherit;font-size:100%;font-weight:inherit;line-height:inherit;color:inherit;margin:0;padding:0}
+button,select{text-transform:none}
+button,[type=button],[type=reset],[type=submit]{-webkit-appearance:button;background-color:transparent;background-image:none}
+blockquote,dl,dd,h1,h2,h3,h4,h5,h6,hr,figure,p,pre{margin:0}
+ol,ul,menu{list-style:none;margin:0;padding:0}
+button,[role=button]{cursor:pointer}
+input::placeholder,textarea::placeholder{opacity:1;color:#9ca3af}
+[hidden]{display:none}
+"""
+
+def tw_color(name: str) -> Optional[str]:
+    if name in ("white", "black"):
+        return "#fff" if name == "white" else "#000"
+    hue, _, shade = name.rpartition("-")
+    if hue in TW_COLORS and shade in TW_SHADES:
+        return TW_COLORS[hue][TW_SHADES.index(shade)]
+    return None
+
+def tw_declarations(name: str) -> Optional[Tuple[str, str]]:
+    """(selector con {s} en lugar de la clase, declaraciones) de una utilidad de Tailwind."""
+    if name in TW_STATIC:
+        return "{s}", TW_STATIC[name]
+    prefix, _, value = name.partition("-")
+    if name.startswith("space-y-") and name[8:].isdigit():
+        return "{s} > :not([hidden]) ~ :not([hidden])", f"margin-top: {int(name[8:]) * 0.25:g}rem"
+    if name.startswith("grid-cols-") and name[10:].isdigit():
+        return "{s}", f"grid-template-columns: repeat({name[10:]}, minmax(0, 1fr))"
+    if name.startswith("max-w-") and name[6:] in TW_MAX_WIDTHS:
+        return "{s}", f"max-width: {TW_MAX_WIDTHS[name[6:]]}"
+    if prefix in TW_SPACING_PROPS and (value.isdigit() or value == "auto"):
+        size = "auto" if value == "auto" else ("0px" if value == "0" else f"{int(value) * 0.25:g}rem")
+        return "{s}", "; ".join(f"{prop}: {size}" for prop in TW_SPACING_PROPS[prefix])
+    if prefix == "text" and value in TW_FONT_SIZES:
+        size, line_height = TW_FONT_SIZES[value]
+        return "{s}", f"font-size: {size}; line-height: {line_height}"
+    color = tw_color(value)
+    if color is not None and prefix in ("text", "bg", "border"):
+        prop = {"text": "color", "bg": "background-color", "border": "border-color"}[prefix]
+        return "{s}", f"{prop}: {color}"
+    return None
+
+def template_classes() -> List[str]:
+    found = set()
+    for source in TEMPLATES.values():
+        for attr in re.findall(r'class="([^"]*)"', source):
+            found.update(re.sub(r"{%.*?%}|{{.*?}}", " ", attr).split())
+    return sorted(found)
+
+def tailwind_css(classes: Sequence[str]) -> Tuple[str, List[str]]:
+    """CSS de las clases pedidas (más el preflight) y la lista de las que no se reconocieron."""
+    base, responsive, unknown = [], [], []
+    for cls in classes:
+        *variants, name = cls.split(":")
+        rule = tw_declarations(name)
+        if cls in CUSTOM_CLASSES:
+            continue
+        if rule is None or any(v not in ("hover", "md") for v in variants):
+            unknown.append(cls)
+            continue
+        selector = "." + re.sub(r"([:./])", r"\\\1", cls) + (":hover" if "hover" in variants else "")
+        css = rule[0].format(s=selector) + "{" + rule[1] + "}"
+        (responsive if "md" in variants else base).append(css)
+    out = TW_PREFLIGHT + "\n".join(base) + "\n"
+    if responsive:
+        out += "@media (min-width: 768px){" + "".join(responsive) + "}\n"
+    return out, unknown
+
+class UnknownCssClasses(ValueError):
+    """Las plantillas usan clases que tw_declarations no conoce: se verían sin estilo."""
+    def __init__(self, classes: Sequence[str]):
+        self.classes = list(classes)
+        super().__init__("clases sin regla CSS: " + ", ".join(self.classes))
+
+def build_css() -> str:
+    """Genera (si hace falta) el CSS de las plantillas y devuelve su nombre dentro de STATIC_DIR.
+    Levanta UnknownCssClasses si alguna clase no tiene regla, así el arranque falla en vez de
+    publicar una página sin estilo."""
+    css, unknown = tailwind_css(template_classes())
+    if unknown:
+        raise UnknownCssClasses(unknown)
+    data = css.encode()
+    filename = f"app.{hashlib.sha256(data).hexdigest()[:12]}.css"
+    path = os.path.join(STATIC_DIR, filename)
+    if not os.path.exists(path):
+        os.makedirs(STATIC_DIR, exist_ok=True)
+        # escritura atómica: otro worker puede estar generando el mismo archivo
+        fd, tmp = tempfile.mkstemp(dir=STATIC_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.chmod(tmp, 0o644)  # mkstemp crea con 0600; el proxy de /static tiene que poder leerlo
+        os.replace(tmp, path)
+    return filename
+
+@app.cli.command("build-css")
+def build_css_command():
+    """Genera static/app.<hash>.css con las clases que usan las plantillas; sale con error si
+    alguna clase no tiene regla."""
+    css, _ = tailwind_css(template_classes())
+    try:
+        filename = build_css()
+    except UnknownCssClasses as e:
+        raise click.ClickException(str(e)) from e
+    print(f"{filename}: {len(css.encode())} bytes.")
+
 from flask import session
 
 # ==============================
@@ -43,6 +318,20 @@ def login_required(view_func):
     return wrapped_view
 
 
+TEMPLATES["login.html"] = r"""
+{% extends "base.html" %}
+{% block content %}
+<div class="max-w-sm mx-auto mt-10 p-6 bg-white rounded shadow">
+  <h1 class="text-xl font-semibold mb-3 text-center">Iniciar sesión</h1>
+  <form method="post" class="grid gap-3">
+    <input name="username" placeholder="Usuario" class="border p-2 rounded" />
+    <input name="password" type="password" placeholder="Contraseña" class="border p-2 rounded" />
+    <button class="px-3 py-2 bg-slate-900 text-white rounded">Entrar</button>
+  </form>
+</div>
+{% endblock %}
+"""
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
@@ -56,17 +345,7 @@ def login():
             flash("Usuario o contraseña incorrectos.")
             return redirect(url_for("login"))
 
-    body = r"""
-    <div class="max-w-sm mx-auto mt-10 p-6 bg-white rounded shadow">
-      <h1 class="text-xl font-semibold mb-3 text-center">Iniciar sesión</h1>
-      <form method="post" class="grid gap-3">
-        <input name="username" placeholder="Usuario" class="border p-2 rounded" />
-        <input name="password" type="password" placeholder="Contraseña" class="border p-2 rounded" />
-        <button class="px-3 py-2 bg-slate-900 text-white rounded">Entrar</button>
-      </form>
-    </div>
-    """
-    return page(body, title="Login | " + APP_TITLE)
+    return render_template("login.html", title="Login | " + APP_TITLE)
 
 
 @app.route("/logout")
@@ -86,109 +365,656 @@ def enforce_https():
         return redirect(url, code=301)
 
 # ==============================
-# Templating (Tailwind minimal)
+# Instrumentación
 # ==============================
-BASE_HTML = r"""
-<!doctype html>
-<html lang="es">
-<head>
-  <meta charset="utf-8" />
-  <meta name="viewport" content="width=device-width, initial-scale=1" />
-  <title>{{ title }}</title>
-  <script src="https://cdn.tailwindcss.com"></script>
-  <style>
-    code { background: #f1f5f9; padding: 2px 6px; border-radius: 6px; }
-    .money { font-variant-numeric: tabular-nums; }
-  </style>
-</head>
-<body class="bg-slate-50 text-slate-900">
-  <nav class="bg-white shadow sticky top-0 z-10">
-    <div class="max-w-7xl mx-auto px-4 py-3 flex gap-4 items-center">
-      <div class="font-bold">{{ app_title }}</div>
-      <a href="{{ url_for('home') }}" class="hover:underline">Productos</a>
-      <a href="{{ url_for('variables') }}" class="hover:underline">Variables</a>
-      <a href="{{ url_for('about') }}" class="hover:underline">Ayuda</a>
-    </div>
-  </nav>
-  <main class="max-w-7xl mx-auto p-4">
-    {% with messages = get_flashed_messages() %}
-      {% if messages %}
-        <div class="mb-4">
-          {% for m in messages %}
-          <div class="p-3 bg-emerald-50 border border-emerald-200 rounded mb-2">{{ m }}</div>
-          {% endfor %}
-        </div>
-      {% endif %}
-    {% endwith %}
-    {{ body|safe }}
-  </main>
-</body>
-</html>
-"""
+# Cada request lleva un RequestStats en un thread-local: tiempo por fase (db, pricing, render),
+# sentencias SQL y filas leídas. Se informa en Server-Timing y se acumula por endpoint para
+# /metrics (formato Prometheus; los contadores son por proceso, cada worker expone los suyos).
+# Con SLOW_REQUEST_MS > 0 cada request corre bajo cProfile y las que superan ese umbral dejan
+# un .prof en SLOW_REQUEST_DIR.
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "0"))
+SLOW_REQUEST_DIR = os.environ.get("SLOW_REQUEST_DIR", os.path.join(tempfile.gettempdir(), "pricing-slow"))
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # si está, /metrics pide "Authorization: Bearer <token>"
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_stats = threading.local()
+
+class RequestStats:
+    __slots__ = ("start", "phases", "queries", "rows", "profile")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.queries = 0
+        self.rows = 0
+        self.profile = None
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+def current_stats() -> Optional[RequestStats]:
+    return getattr(_stats, "current", None)
+
+@contextmanager
+def timed_phase(name: str):
+    stats = current_stats()
+    if stats is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add(name, time.perf_counter() - t0)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cuenta sentencias, filas y tiempo de SQLite del request en curso (fuera de un
+    request, p. ej. en los trabajos de fondo, no hace nada)."""
+
+    def execute(self, sql, parameters=()):
+        self.stats = stats = current_stats()
+        if stats is None:
+            return super().execute(sql, parameters)
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            stats.queries += 1
+            stats.add("db", time.perf_counter() - t0)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.stats = stats = current_stats()
+        if stats is None:
+            return super().executemany(sql, seq_of_parameters)
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            stats.queries += 1
+            stats.add("db", time.perf_counter() - t0)
+
+    def _fetch(self, fetch, *args):
+        stats = getattr(self, "stats", None)
+        if stats is None:
+            return fetch(*args)
+        t0 = time.perf_counter()
+        rows = fetch(*args)
+        stats.add("db", time.perf_counter() - t0)
+        stats.rows += len(rows) if isinstance(rows, list) else rows is not None
+        return rows
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __next__(self):
+        row = super().__next__()
+        stats = getattr(self, "stats", None)
+        if stats is not None:
+            stats.rows += 1
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class RouteMetrics:
+    """Histogramas y contadores por (endpoint, método), en memoria del proceso."""
+
+    def __init__(self, buckets: Sequence[float] = METRIC_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.histograms: Dict[Tuple[str, ...], List[float]] = {}  # cuentas por bucket + [+Inf, suma]
+        self.counters: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, name: str, labels: Tuple[Tuple[str, str], ...], value: float):
+        key = (name, labels)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h[i] += 1
+            h[-2] += 1
+            h[-1] += value
+
+    def inc(self, name: str, labels: Tuple[Tuple[str, str], ...], value: float = 1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self) -> str:
+        def fmt(labels, extra=()):
+            pairs = [*labels, *extra]
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+        lines, declared = [], set()
+        with self.lock:
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in declared:
+                    declared.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                for bound, count in zip(self.buckets, h):
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', repr(bound))])} {count:g}")
+                lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {h[-2]:g}")
+                lines.append(f"{name}_count{fmt(labels)} {h[-2]:g}")
+                lines.append(f"{name}_sum{fmt(labels)} {h[-1]:.6f}")
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in declared:
+                    declared.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{fmt(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+metrics = RouteMetrics()
+
+@app.before_request
+def start_request_stats():
+    stats = _stats.current = RequestStats()
+    if SLOW_REQUEST_MS > 0:
+        stats.profile = cProfile.Profile()
+        stats.profile.enable()
+
+@before_render_template.connect_via(app)
+def _render_started(sender, template, context, **extra):
+    _stats.render_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _render_finished(sender, template, context, **extra):
+    stats, t0 = current_stats(), getattr(_stats, "render_start", None)
+    if stats is not None and t0 is not None:
+        stats.add("render", time.perf_counter() - t0)
+        _stats.render_start = None
+
+@app.after_request
+def finish_request_stats(response: Response) -> Response:
+    stats = current_stats()
+    if stats is None:
+        return response
+    _stats.current = None
+    total = time.perf_counter() - stats.start
+    if stats.profile is not None:
+        stats.profile.disable()
+        if total * 1000 >= SLOW_REQUEST_MS:
+            os.makedirs(SLOW_REQUEST_DIR, exist_ok=True)
+            path = os.path.join(
+                SLOW_REQUEST_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{request.endpoint or 'none'}-{total * 1000:.0f}ms.prof"
+            )
+            stats.profile.dump_stats(path)
+            app.logger.warning("request lenta %s %s: %.0f ms (perfil en %s)", request.method, request.full_path, total * 1000, path)
+
+    # en las respuestas en streaming esto cubre hasta que empieza el cuerpo
+    timings = [
+        f'{name};dur={seconds * 1000:.1f}' + (f';desc="{stats.queries} consultas, {stats.rows} filas"' if name == "db" else "")
+        for name, seconds in stats.phases.items()
+    ]
+    timings.append(f"total;dur={total * 1000:.1f}")
+    response.headers["Server-Timing"] = ", ".join(timings)
+
+    labels = (("endpoint", request.endpoint or "none"), ("method", request.method))
+    metrics.observe("pricing_request_duration_seconds", labels, total)
+    for name, seconds in stats.phases.items():
+        metrics.observe("pricing_request_phase_seconds", labels + (("phase", name),), seconds)
+    metrics.inc("pricing_requests_total", labels + (("status", str(response.status_code)),))
+    metrics.inc("pricing_sql_statements_total", labels, stats.queries)
+    metrics.inc("pricing_sql_rows_total", labels, stats.rows)
+    return response
 
-def page(body: str, title: str):
-    return render_template_string(BASE_HTML, body=body, title=title, app_title=APP_TITLE)
+# ==============================
+# Compresión y caché HTTP
+# ==============================
+# Las respuestas HTML/JSON/CSV de más de COMPRESS_MIN_SIZE bytes salen comprimidas con brotli
+# (si el paquete está instalado y el cliente lo acepta) o gzip. Las respuestas en streaming se
+# comprimen chunk a chunk (con flush en cada uno, para no frenar el render progresivo) y los
+# archivos (direct_passthrough) no se tocan. Cada ruta puede ajustar o apagar la compresión con
+# @compress(...). Los archivos estáticos con hash en el nombre van con caché inmutable.
+try:
+    import brotli
+except ImportError:  # opcional: sin brotli se usa gzip
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 5
+COMPRESS_MIMETYPES = {"text/html", "application/json", "text/csv", "application/x-ndjson", "text/plain", "text/css"}
+HASHED_STATIC_RE = re.compile(r"\.[0-9a-f]{12}\.\w+$")
+
+def compress(enabled: bool = True, min_size: Optional[int] = None, level: Optional[int] = None):
+    """Configuración de compresión de una ruta (va debajo de @app.route)."""
+    def decorator(view_func):
+        view_func.compress_options = {"enabled": enabled, "min_size": min_size, "level": level}
+        return view_func
+    return decorator
+
+class StreamCompressor:
+    """Compresor incremental: cada chunk sale comprimido y completo (sync flush)."""
+
+    def __init__(self, encoding: str, level: Optional[int] = None):
+        if encoding == "br":
+            self._br = brotli.Compressor(quality=level or COMPRESS_BROTLI_QUALITY)
+        else:
+            self._br = None
+            self._z = zlib.compressobj(level or COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        if self._br is not None:
+            return self._br.process(data) + self._br.flush()
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._br.finish() if self._br is not None else self._z.flush()
+
+def compress_chunks(chunks, encoding: str, level: Optional[int] = None) -> Iterator[bytes]:
+    compressor = StreamCompressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compressor.chunk(chunk.encode() if isinstance(chunk, str) else chunk)
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+def negotiate_encoding() -> Optional[str]:
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"] and accepted["br"] >= accepted["gzip"]:
+        return "br"
+    return "gzip" if accepted["gzip"] else None
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    if request.endpoint == "static" and HASHED_STATIC_RE.search(request.path):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    options = getattr(app.view_functions.get(request.endpoint), "compress_options", {})
+    if (
+        not options.get("enabled", True)
+        or response.direct_passthrough
+        or not 200 <= response.status_code < 300
+        or response.status_code == 206
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESS_MIMETYPES
+    ):
+        return response
+    level = options.get("level")
+    if response.is_streamed:
+        # no se sabe el tamaño: se asume grande (para eso se hace streaming)
+        response.vary.add("Accept-Encoding")
+        encoding = negotiate_encoding()
+        if encoding is None:
+            return response
+        response.response = compress_chunks(response.response, encoding, level)
+    else:
+        data = response.get_data()
+        if len(data) < (options.get("min_size") or COMPRESS_MIN_SIZE):
+            return response
+        response.vary.add("Accept-Encoding")
+        encoding = negotiate_encoding()
+        if encoding is None:
+            return response
+        if encoding == "br":
+            response.set_data(brotli.compress(data, quality=level or COMPRESS_BROTLI_QUALITY))
+        else:
+            response.set_data(gzip.compress(data, compresslevel=level or COMPRESS_GZIP_LEVEL, mtime=0))
+    response.headers["Content-Encoding"] = encoding
+    # como hace nginx: el cuerpo ya no es byte a byte el mismo, la ETag pasa a ser débil
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
 
 # ==============================
 # DB Helpers
 # ==============================
+# Cada hilo de cada worker mantiene sus conexiones abiertas entre requests (una de
+# escritura y una de solo lectura). La base está en WAL: los lectores no esperan al que escribe.
+SQLITE_PRAGMAS = (
+    ("synchronous", "NORMAL"),       # en WAL alcanza: no se pierde integridad, solo el último commit ante un corte
+    ("mmap_size", 256 * 1024 * 1024),
+    ("cache_size", -64 * 1024),      # KiB
+    ("busy_timeout", 5000),          # ms esperando el lock de escritura antes de fallar
+    ("temp_store", "MEMORY"),
+)
+STATEMENT_CACHE_SIZE = 256  # sentencias preparadas por conexión
+
+_local = threading.local()
+
+def connect(readonly: bool = False) -> sqlite3.Connection:
+    if readonly:
+        uri = pathlib.Path(DB_PATH).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, cached_statements=STATEMENT_CACHE_SIZE, factory=InstrumentedConnection)
+    else:
+        conn = sqlite3.connect(DB_PATH, cached_statements=STATEMENT_CACHE_SIZE, factory=InstrumentedConnection)
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.row_factory = sqlite3.Row
+    for pragma, value in SQLITE_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}={value}")
+    return conn
+
+def worker_connection(readonly: bool = False) -> sqlite3.Connection:
+    """Conexión de larga vida del hilo actual (se reabre si cambió el proceso o DB_PATH)."""
+    conns = getattr(_local, "conns", None)
+    if conns is None or _local.owner != (os.getpid(), DB_PATH):
+        conns = _local.conns = {}
+        _local.owner = (os.getpid(), DB_PATH)
+    conn = conns.get(readonly)
+    if conn is None:
+        conn = conns[readonly] = connect(readonly)
+    return conn
+
 def get_db():
+    """Conexión para leer: de solo lectura en requests GET/HEAD, de escritura en el resto."""
     if 'db' not in g:
-        g.db = sqlite3.connect(DB_PATH)
-        g.db.row_factory = sqlite3.Row
+        readonly = has_request_context() and request.method in ("GET", "HEAD")
+        g.db = worker_connection(readonly=readonly)
     return g.db
 
+def get_write_db():
+    if 'write_db' not in g:
+        g.write_db = worker_connection()
+    return g.write_db
+
 @app.teardown_appcontext
 def close_db(exception):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+    # las conexiones no se cierran: solo se descarta lo que haya quedado sin commit
+    for key in ('db', 'write_db'):
+        db = g.pop(key, None)
+        if db is not None and db.in_transaction:
+            db.rollback()
 
-def init_db():
-    db = get_db()
-    with closing(db.cursor()) as cur:
-        cur.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS variables (
-              key TEXT PRIMARY KEY,
-              value TEXT NOT NULL
-            );
-
-            CREATE TABLE IF NOT EXISTS products (
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              brand TEXT NOT NULL,
-              name TEXT NOT NULL,
-              sku TEXT NOT NULL UNIQUE,
-              fob_usd REAL NOT NULL DEFAULT 0,
-              peso_kg REAL NOT NULL DEFAULT 0,
-              costo_flete_usd_kg REAL NOT NULL DEFAULT 4.20,
-              costo_financiero REAL NOT NULL DEFAULT 0.04,
-              arancel REAL NOT NULL DEFAULT 0.16,
-              aduana REAL NOT NULL DEFAULT 0.0053,
-              despachante REAL NOT NULL DEFAULT 0.0095,
-              banco REAL NOT NULL DEFAULT 0.0040,
-              iva REAL NOT NULL DEFAULT 0.21,
-              envio_ars REAL NOT NULL DEFAULT 0,
-              margen_neto REAL NOT NULL DEFAULT 0.06,
-              precio_manual_ars REAL DEFAULT NULL,
-              updated_at TEXT NOT NULL DEFAULT (datetime('now'))
-            );
-
-            CREATE TABLE IF NOT EXISTS price_history (
-              id INTEGER PRIMARY KEY AUTOINCREMENT,
-              product_id INTEGER NOT NULL,
-              precio_web_ars REAL NOT NULL,
-              precio_ml1_ars REAL NOT NULL,
-              precio_ml3_ars REAL NOT NULL,
-              precio_ml6_ars REAL NOT NULL,
-              precio_ml9_ars REAL NOT NULL,
-              precio_ml12_ars REAL NOT NULL,
-              created_at TEXT NOT NULL,
-              FOREIGN KEY(product_id) REFERENCES products(id) ON DELETE CASCADE
-            );
-            """
-        )
+# ==============================
+# Esquema y migraciones
+# ==============================
+# Cada migración corre una sola vez, en orden, y queda registrada en schema_version.
+# Las primeras usan IF NOT EXISTS porque las bases anteriores a schema_version ya tienen
+# esas tablas (las creaba init_db en cada request).
+def _rename_price_history_columns(db: sqlite3.Connection):
+    """price_history pudo quedar con columnas price_* (las que usaba recalc_all); se
+    normalizan a precio_* como en el resto del esquema."""
+    cols = {r["name"] for r in db.execute("PRAGMA table_info(price_history)")}
+    for channel in ("web", "ml1", "ml3", "ml6", "ml9", "ml12"):
+        old, new = f"price_{channel}_ars", f"precio_{channel}_ars"
+        if old in cols and new not in cols:
+            db.execute(f"ALTER TABLE price_history RENAME COLUMN {old} TO {new}")
+
+MIGRATIONS: List[Tuple[int, str, Any]] = [
+    (1, "tablas base", """
+        CREATE TABLE IF NOT EXISTS variables (
+          key TEXT PRIMARY KEY,
+          value TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS products (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          brand TEXT NOT NULL,
+          name TEXT NOT NULL,
+          sku TEXT NOT NULL UNIQUE,
+          fob_usd REAL NOT NULL DEFAULT 0,
+          peso_kg REAL NOT NULL DEFAULT 0,
+          costo_flete_usd_kg REAL NOT NULL DEFAULT 4.20,
+          costo_financiero REAL NOT NULL DEFAULT 0.04,
+          arancel REAL NOT NULL DEFAULT 0.16,
+          aduana REAL NOT NULL DEFAULT 0.0053,
+          despachante REAL NOT NULL DEFAULT 0.0095,
+          banco REAL NOT NULL DEFAULT 0.0040,
+          iva REAL NOT NULL DEFAULT 0.21,
+          envio_ars REAL NOT NULL DEFAULT 0,
+          margen_neto REAL NOT NULL DEFAULT 0.06,
+          precio_manual_ars REAL DEFAULT NULL,
+          updated_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+
+        CREATE TABLE IF NOT EXISTS price_history (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          product_id INTEGER NOT NULL,
+          precio_web_ars REAL NOT NULL,
+          precio_ml1_ars REAL NOT NULL,
+          precio_ml3_ars REAL NOT NULL,
+          precio_ml6_ars REAL NOT NULL,
+          precio_ml9_ars REAL NOT NULL,
+          precio_ml12_ars REAL NOT NULL,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(product_id) REFERENCES products(id) ON DELETE CASCADE
+        );
+    """),
+    (2, "precios materializados", """
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+          key TEXT PRIMARY KEY,
+          value INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS computed_prices (
+          product_id INTEGER PRIMARY KEY,
+          vars_version INTEGER NOT NULL,
+          product_updated_at TEXT NOT NULL,
+          cif_usd REAL NOT NULL,
+          costo_final_usd REAL NOT NULL,
+          pv_neto_usd REAL NOT NULL,
+          margen_neto REAL NOT NULL,
+          precio_web_ars REAL NOT NULL,
+          precio_ml_1_ars REAL NOT NULL,
+          precio_ml_3_ars REAL NOT NULL,
+          precio_ml_6_ars REAL NOT NULL,
+          precio_ml_9_ars REAL NOT NULL,
+          precio_ml_12_ars REAL NOT NULL,
+          FOREIGN KEY(product_id) REFERENCES products(id) ON DELETE CASCADE
+        );
+    """),
+    (3, "búsqueda FTS5", """
+        -- índice de búsqueda sobre marca/modelo/SKU (tabla externa: el contenido vive en products)
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+          brand, name, sku,
+          content='products', content_rowid='id',
+          tokenize="unicode61 remove_diacritics 2", prefix='2 3'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+          INSERT INTO products_fts(rowid, brand, name, sku) VALUES (new.id, new.brand, new.name, new.sku);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+          INSERT INTO products_fts(products_fts, rowid, brand, name, sku) VALUES ('delete', old.id, old.brand, old.name, old.sku);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF brand, name, sku ON products BEGIN
+          INSERT INTO products_fts(products_fts, rowid, brand, name, sku) VALUES ('delete', old.id, old.brand, old.name, old.sku);
+          INSERT INTO products_fts(rowid, brand, name, sku) VALUES (new.id, new.brand, new.name, new.sku);
+        END;
+
+        -- indexar los productos que ya estaban cargados
+        INSERT INTO products_fts(products_fts) VALUES ('rebuild');
+    """),
+    (4, "índices de listado e historial", """
+        CREATE INDEX IF NOT EXISTS idx_products_brand_name_id ON products(brand, name, id);
+        CREATE INDEX IF NOT EXISTS idx_price_history_product_created ON price_history(product_id, created_at);
+    """),
+    (5, "price_history: columnas precio_*", _rename_price_history_columns),
+    (6, "trabajos en segundo plano", """
+        CREATE TABLE IF NOT EXISTS jobs (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          kind TEXT NOT NULL,
+          status TEXT NOT NULL,  -- running | done | failed
+          total INTEGER NOT NULL DEFAULT 0,
+          done INTEGER NOT NULL DEFAULT 0,
+          rows_written INTEGER NOT NULL DEFAULT 0,
+          error TEXT,
+          started_at TEXT NOT NULL,
+          heartbeat_at TEXT NOT NULL,
+          finished_at TEXT
+        );
+
+        -- a lo sumo un trabajo en curso por tipo (entre todos los workers)
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_one_running ON jobs(kind) WHERE status = 'running';
+    """),
+    (7, "computed_prices: fecha del último cambio de precio", """
+        ALTER TABLE computed_prices ADD COLUMN prices_changed_at TEXT;
+        UPDATE computed_prices SET prices_changed_at = datetime('now');
+        CREATE INDEX IF NOT EXISTS idx_computed_prices_changed ON computed_prices(prices_changed_at);
+    """),
+    (8, "versión del catálogo de productos", """
+        -- cualquier alta/baja/modificación en products avanza products_version
+        INSERT OR IGNORE INTO catalog_meta(key, value) VALUES ('products_version', 0);
+
+        CREATE TRIGGER IF NOT EXISTS products_version_ai AFTER INSERT ON products BEGIN
+          UPDATE catalog_meta SET value = value + 1 WHERE key = 'products_version';
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS products_version_au AFTER UPDATE ON products BEGIN
+          UPDATE catalog_meta SET value = value + 1 WHERE key = 'products_version';
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS products_version_ad AFTER DELETE ON products BEGIN
+          UPDATE catalog_meta SET value = value + 1 WHERE key = 'products_version';
+        END;
+    """),
+    (9, "price_history: índice cubriente", """
+        -- con los seis precios en el índice, "último precio de un producto" y las series
+        -- por rango de fechas se resuelven sin tocar la tabla
+        DROP INDEX IF EXISTS idx_price_history_product_created;
+        CREATE INDEX IF NOT EXISTS idx_price_history_covering ON price_history(
+          product_id, created_at,
+          precio_web_ars, precio_ml1_ars, precio_ml3_ars, precio_ml6_ars, precio_ml9_ars, precio_ml12_ars
+        );
+    """),
+    (10, "versión de variables", """
+        -- cualquier cambio en variables (también las que no afectan precios) avanza variables_version
+        INSERT OR IGNORE INTO catalog_meta(key, value) VALUES ('variables_version', 0);
+
+        CREATE TRIGGER IF NOT EXISTS variables_version_ai AFTER INSERT ON variables BEGIN
+          UPDATE catalog_meta SET value = value + 1 WHERE key = 'variables_version';
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS variables_version_au AFTER UPDATE ON variables BEGIN
+          UPDATE catalog_meta SET value = value + 1 WHERE key = 'variables_version';
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS variables_version_ad AFTER DELETE ON variables BEGIN
+          UPDATE catalog_meta SET value = value + 1 WHERE key = 'variables_version';
+        END;
+    """),
+    (11, "feed de cotización", """
+        CREATE TABLE IF NOT EXISTS fx_feed (
+          source TEXT PRIMARY KEY,
+          started_at TEXT NOT NULL,
+          updated_at TEXT NOT NULL,
+          ticks INTEGER NOT NULL DEFAULT 0,
+          ignored INTEGER NOT NULL DEFAULT 0,   -- movimientos bajo el umbral
+          applied INTEGER NOT NULL DEFAULT 0    -- save_variables efectivos
+        );
+
+        CREATE TABLE IF NOT EXISTS fx_updates (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          source TEXT NOT NULL,
+          previous REAL,
+          rate REAL NOT NULL,
+          ticks INTEGER NOT NULL,               -- ticks de la ventana que se aplicó
+          first_tick_at TEXT NOT NULL,
+          applied_at TEXT NOT NULL,
+          lag_ms REAL NOT NULL,                 -- del primer tick de la ventana a los precios publicados
+          reprice_ms REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_fx_updates_source ON fx_updates(source, id);
+    """),
+    (12, "versión por producto", """
+        -- updated_at tiene resolución de un segundo: dos escrituras en el mismo segundo no lo
+        -- cambian. version avanza en cada UPDATE de la fila y es lo que decide si los precios
+        -- materializados (y las filas cacheadas) siguen valiendo.
+        ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+
+        CREATE TRIGGER IF NOT EXISTS products_row_version_au AFTER UPDATE ON products
+        WHEN new.version = old.version BEGIN
+          UPDATE products SET version = old.version + 1 WHERE id = new.id;
+        END;
+
+        -- las filas existentes no tienen versión: quedan vencidas y se recalculan
+        ALTER TABLE computed_prices ADD COLUMN product_version INTEGER;
+    """),
+    (13, "búsqueda por pedazos de SKU", """
+        -- products_fts parte el SKU en palabras y solo matchea prefijos: "5dy" o "dy-20" no
+        -- encuentran "HP-15DY-2045". Con trigramas cualquier subcadena de 3+ caracteres sirve.
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_sku_fts USING fts5(
+          sku, content='products', content_rowid='id', tokenize='trigram'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS products_sku_fts_ai AFTER INSERT ON products BEGIN
+          INSERT INTO products_sku_fts(rowid, sku) VALUES (new.id, new.sku);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS products_sku_fts_ad AFTER DELETE ON products BEGIN
+          INSERT INTO products_sku_fts(products_sku_fts, rowid, sku) VALUES ('delete', old.id, old.sku);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS products_sku_fts_au AFTER UPDATE OF sku ON products BEGIN
+          INSERT INTO products_sku_fts(products_sku_fts, rowid, sku) VALUES ('delete', old.id, old.sku);
+          INSERT INTO products_sku_fts(rowid, sku) VALUES (new.id, new.sku);
+        END;
+
+        INSERT INTO products_sku_fts(products_sku_fts) VALUES ('rebuild');
+    """),
+]
+
+def split_sql(script: str) -> List[str]:
+    """Separa un script en sentencias (respetando los ; dentro de BEGIN ... END de triggers)."""
+    statements, current = [], ""
+    for line in script.splitlines(keepends=True):
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ""
+    if current.strip():
+        statements.append(current.strip())
+    return statements
+
+def schema_version(db: sqlite3.Connection) -> int:
+    db.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_at TEXT NOT NULL)")
+    return db.execute("SELECT coalesce(max(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate(db: sqlite3.Connection) -> List[int]:
+    """Aplica las migraciones pendientes. Devuelve las versiones aplicadas."""
+    if schema_version(db) >= MIGRATIONS[-1][0]:
+        return []
+    # BEGIN IMMEDIATE: si varios workers arrancan juntos, migra uno solo y el resto espera
+    db.execute("BEGIN IMMEDIATE")
+    applied = []
+    try:
+        current = schema_version(db)
+        for version, description, step in MIGRATIONS:
+            if version <= current:
+                continue
+            if callable(step):
+                step(db)
+            else:
+                for statement in split_sql(step):
+                    db.execute(statement)
+            db.execute(
+                "INSERT INTO schema_version(version, description, applied_at) VALUES (?, ?, datetime('now'))",
+                (version, description),
+            )
+            applied.append(version)
         db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return applied
+
+def init_db():
+    db = get_write_db()
+    migrate(db)
 
     # Variables globales (si no existen)
     if not get_variables():
@@ -202,7 +1028,27 @@ def init_db():
             "redondeo": "999"
         }
         save_variables(defaults)
-        
+
+    # las terminaciones vienen del entorno: si cambiaron desde el último arranque, los
+    # precios materializados quedan vencidos igual que al cambiar una variable
+    endings_crc = zlib.crc32(PRICE_ENDINGS_SPEC.encode())
+    row = db.execute("SELECT value FROM catalog_meta WHERE key='price_endings_crc'").fetchone()
+    if row is None or row["value"] != endings_crc:
+        db.execute(
+            "INSERT INTO catalog_meta(key, value) VALUES('price_endings_crc', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+            (endings_crc,),
+        )
+        db.commit()
+        if row is not None:
+            bump_vars_version()
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Crea el esquema / aplica migraciones pendientes."""
+    init_db()
+    print(f"Esquema en versión {schema_version(get_write_db())}.")
+
 def get_variables() -> Dict[str, float]:
     db = get_db()
     cur = db.execute("SELECT key, value FROM variables")
@@ -214,8 +1060,12 @@ def get_variables() -> Dict[str, float]:
             out[r["key"]] = 0.0
     return out
 
+# variables globales que cambian los precios calculados
+PRICE_VARIABLES = ("dolar", "redondeo", "coef_ml_1", "coef_ml_3", "coef_ml_6", "coef_ml_9", "coef_ml_12")
+
 def save_variables(dct: Dict[str, Any]):
-    db = get_db()
+    db = get_write_db()
+    before = get_variables()
     with closing(db.cursor()) as cur:
         for k, v in dct.items():
             cur.execute(
@@ -224,6 +1074,39 @@ def save_variables(dct: Dict[str, Any]):
             )
         db.commit()
 
+    after = get_variables()
+    if any(before.get(k) != after.get(k) for k in PRICE_VARIABLES):
+        bump_vars_version()
+        refresh_computed_prices()
+
+def get_vars_version() -> int:
+    row = get_db().execute("SELECT value FROM catalog_meta WHERE key='vars_version'").fetchone()
+    return row["value"] if row else 0
+
+def catalog_version() -> Tuple[int, int]:
+    """(vars_version, products_version) en una sola lectura de catalog_meta."""
+    versions = dict(get_db().execute(
+        "SELECT key, value FROM catalog_meta WHERE key IN ('vars_version', 'products_version')"
+    ).fetchall())
+    return versions.get("vars_version", 0), versions.get("products_version", 0)
+
+SNAPSHOT_VERSION_KEYS = ("vars_version", "products_version", "variables_version")
+
+def snapshot_version() -> Tuple[int, ...]:
+    """Contadores que invalidan el CatalogSnapshot, en una sola lectura de catalog_meta."""
+    marks = ", ".join("?" for _ in SNAPSHOT_VERSION_KEYS)
+    versions = dict(get_db().execute(
+        f"SELECT key, value FROM catalog_meta WHERE key IN ({marks})", SNAPSHOT_VERSION_KEYS
+    ).fetchall())
+    return tuple(versions.get(k, 0) for k in SNAPSHOT_VERSION_KEYS)
+
+def bump_vars_version():
+    db = get_write_db()
+    db.execute(
+        "INSERT INTO catalog_meta(key, value) VALUES('vars_version', 1) ON CONFLICT(key) DO UPDATE SET value=value+1"
+    )
+    db.commit()
+
 # ==============================
 # Domain Logic
 # ==============================
@@ -231,33 +1114,88 @@ def money(n: float) -> str:
     # format currency with thousands separator and no decimals
     return f"${int(round(n)):,.0f}".replace(",", ".")
 
-def end_599_999(value: float) -> float:
-    """
-    Redondea a la terminación más cercana en 599 o 999.
-    Estrategia: calculamos candidatos alrededor del valor y elegimos el más cercano.
-    En caso de empate, preferimos 999.
-    """
-    base = int(value)
-    thousands = base // 1000
-    candidates = [
-        thousands * 1000 + 599,
-        thousands * 1000 + 999,
-        (thousands + 1) * 1000 + 599,
-        (thousands + 1) * 1000 + 999,
-        max(0, (thousands - 1) * 1000 + 999),  # por si value < x599 del mismo mil
-        max(0, (thousands - 1) * 1000 + 599),
-    ]
-    # quitar duplicados y no-negativos
-    candidates = sorted(set([c for c in candidates if c >= 0]))
-    # elegir por distancia; si empata, preferir 999
-    best = None
-    best_dist = None
-    for c in candidates:
-        dist = abs(c - value)
-        if best is None or dist < best_dist or (dist == best_dist and c % 1000 == 999):
-            best = c
-            best_dist = dist
-    return float(best if best is not None else value)
+# campos editables de un producto, en el orden de los INSERT/UPDATE
+PRODUCT_FIELDS = (
+    "brand", "name", "sku", "fob_usd", "peso_kg", "costo_flete_usd_kg", "costo_financiero",
+    "arancel", "aduana", "despachante", "banco", "iva", "envio_ars", "margen_neto", "precio_manual_ars",
+)
+TEXT_FIELDS = ("brand", "name", "sku")
+
+def normalize_product_data(raw: Mapping[str, Any], keys: Sequence[str] = PRODUCT_FIELDS) -> Dict[str, str]:
+    """Limpia los campos de un producto: recorta espacios y en los numéricos acepta coma
+    decimal; vacío equivale a 0."""
+    data = {}
+    for k in keys:
+        v = raw.get(k)
+        data[k] = "" if v is None else str(v).strip()
+        if k not in TEXT_FIELDS:
+            data[k] = data[k].replace(",", ".") or "0"
+    return data
+
+# --- Redondeo a terminaciones ---
+# Cada canal redondea a un conjunto de terminaciones (los tres últimos dígitos). Los candidatos
+# son esas terminaciones dentro del mil del valor y del mil siguiente (nunca del anterior: el
+# precio no baja del mil en que cae); gana el más cercano y, en caso de empate, el menor.
+# Por defecto todos los canales usan 599 y la variable `redondeo`. PRICE_ENDINGS lo cambia por
+# canal, p. ej. "web=599,999;ml=999" ("ml" abarca todas las cuotas).
+CHANNELS = ("web", "ml1", "ml3", "ml6", "ml9", "ml12")
+CHANNEL_FIELDS = dict(zip(CHANNELS, (
+    "precio_web_ars", "precio_ml_1_ars", "precio_ml_3_ars", "precio_ml_6_ars", "precio_ml_9_ars", "precio_ml_12_ars",
+)))
+CHANNEL_COEFS = dict(zip(CHANNELS, (None, "coef_ml_1", "coef_ml_3", "coef_ml_6", "coef_ml_9", "coef_ml_12")))
+
+def parse_price_endings(spec: str) -> Dict[str, Tuple[int, ...]]:
+    out = {}
+    for part in filter(None, (p.strip() for p in spec.split(";"))):
+        name, _, values = part.partition("=")
+        name = name.strip()
+        channels = [c for c in CHANNELS if c.startswith("ml")] if name == "ml" else [name]
+        endings = tuple(sorted({int(v) for v in values.split(",") if v.strip()}))
+        if any(c not in CHANNELS for c in channels) or not endings or not all(0 <= e < 1000 for e in endings):
+            raise ValueError(f"PRICE_ENDINGS inválido: {part!r}")
+        out.update((c, endings) for c in channels)
+    return out
+
+PRICE_ENDINGS_SPEC = os.environ.get("PRICE_ENDINGS", "")
+PRICE_ENDINGS = parse_price_endings(PRICE_ENDINGS_SPEC)
+
+def channel_endings(channel: str, vars: Mapping[str, float]) -> Tuple[int, ...]:
+    if channel in PRICE_ENDINGS:
+        return PRICE_ENDINGS[channel]
+    return tuple(sorted({599, int(vars.get("redondeo", 999)) % 1000}))
+
+@lru_cache(maxsize=64)
+def ending_steps(endings: Tuple[int, ...]) -> np.ndarray:
+    """Desplazamientos candidatos desde el mil del valor: las terminaciones de ese mil y del siguiente."""
+    return np.array(endings + tuple(e + 1000 for e in endings), dtype=np.float64)
+
+@lru_cache(maxsize=64)
+def ending_steps_list(endings: Tuple[int, ...]) -> List[float]:
+    return ending_steps(endings).tolist()
+
+def redondear(valor: float, endings: Tuple[int, ...]) -> float:
+    """Redondeo de un solo valor en forma cerrada (misma regla que redondear_array, sin numpy)."""
+    if not math.isfinite(valor):
+        return valor
+    steps = ending_steps_list(endings)
+    base = (math.trunc(valor) // 1000) * 1000
+    resto = valor - base
+    pos = min(max(bisect.bisect_left(steps, resto), 1), len(steps) - 1)
+    lo, hi = steps[pos - 1], steps[pos]
+    return float(base + (lo if resto - lo <= hi - resto else hi))
+
+def redondear_array(valores: np.ndarray, endings: Tuple[int, ...]) -> np.ndarray:
+    """Redondea una columna entera de precios: searchsorted ubica cada resto entre dos
+    terminaciones consecutivas y se queda con la más cercana (la menor si empatan)."""
+    steps = ending_steps(endings)
+    with np.errstate(invalid="ignore"):
+        base = np.floor_divide(np.trunc(valores), 1000) * 1000
+        resto = valores - base
+        # resto < steps[0] cae en pos 1 con lo = steps[0], que es justo lo que corresponde
+        pos = np.clip(np.searchsorted(steps, resto), 1, len(steps) - 1)
+        lo, hi = steps[pos - 1], steps[pos]
+        out = base + np.where(resto - lo <= hi - resto, lo, hi)
+    return np.where(np.isfinite(valores), out, valores)
 
 @dataclass
 class CalcResult:
@@ -273,156 +1211,1701 @@ class CalcResult:
     precio_ml_12_ars: float
 
 
-def calculate_prices(vars: Dict[str, float], p: sqlite3.Row) -> CalcResult:
+# columnas de products que intervienen en el cálculo (todas NOT NULL salvo precio_manual_ars)
+PRICE_INPUT_COLUMNS = (
+    "fob_usd", "peso_kg", "costo_flete_usd_kg", "costo_financiero", "arancel",
+    "aduana", "despachante", "banco", "iva", "envio_ars", "margen_neto",
+)
+CALC_FIELDS = tuple(f.name for f in fields(CalcResult))
+
+
+@dataclass
+class PriceBatch:
+    """Resultado columnar de calculate_prices_batch: un array por campo de CalcResult."""
+    cif_usd: np.ndarray
+    costo_final_usd: np.ndarray
+    pv_neto_usd: np.ndarray
+    margen_neto: np.ndarray
+    precio_web_ars: np.ndarray
+    precio_ml_1_ars: np.ndarray
+    precio_ml_3_ars: np.ndarray
+    precio_ml_6_ars: np.ndarray
+    precio_ml_9_ars: np.ndarray
+    precio_ml_12_ars: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.cif_usd)
+
+    def row(self, i: int) -> CalcResult:
+        return CalcResult(*(float(getattr(self, f)[i]) for f in CALC_FIELDS))
+
+    def __iter__(self) -> Iterator[CalcResult]:
+        cols = [getattr(self, f).tolist() for f in CALC_FIELDS]
+        for values in zip(*cols):
+            yield CalcResult(*values)
+
+
+def product_arrays(products: Sequence[Mapping[str, Any]]) -> Dict[str, np.ndarray]:
+    """Pasa las columnas de precio de una lista de filas a arrays float64."""
+    n = len(products)
+    cols = {c: np.fromiter((p[c] for p in products), dtype=np.float64, count=n) for c in PRICE_INPUT_COLUMNS}
+    # precio manual vacío/0/NULL equivale a "sin precio manual" (mismo criterio que `if precio_manual`)
+    cols["precio_manual_ars"] = np.fromiter(
+        (p["precio_manual_ars"] or 0.0 for p in products), dtype=np.float64, count=n
+    )
+    return cols
+
+
+def calculate_prices_arrays(vars: Dict[str, float], cols: Dict[str, np.ndarray]) -> PriceBatch:
+    with timed_phase("pricing"):
+        return _calculate_prices_arrays(vars, cols)
+
+def _calculate_prices_arrays(vars: Dict[str, float], cols: Dict[str, np.ndarray]) -> PriceBatch:
     dolar = vars.get("dolar", 1.0)
-    redondeo = int(vars.get("redondeo", 999))
-
-    # --- datos específicos del producto ---
-    fob = float(p["fob_usd"])
-    peso = float(p["peso_kg"])
-    flete_kg = float(p["costo_flete_usd_kg"])
-    fin = float(p["costo_financiero"])
-    arancel = float(p["arancel"])
-    aduana = float(p["aduana"])
-    desp = float(p["despachante"])
-    banco = float(p["banco"])
-    iva = float(p["iva"])
-    envio_ars = float(p["envio_ars"])
-    margen = float(p["margen_neto"])
-    precio_manual = p["precio_manual_ars"]
+
+    fob = cols["fob_usd"]
+    iva = cols["iva"]
+    envio_ars = cols["envio_ars"]
+    precio_manual = cols["precio_manual_ars"]
 
     # --- cálculos base ---
-    cif_usd = (fob + (fob * fin)) + (flete_kg * peso)
-    costo_final_usd = cif_usd * (1 + arancel + aduana + desp + banco)
+    cif_usd = (fob + (fob * cols["costo_financiero"])) + (cols["costo_flete_usd_kg"] * cols["peso_kg"])
+    costo_final_usd = cif_usd * (1 + cols["arancel"] + cols["aduana"] + cols["despachante"] + cols["banco"])
 
-    if precio_manual:
-        pv_neto_usd = (precio_manual / (1 + iva)) / dolar
-        margen_neto = ((pv_neto_usd - costo_final_usd) / costo_final_usd)
-    else:
-        pv_neto_usd = costo_final_usd * (1 + margen)
-        margen_neto = margen
+    manual = precio_manual != 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pv_neto_usd = np.where(manual, (precio_manual / (1 + iva)) / dolar, costo_final_usd * (1 + cols["margen_neto"]))
+        margen_neto = np.where(manual, (pv_neto_usd - costo_final_usd) / costo_final_usd, cols["margen_neto"])
 
     # --- precios ARS ---
-    def redondear(valor: float) -> float:
-        base = int(valor)
-        miles = base // 1000
-        candidatos = [miles * 1000 + 599, miles * 1000 + redondeo, (miles + 1) * 1000 + 599, (miles + 1) * 1000 + redondeo]
-        mejor = min(candidatos, key=lambda x: abs(x - valor))
-        return mejor
-
-    coef1 = vars.get("coef_ml_1", 1.0)
-    coef3 = vars.get("coef_ml_3", 1.0)
-    coef6 = vars.get("coef_ml_6", 1.0)
-    coef9 = vars.get("coef_ml_9", 1.0)
-    coef12 = vars.get("coef_ml_12", 1.0)
-
-    precio_web_ars = redondear(pv_neto_usd * dolar * (1 + iva) + envio_ars)
-    precio_ml_1_ars = redondear(pv_neto_usd * dolar * (1 + iva) * coef1 + envio_ars)
-    precio_ml_3_ars = redondear(pv_neto_usd * dolar * (1 + iva) * coef3 + envio_ars)
-    precio_ml_6_ars = redondear(pv_neto_usd * dolar * (1 + iva) * coef6 + envio_ars)
-    precio_ml_9_ars = redondear(pv_neto_usd * dolar * (1 + iva) * coef9 + envio_ars)
-    precio_ml_12_ars = redondear(pv_neto_usd * dolar * (1 + iva) * coef12 + envio_ars)
-
-    return CalcResult(
+    base_ars = pv_neto_usd * dolar * (1 + iva)
+    prices = {}
+    for channel, col in CHANNEL_FIELDS.items():
+        coef = CHANNEL_COEFS[channel]
+        valor = (base_ars if coef is None else base_ars * vars.get(coef, 1.0)) + envio_ars
+        prices[col] = redondear_array(valor, channel_endings(channel, vars))
+    return PriceBatch(
         cif_usd=cif_usd,
         costo_final_usd=costo_final_usd,
         pv_neto_usd=pv_neto_usd,
         margen_neto=margen_neto,
-        precio_web_ars=precio_web_ars,
-        precio_ml_1_ars=precio_ml_1_ars,
-        precio_ml_3_ars=precio_ml_3_ars,
-        precio_ml_6_ars=precio_ml_6_ars,
-        precio_ml_9_ars=precio_ml_9_ars,
-        precio_ml_12_ars=precio_ml_12_ars
+        **prices,
     )
 
+
+def calculate_prices_batch(vars: Dict[str, float], products: Sequence[Mapping[str, Any]]) -> PriceBatch:
+    """Calcula los precios de muchos productos a la vez, columna por columna."""
+    return calculate_prices_arrays(vars, product_arrays(products))
+
+
+def fdiv(a: float, b: float) -> float:
+    """a / b con la semántica de numpy: dividir por cero da ±inf (o nan si a es 0)."""
+    try:
+        return a / b
+    except ZeroDivisionError:
+        if a == 0 or math.isnan(a):
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+def calculate_prices(vars: Dict[str, float], p: Mapping[str, Any]) -> CalcResult:
+    """Un solo producto, con floats de Python: las mismas operaciones y en el mismo orden que
+    _calculate_prices_arrays (da exactamente lo mismo) sin el costo de armar arrays de uno."""
+    with timed_phase("pricing"):
+        dolar = vars.get("dolar", 1.0)
+        fob, iva, envio_ars = p["fob_usd"], p["iva"], p["envio_ars"]
+        precio_manual = p["precio_manual_ars"] or 0.0
+
+        cif_usd = (fob + (fob * p["costo_financiero"])) + (p["costo_flete_usd_kg"] * p["peso_kg"])
+        costo_final_usd = cif_usd * (1 + p["arancel"] + p["aduana"] + p["despachante"] + p["banco"])
+        if precio_manual != 0:
+            pv_neto_usd = fdiv(fdiv(precio_manual, 1 + iva), dolar)
+            margen_neto = fdiv(pv_neto_usd - costo_final_usd, costo_final_usd)
+        else:
+            pv_neto_usd = costo_final_usd * (1 + p["margen_neto"])
+            margen_neto = p["margen_neto"]
+
+        base_ars = pv_neto_usd * dolar * (1 + iva)
+        prices = {}
+        for channel, col in CHANNEL_FIELDS.items():
+            coef = CHANNEL_COEFS[channel]
+            valor = (base_ars if coef is None else base_ars * vars.get(coef, 1.0)) + envio_ars
+            prices[col] = redondear(valor, channel_endings(channel, vars))
+        return CalcResult(
+            cif_usd=float(cif_usd),
+            costo_final_usd=float(costo_final_usd),
+            pv_neto_usd=float(pv_neto_usd),
+            margen_neto=float(margen_neto),
+            **prices,
+        )
+
 # ==============================
-# Routes
+# Precios materializados (computed_prices)
 # ==============================
-@app.route("/")
-@login_required
-def home():
-    init_db()
+# Cada fila guarda el CalcResult de un producto junto con la versión de variables y la
+# versión del producto (products.version) con que se calculó. Si alguna no coincide, está vencida.
+COMPUTED_COLUMNS = ", ".join(f"cp.{f} AS calc_{f}" for f in CALC_FIELDS)
+
+PRICE_FIELDS = tuple(f for f in CALC_FIELDS if f.startswith("precio_"))
+
+# prices_changed_at solo avanza si cambió alguno de los seis precios (sirve para exportar incrementales)
+UPSERT_COMPUTED_SQL = f"""
+    INSERT INTO computed_prices(product_id, vars_version, product_version, product_updated_at, {", ".join(CALC_FIELDS)}, prices_changed_at)
+    VALUES (?, ?, ?, ?, {", ".join("?" for _ in CALC_FIELDS)}, datetime('now'))
+    ON CONFLICT(product_id) DO UPDATE SET
+      vars_version=excluded.vars_version,
+      product_version=excluded.product_version,
+      product_updated_at=excluded.product_updated_at,
+      {", ".join(f"{f}=excluded.{f}" for f in CALC_FIELDS)},
+      prices_changed_at=CASE
+        WHEN {" OR ".join(f"computed_prices.{f} IS NOT excluded.{f}" for f in PRICE_FIELDS)}
+        THEN excluded.prices_changed_at ELSE computed_prices.prices_changed_at
+      END
+"""
+
+def calc_from_row(row: Mapping[str, Any]) -> CalcResult:
+    """Arma el CalcResult de una fila leída con COMPUTED_COLUMNS (siempre al final del SELECT)."""
+    return CalcResult(*row[-len(CALC_FIELDS):])
+
+def store_computed_prices(products: Sequence[Mapping[str, Any]], batch: PriceBatch, version: int) -> int:
+    get_write_db().executemany(
+        UPSERT_COMPUTED_SQL,
+        ((p["id"], version, p["version"], p["updated_at"], *astuple(c)) for p, c in zip(products, batch)),
+    )
+    return len(products)
+
+def refresh_computed_prices(product_ids: Optional[Sequence[int]] = None) -> int:
+    """Recalcula las filas vencidas de computed_prices (o solo las de product_ids).
+
+    Devuelve la cantidad de productos recalculados."""
+    db = get_write_db()
+    version = get_vars_version()
+    if product_ids is None:
+        products = db.execute(
+            """
+            SELECT p.* FROM products p
+            LEFT JOIN computed_prices cp ON cp.product_id = p.id
+            WHERE cp.product_id IS NULL OR cp.vars_version != ? OR cp.product_version IS NOT p.version
+            """,
+            (version,),
+        ).fetchall()
+    else:
+        # json_each en vez de IN (?, ...): una edición masiva puede pasar más ids que variables admite SQLite
+        products = db.execute(
+            "SELECT * FROM products WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(list(product_ids)),)
+        ).fetchall()
+    if not products:
+        return 0
+    n = store_computed_prices(products, calculate_prices_batch(get_variables(), products), version)
+    db.commit()
+    return n
+
+def priced_products_query(
+    product_ids: Optional[Sequence[int]] = None,
+    after: Optional[Tuple[str, str, int]] = None,
+    limit: Optional[int] = None,
+    matching: Optional[Sequence[int]] = None,
+) -> Tuple[str, Tuple[Any, ...]]:
+    """SQL + parámetros para leer productos junto con sus precios materializados.
+
+    Sin product_ids recorre el catálogo en orden (brand, name, id), opcionalmente desde el
+    cursor `after` (paginación por keyset sobre idx_products_brand_name_id) y limitado a los
+    ids de `matching` (p. ej. los de una búsqueda). Con product_ids trae solo esos, en el
+    orden recibido."""
+    select = f"""
+        SELECT p.*, cp.vars_version AS calc_vars_version, cp.product_version AS calc_product_version, {COMPUTED_COLUMNS}
+    """
+    params: Tuple[Any, ...]
+    if product_ids is None:
+        sql = select + " FROM products p LEFT JOIN computed_prices cp ON cp.product_id = p.id"
+        where, params = [], ()
+        if matching is not None:
+            where.append("p.id IN (SELECT value FROM json_each(?))")
+            params += (json.dumps(list(matching)),)
+        if after is not None:
+            where.append("(p.brand, p.name, p.id) > (?, ?, ?)")
+            params += tuple(after)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY p.brand, p.name, p.id"
+    else:
+        sql = select + """
+            FROM json_each(?) ids
+            JOIN products p ON p.id = ids.value
+            LEFT JOIN computed_prices cp ON cp.product_id = p.id
+            ORDER BY ids.key
+        """
+        params = (json.dumps(list(product_ids)),)
+    if limit is not None:
+        sql += " LIMIT ?"
+        params += (limit,)
+    return sql, params
+
+def attach_prices(products: Sequence[sqlite3.Row], version: int, persist: bool = True) -> List[Tuple[sqlite3.Row, CalcResult]]:
+    """Empareja cada fila con su CalcResult; las filas vencidas se calculan en el momento
+    (y se guardan si persist)."""
+    calcs: List[Optional[CalcResult]] = [
+        None if p["calc_vars_version"] != version or p["calc_product_version"] != p["version"] else calc_from_row(p)
+        for p in products
+    ]
+    stale = [i for i, c in enumerate(calcs) if c is None]
+    if stale:
+        stale_rows = [products[i] for i in stale]
+        batch = calculate_prices_batch(get_variables(), stale_rows)
+        for i, c in zip(stale, batch):
+            calcs[i] = c
+        if persist:
+            store_computed_prices(stale_rows, batch, version)
+            get_write_db().commit()
+    return list(zip(products, calcs))
+
+def load_priced_products(
+    product_ids: Optional[Sequence[int]] = None,
+    after: Optional[Tuple[str, str, int]] = None,
+    limit: Optional[int] = None,
+    matching: Optional[Sequence[int]] = None,
+) -> List[Tuple[sqlite3.Row, CalcResult]]:
+    """Lee productos + precios materializados en un solo SELECT (ver priced_products_query).
+
+    Si aparece alguna fila vencida (p. ej. escrita por fuera de la app) se recalcula esa sola."""
+    version = get_vars_version()
+    sql, params = priced_products_query(product_ids, after, limit, matching)
+    return attach_prices(get_db().execute(sql, params).fetchall(), version)
+
+def iter_priced_products(
+    product_ids: Optional[Sequence[int]] = None,
+    after: Optional[Tuple[str, str, int]] = None,
+    chunk_size: int = 500,
+    matching: Optional[Sequence[int]] = None,
+) -> Iterator[List[Tuple[sqlite3.Row, CalcResult]]]:
+    """Como load_priced_products pero de a bloques sobre el cursor: la memoria no depende
+    del tamaño del catálogo. Las filas vencidas se calculan pero no se guardan."""
+    version = get_vars_version()
+    sql, params = priced_products_query(product_ids, after, matching=matching)
+    with closing(get_db().execute(sql, params)) as cur:
+        while True:
+            chunk = cur.fetchmany(chunk_size)
+            if not chunk:
+                break
+            yield attach_prices(chunk, version, persist=False)
+
+def encode_cursor(p: Mapping[str, Any]) -> str:
+    raw = json.dumps([p["brand"], p["name"], p["id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(token: str) -> Optional[Tuple[str, str, int]]:
+    try:
+        brand, name, pid = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return str(brand), str(name), int(pid)
+    except (ValueError, TypeError):
+        return None
+
+# ==============================
+# Búsqueda (FTS5)
+# ==============================
+SKU_FRAGMENT_MIN = 3  # el tokenizer trigram no matchea nada más corto
+
+def fts_query(q: str) -> str:
+    """Convierte lo que escribe el usuario en una consulta FTS5.
+
+    Cada palabra es una frase con prefijo, así "len x1" encuentra "Lenovo ThinkPad X1" y un
+    SKU desde el comienzo de una parte, como "15dy-20", encuentra "HP-15DY-2045" (el tokenizer
+    parte en los guiones). Las palabras se combinan con AND."""
+    return " ".join('"{}"*'.format(term.replace('"', '""')) for term in q.split())
+
+def sku_fragment_query(q: str) -> Optional[str]:
+    """Consulta para products_sku_fts: q entero como subcadena del SKU (como el LIKE de antes),
+    así "5dy" o "dy-20" encuentran "HP-15DY-2045". None si es muy corto para trigramas."""
+    q = q.strip()
+    if len(q) < SKU_FRAGMENT_MIN:
+        return None
+    return '"{}"'.format(q.replace('"', '""'))
+
+def search_product_ids(q: str, limit: Optional[int] = None) -> List[int]:
+    """Ids de productos que matchean q: primero los de products_fts, después los que solo
+    contienen q dentro del SKU. Sin orden de relevancia: el listado los muestra por
+    (brand, name, id), igual que sin búsqueda, así el cursor sigue sirviendo."""
     db = get_db()
-    q = (request.args.get("q") or "").strip().lower()
+    try:
+        ids = [r[0] for r in db.execute("SELECT rowid FROM products_fts WHERE products_fts MATCH ? ORDER BY rowid", (fts_query(q),))]
+    except sqlite3.OperationalError:
+        # consulta que FTS5 no puede interpretar: sin resultados por palabras
+        ids = []
+    fragment = sku_fragment_query(q)
+    if fragment is not None and (limit is None or len(ids) < limit):
+        seen = set(ids)
+        ids += [
+            r[0] for r in db.execute("SELECT rowid FROM products_sku_fts WHERE products_sku_fts MATCH ? ORDER BY rowid", (fragment,))
+            if r[0] not in seen
+        ]
+    return ids if limit is None else ids[:limit]
+
+# ==============================
+# Snapshot del catálogo
+# ==============================
+# Cada worker guarda en memoria una foto inmutable de variables + productos con sus precios,
+# en el orden del listado. En cada request se compara snapshot_version() (una lectura de
+# catalog_meta) con la de la foto y solo se rehace si alguien escribió, sea este proceso u otro.
+# Catálogos de más de SNAPSHOT_MAX_PRODUCTS productos guardan solo las variables y el listado
+# sigue leyendo de SQLite.
+SNAPSHOT_MAX_PRODUCTS = int(os.environ.get("SNAPSHOT_MAX_PRODUCTS", "200000"))
+
+PricedRow = Tuple[sqlite3.Row, CalcResult]
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    source: str
+    version: Tuple[int, ...]
+    variables: Mapping[str, float]
+    rows: Optional[Tuple[PricedRow, ...]]          # orden (brand, name, id); None si no entra
+    keys: Tuple[Tuple[str, str, int], ...] = ()    # claves de orden de rows, para bisect
+    by_id: Mapping[int, PricedRow] = field(default_factory=dict)
+
+    def page(self, after: Optional[Tuple[str, str, int]], limit: int, matching: Optional[Sequence[int]] = None) -> List[PricedRow]:
+        if matching is None:
+            rows, keys = self.rows, self.keys
+        else:
+            # solo las filas buscadas, en el mismo orden que el listado completo
+            rows = sorted(self.lookup(matching), key=lambda r: (r[0]["brand"], r[0]["name"], r[0]["id"]))
+            keys = [(p["brand"], p["name"], p["id"]) for p, _ in rows]
+        start = bisect.bisect_right(keys, after) if after is not None else 0
+        return list(rows[start:start + limit])
+
+    def lookup(self, product_ids: Sequence[int]) -> List[PricedRow]:
+        return [self.by_id[pid] for pid in product_ids if pid in self.by_id]
+
+_snapshot: Optional[CatalogSnapshot] = None
+_snapshot_lock = threading.Lock()
+
+def build_snapshot(version: Tuple[int, ...], previous: Optional[CatalogSnapshot] = None) -> CatalogSnapshot:
+    # la versión se lee antes que los datos: si alguien escribe en el medio, la foto queda
+    # marcada como vieja y se rehace en el request siguiente (nunca al revés)
+    variables = types.MappingProxyType(get_variables())
+    if previous is not None and previous.source == DB_PATH and previous.version[:2] == version[:2]:
+        # cambiaron solo variables que no tocan precios: los productos siguen valiendo
+        return replace(previous, version=version, variables=variables)
+    count = get_db().execute("SELECT count(*) FROM products").fetchone()[0]
+    if count > SNAPSHOT_MAX_PRODUCTS:
+        return CatalogSnapshot(DB_PATH, version, variables, None)
+    rows = tuple(load_priced_products())
+    return CatalogSnapshot(
+        DB_PATH, version, variables, rows,
+        keys=tuple((p["brand"], p["name"], p["id"]) for p, _ in rows),
+        by_id=types.MappingProxyType({p["id"]: (p, c) for p, c in rows}),
+    )
+
+def catalog_snapshot(build: bool = True) -> Optional[CatalogSnapshot]:
+    """La foto vigente, rehaciéndola si quedó vieja. Con build=False devuelve None en ese
+    caso (para rutas que resuelven más barato con SQL que rehaciendo la foto entera)."""
+    global _snapshot
+    snap = _snapshot
+    if snap is not None and snap.source == DB_PATH and snap.version == snapshot_version():
+        return snap
+    if not build:
+        return None
+    with _snapshot_lock:
+        # otro hilo pudo haberla rehecho mientras esperábamos
+        version = snapshot_version()
+        snap = _snapshot
+        if snap is None or snap.source != DB_PATH or snap.version != version:
+            snap = _snapshot = build_snapshot(version, snap)
+    return snap
+
+# ==============================
+# Trabajos en segundo plano
+# ==============================
+# El estado vive en la tabla jobs (no en memoria) para que cualquier worker pueda
+# responder /jobs/<id>. Un trabajo sin heartbeat por JOB_STALE_SECONDS se da por caído.
+RECALC_CHUNK_SIZE = int(os.environ.get("RECALC_CHUNK_SIZE", "2000"))  # productos por transacción
+# procesos para el recálculo total; con 1 se calcula en el mismo hilo del trabajo
+RECALC_WORKERS = int(os.environ.get("RECALC_WORKERS", "1"))
+# por debajo de esto levantar el pool (spawn + importar el módulo en cada proceso) cuesta más
+# de lo que ahorra: se calcula en el hilo del trabajo aunque se hayan pedido más workers
+RECALC_POOL_MIN_PRODUCTS = int(os.environ.get("RECALC_POOL_MIN_PRODUCTS", "50000"))
+JOB_STALE_SECONDS = 120
+
+INSERT_HISTORY_SQL = """
+    INSERT INTO price_history(product_id, precio_web_ars, precio_ml1_ars, precio_ml3_ars, precio_ml6_ars, precio_ml9_ars, precio_ml12_ars, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def now_iso() -> str:
+    return datetime.now().isoformat(timespec="milliseconds")
+
+def start_job(kind: str, target, total: int) -> Optional[int]:
+    """Registra un trabajo y lo corre en un hilo aparte. Devuelve None si ya hay uno del
+    mismo tipo en curso."""
+    db = get_write_db()
+    db.execute(
+        "UPDATE jobs SET status='failed', error='sin heartbeat', finished_at=? WHERE status='running' AND heartbeat_at < ?",
+        (now_iso(), (datetime.now() - timedelta(seconds=JOB_STALE_SECONDS)).isoformat(timespec="milliseconds")),
+    )
+    try:
+        started = now_iso()
+        job_id = db.execute(
+            "INSERT INTO jobs(kind, status, total, started_at, heartbeat_at) VALUES (?, 'running', ?, ?, ?)",
+            (kind, total, started, started),
+        ).lastrowid
+        db.commit()
+    except sqlite3.IntegrityError:
+        db.rollback()
+        return None
+    threading.Thread(target=run_job, args=(job_id, target), name=f"{kind}-{job_id}", daemon=True).start()
+    return job_id
+
+def run_job(job_id: int, target):
+    with app.app_context():
+        db = get_write_db()
+        try:
+            rows_written = target(job_id)
+            db.execute(
+                "UPDATE jobs SET status='done', rows_written=?, finished_at=?, heartbeat_at=? WHERE id=?",
+                (rows_written, now_iso(), now_iso(), job_id),
+            )
+        except Exception as exc:
+            app.logger.exception("job %s falló", job_id)
+            db.rollback()
+            db.execute(
+                "UPDATE jobs SET status='failed', error=?, finished_at=? WHERE id=?",
+                (repr(exc), now_iso(), job_id),
+            )
+        db.commit()
+
+def recalc_job(job_id: int, workers: Optional[int] = None, chunk_size: Optional[int] = None) -> int:
+    """Recalcula todo el catálogo de a chunk_size productos: cada bloque escribe su
+    historial y sus precios materializados en una transacción propia."""
+    db = get_write_db()
+
+    def progress(done: int, written: int):
+        db.execute("UPDATE jobs SET done=?, rows_written=?, heartbeat_at=? WHERE id=?", (done, written, now_iso(), job_id))
+
+    _, written = recalc_catalog(workers, chunk_size, progress)
+    start_job("compact", compact_job, 0)
+    return written
+
+def recalc_catalog(workers: Optional[int] = None, chunk_size: Optional[int] = None, progress=None) -> Tuple[int, int]:
+    """Recalcula y guarda todos los precios. Devuelve (productos, filas de historial escritas).
+
+    Con más de un worker el cálculo se reparte en procesos (ver price_shards); la escritura
+    sigue siendo de este hilo solo, así SQLite nunca ve dos escritores. `progress(done, written)`
+    se llama dentro de la transacción de cada bloque."""
+    chunk_size = chunk_size or RECALC_CHUNK_SIZE
+    db = get_write_db()
+    workers = recalc_workers(workers or RECALC_WORKERS)
     vars_map = get_variables()
-    products = db.execute("SELECT * FROM products ORDER BY brand, name").fetchall()
-
-    rows = []
-    for p in products:
-        calc = calculate_prices(vars_map, p)
-        rows.append((p, calc))
-
-    if q:
-        rows = [r for r in rows if q in r[0]["name"].lower() or q in r[0]["sku"].lower() or q in r[0]["brand"].lower()]
-
-    body = render_template_string(
-    r"""
-    <div class="flex items-center justify-between mb-4">
-      <form method="get">
-        <input name="q" value="{{ q }}" placeholder="Buscar por marca, modelo o SKU" class="border p-2 rounded w-72" />
-      </form>
-      <div class="flex gap-2">
-        <a href="{{ url_for('recalc_all') }}" class="px-3 py-2 bg-emerald-700 text-white rounded">Recalcular todo</a>
-        <a href="{{ url_for('new_product') }}" class="px-3 py-2 bg-slate-900 text-white rounded">+ Nuevo producto</a>
-      </div>
-    </div>
+    version = get_vars_version()
+    created_at = datetime.now().isoformat(timespec="seconds")
+    shards = price_shards(vars_map, chunk_size, workers) if workers > 1 else local_shards(vars_map, chunk_size)
+    done, written = 0, 0
+    for products, batch in shards:
+        with db:
+            history = changed_history_rows(products, batch, created_at)
+            db.executemany(INSERT_HISTORY_SQL, history)
+            store_computed_prices(products, batch, version)
+            done += len(products)
+            written += len(history)
+            if progress is not None:
+                progress(done, written)
+    return done, written
+
+def available_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def recalc_workers(requested: int) -> int:
+    """Procesos que vale la pena usar: ninguno extra con una sola CPU o un catálogo chico, y
+    nunca más que las CPUs disponibles."""
+    cpus = available_cpus()
+    if requested <= 1 or cpus <= 1:
+        return 1
+    if get_write_db().execute("SELECT count(*) FROM products").fetchone()[0] < RECALC_POOL_MIN_PRODUCTS:
+        return 1
+    return min(requested, cpus)
+
+def local_shards(vars_map: Dict[str, float], chunk_size: int) -> Iterator[Tuple[Sequence[Mapping[str, Any]], PriceBatch]]:
+    db = get_write_db()
+    last_id = 0
+    while True:
+        chunk = db.execute("SELECT * FROM products WHERE id > ? ORDER BY id LIMIT ?", (last_id, chunk_size)).fetchall()
+        if not chunk:
+            return
+        yield chunk, calculate_prices_batch(vars_map, chunk)
+        last_id = chunk[-1]["id"]
+
+# ---------- Recálculo repartido en procesos ----------
+# El catálogo se corta en rangos de id de chunk_size productos. Cada proceso del pool (spawn:
+# nada de conexiones SQLite heredadas por fork) lee su rango con su propia conexión de solo
+# lectura, calcula y devuelve arrays: ids, versiones, updated_at y el PriceBatch. Los resultados
+# se consumen en orden de id, así el historial queda escrito igual que en el camino de un solo
+# proceso. Si un proceso muere, result() levanta BrokenProcessPool y el trabajo queda como fallido.
+_shard_vars: Dict[str, float] = {}
+SHARD_WINDOW = 2  # rangos en vuelo por proceso
+
+def shard_bounds(chunk_size: int) -> List[Tuple[int, int]]:
+    """Rangos (desde, hasta] de id con chunk_size productos cada uno."""
+    ids = [r[0] for r in get_write_db().execute("SELECT id FROM products ORDER BY id")]
+    cuts = ids[chunk_size - 1::chunk_size]
+    if ids and (not cuts or cuts[-1] != ids[-1]):
+        cuts.append(ids[-1])
+    return list(zip([0] + cuts[:-1], cuts))
+
+def init_shard_worker(db_path: str, vars_map: Dict[str, float]):
+    global DB_PATH, _shard_vars
+    DB_PATH = db_path
+    _shard_vars = vars_map
+
+def price_shard(bounds: Tuple[int, int]) -> Tuple[List[int], List[int], List[str], PriceBatch]:
+    products = worker_connection(readonly=True).execute(
+        "SELECT * FROM products WHERE id > ? AND id <= ? ORDER BY id", bounds
+    ).fetchall()
+    return (
+        [p["id"] for p in products], [p["version"] for p in products], [p["updated_at"] for p in products],
+        calculate_prices_batch(_shard_vars, products),
+    )
 
-    <div class="overflow-x-auto">
-    <table class="min-w-full bg-white rounded shadow">
-      <thead class="bg-slate-100 text-left text-sm">
-        <tr>
-          <th class="p-2">Marca</th>
-          <th class="p-2">Producto</th>
-          <th class="p-2">SKU</th>
-          <th class="p-2 text-right">FOB (USD)</th>
-          <th class="p-2 text-right">Costo Final USD</th>
-          <th class="p-2 text-right">Margen Neto %</th>
-          <th class="p-2 text-right">Web (ARS)</th>
-          <th class="p-2 text-right">ML 1</th>
-          <th class="p-2 text-right">ML 3</th>
-          <th class="p-2 text-right">ML 6</th>
-          <th class="p-2 text-right">ML 9</th>
-          <th class="p-2 text-right">ML 12</th>
-          <th class="p-2"></th>
-        </tr>
-      </thead>
-      <tbody class="text-sm">
-        {% for p, c in rows %}
-        <tr class="border-t hover:bg-slate-50">
-          <td class="p-2">{{ p['brand'] }}</td>
-          <td class="p-2">{{ p['name'] }}</td>
-          <td class="p-2 font-mono">{{ p['sku'] }}</td>
-          <td class="p-2 text-right">{{ '%.2f' % p['fob_usd'] }}</td>
-          <td class="p-2 text-right">{{ '%.2f' % c.costo_final_usd }}</td>
-          <td class="p-2 text-right {% if c.margen_neto < 0.05 %}text-red-600{% elif c.margen_neto < 0.1 %}text-yellow-600{% else %}text-emerald-700{% endif %}">
-            {{ '%.2f' % (c.margen_neto * 100) }}%
-          </td>
-          <td class="p-2 text-right money">{{ money(c.precio_web_ars) }}</td>
-          <td class="p-2 text-right money">{{ money(c.precio_ml_1_ars) }}</td>
-          <td class="p-2 text-right money">{{ money(c.precio_ml_3_ars) }}</td>
-          <td class="p-2 text-right money">{{ money(c.precio_ml_6_ars) }}</td>
-          <td class="p-2 text-right money">{{ money(c.precio_ml_9_ars) }}</td>
-          <td class="p-2 text-right money">{{ money(c.precio_ml_12_ars) }}</td>
-          <td class="p-2 text-right">
-            <a href="{{ url_for('edit_product', pid=p['id']) }}" class="text-blue-700 hover:underline">Editar</a>
-          </td>
-        </tr>
-        {% endfor %}
-      </tbody>
-    </table>
-    </div>
-    """,
-    rows=rows, q=q, money=money,
+def price_shards(vars_map: Dict[str, float], chunk_size: int, workers: int) -> Iterator[Tuple[Sequence[Mapping[str, Any]], PriceBatch]]:
+    bounds = shard_bounds(chunk_size)
+    if not bounds:
+        return
+    workers = min(workers, len(bounds))
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_shard_worker, initargs=(DB_PATH, vars_map),
+    ) as pool:
+        # a lo sumo SHARD_WINDOW rangos por proceso en vuelo: el que escribe es más lento que
+        # los que calculan, y con todo encolado de entrada los resultados se apilarían en memoria
+        pending: Deque[Future] = deque()
+        remaining = iter(bounds)
+        for b in itertools.islice(remaining, workers * SHARD_WINDOW):
+            pending.append(pool.submit(price_shard, b))
+        while pending:
+            ids, versions, updated_at, batch = pending.popleft().result()
+            for b in itertools.islice(remaining, 1):
+                pending.append(pool.submit(price_shard, b))
+            yield [{"id": i, "version": v, "updated_at": u} for i, v, u in zip(ids, versions, updated_at)], batch
+
+@app.cli.command("recalc")
+@click.option("--workers", type=int, default=RECALC_WORKERS, show_default=True, help="Procesos de cálculo (1 = sin pool).")
+@click.option("--chunk-size", type=int, default=RECALC_CHUNK_SIZE, show_default=True, help="Productos por rango/transacción.")
+def recalc_command(workers: int, chunk_size: int):
+    """Recalcula todos los precios y registra los cambios en el historial."""
+    t0 = time.perf_counter()
+    done, written = recalc_catalog(workers, chunk_size)
+    print(f"{done} productos recalculados, {written} cambios de precio, {time.perf_counter() - t0:.1f}s.")
+
+# ==============================
+# Historial de precios
+# ==============================
+# price_history guarda solo cambios: una fila nueva únicamente si alguno de los seis precios
+# difiere del último registro del producto. La compactación además reduce lo viejo:
+# todo el detalle por HISTORY_RAW_DAYS, después el último valor de cada día hasta
+# HISTORY_DAILY_DAYS, y de ahí en más el último de cada semana.
+HISTORY_COLUMNS = ("precio_web_ars", "precio_ml1_ars", "precio_ml3_ars", "precio_ml6_ars", "precio_ml9_ars", "precio_ml12_ars")
+HISTORY_RAW_DAYS = int(os.environ.get("HISTORY_RAW_DAYS", "30"))
+HISTORY_DAILY_DAYS = int(os.environ.get("HISTORY_DAILY_DAYS", "365"))
+
+# último registro de cada producto: búsqueda por índice (product_id, created_at) desde el final
+LATEST_HISTORY_SQL = f"""
+    SELECT ids.value AS product_id, {", ".join(f"h.{c}" for c in HISTORY_COLUMNS)}
+    FROM json_each(?) ids
+    JOIN price_history h ON h.id = (
+      SELECT id FROM price_history WHERE product_id = ids.value ORDER BY created_at DESC LIMIT 1
+    )
+"""
+
+def changed_history_rows(products: Sequence[Mapping[str, Any]], batch: PriceBatch, created_at: str) -> List[Tuple[Any, ...]]:
+    """Filas para INSERT_HISTORY_SQL, solo de los productos cuyos precios cambiaron
+    respecto de su último registro."""
+    ids = [p["id"] for p in products]
+    latest = {r[0]: tuple(r[1:]) for r in get_write_db().execute(LATEST_HISTORY_SQL, (json.dumps(ids),))}
+    prices = np.column_stack([getattr(batch, f) for f in PRICE_FIELDS]).tolist()
+    return [(pid, *row, created_at) for pid, row in zip(ids, prices) if latest.get(pid) != tuple(row)]
+
+def compact_price_history(now: Optional[datetime] = None) -> int:
+    """Aplica la política de retención y borra repeticiones consecutivas. Devuelve las filas borradas."""
+    now = now or datetime.now()
+    raw_cutoff = (now - timedelta(days=HISTORY_RAW_DAYS)).isoformat(timespec="seconds")
+    daily_cutoff = (now - timedelta(days=HISTORY_DAILY_DAYS)).isoformat(timespec="seconds")
+    keep_last = """
+        DELETE FROM price_history WHERE id IN (
+          SELECT id FROM (
+            SELECT id, row_number() OVER (PARTITION BY product_id, {bucket} ORDER BY created_at DESC, id DESC) AS rn
+            FROM price_history WHERE {where}
+          ) WHERE rn > 1
+        )
+    """
+    same_as_previous = " AND ".join(f"{c} IS lag({c}) OVER w" for c in HISTORY_COLUMNS)
+    db = get_write_db()
+    with db:
+        deleted = db.execute(
+            keep_last.format(bucket="date(created_at)", where="created_at < ? AND created_at >= ?"),
+            (raw_cutoff, daily_cutoff),
+        ).rowcount
+        deleted += db.execute(
+            keep_last.format(bucket="strftime('%Y-%W', created_at)", where="created_at < ?"),
+            (daily_cutoff,),
+        ).rowcount
+        deleted += db.execute(f"""
+            DELETE FROM price_history WHERE id IN (
+              SELECT id FROM (
+                SELECT id, {same_as_previous} AS same
+                FROM price_history
+                WINDOW w AS (PARTITION BY product_id ORDER BY created_at, id)
+              ) WHERE same
+            )
+        """).rowcount
+    return deleted
+
+# ---------- consultas de series ----------
+HISTORY_CHANNELS = dict(zip(CHANNELS, HISTORY_COLUMNS))
+HISTORY_AGGREGATIONS = ("raw", "daily", "range", "change")
+
+def parse_history_range(start: Optional[str], end: Optional[str]) -> Tuple[str, str]:
+    """Normaliza [desde, hasta] al formato de created_at. Una fecha sola en `hasta` incluye todo el día."""
+    start_s = datetime.fromisoformat(start).isoformat(timespec="seconds") if start else "0000-01-01T00:00:00"
+    if not end:
+        end_s = "9999-12-31T23:59:59"
+    elif len(end.strip()) == 10:
+        end_s = end.strip() + "T23:59:59"
+    else:
+        end_s = datetime.fromisoformat(end).isoformat(timespec="seconds")
+    return start_s, end_s
+
+def as_of_sql(column: str, product: str) -> str:
+    """Subconsulta: valor vigente al inicio (último <= :start, o el primero del rango) y al final del rango."""
+    return f"""
+        coalesce(
+          (SELECT {column} FROM price_history WHERE product_id = {product} AND created_at <= :start ORDER BY created_at DESC LIMIT 1),
+          (SELECT {column} FROM price_history WHERE product_id = {product} AND created_at BETWEEN :start AND :end ORDER BY created_at LIMIT 1)
+        ) AS first_value,
+        (SELECT {column} FROM price_history WHERE product_id = {product} AND created_at <= :end ORDER BY created_at DESC LIMIT 1) AS last_value
+    """
+
+def price_series(
+    start: str, end: str, product_id: Optional[int] = None, brand: Optional[str] = None,
+    agg: str = "raw", channel: str = "web",
+) -> List[Dict[str, Any]]:
+    """Serie de precios de un producto o de una marca entre start y end, agregada en SQL.
+
+    raw: cada registro; daily: último valor de cada día; range: mín/máx/cantidad del canal;
+    change: valor al inicio y al final del período y variación %."""
+    column = HISTORY_CHANNELS[channel]
+    if product_id is not None:
+        targets, params = "SELECT :product_id AS id", {"product_id": product_id}
+    else:
+        targets, params = "SELECT id FROM products WHERE brand = :brand", {"brand": brand}
+    params.update(start=start, end=end)
+    columns = ", ".join(HISTORY_COLUMNS)
+    in_range = f"product_id IN ({targets}) AND created_at BETWEEN :start AND :end"
+
+    if agg == "raw":
+        sql = f"SELECT product_id, created_at, {columns} FROM price_history WHERE {in_range} ORDER BY product_id, created_at"
+    elif agg == "daily":
+        sql = f"""
+            SELECT product_id, day, created_at, {columns} FROM (
+              SELECT product_id, date(created_at) AS day, created_at, {columns},
+                     row_number() OVER (PARTITION BY product_id, date(created_at) ORDER BY created_at DESC) AS rn
+              FROM price_history WHERE {in_range}
+            ) WHERE rn = 1 ORDER BY product_id, day
+        """
+    elif agg == "range":
+        sql = f"""
+            SELECT product_id, min({column}) AS min_value, max({column}) AS max_value, count(*) AS points,
+                   min(created_at) AS first_at, max(created_at) AS last_at
+            FROM price_history WHERE {in_range} GROUP BY product_id ORDER BY product_id
+        """
+    else:
+        sql = f"""
+            SELECT product_id, first_value, last_value,
+                   CASE WHEN first_value > 0 THEN round((last_value - first_value) * 100.0 / first_value, 4) END AS pct_change
+            FROM (SELECT t.id AS product_id, {as_of_sql(column, "t.id")} FROM ({targets}) AS t)
+            WHERE first_value IS NOT NULL ORDER BY product_id
+        """
+    return [dict(r) for r in get_db().execute(sql, params)]
+
+def top_movers(start: str, end: str, channel: str = "web", limit: int = 50) -> List[Dict[str, Any]]:
+    """Productos con mayor variación % (en valor absoluto) entre start y end, en una sola consulta:
+    dos búsquedas por índice por producto, sin leer el historial completo."""
+    column = HISTORY_CHANNELS[channel]
+    sql = f"""
+        SELECT id AS product_id, brand, name, sku, first_value, last_value,
+               round((last_value - first_value) * 100.0 / first_value, 4) AS pct_change
+        FROM (SELECT p.id, p.brand, p.name, p.sku, {as_of_sql(column, "p.id")} FROM products p)
+        WHERE first_value > 0 AND last_value IS NOT NULL AND last_value != first_value
+        ORDER BY abs(last_value - first_value) * 1.0 / first_value DESC
+        LIMIT :limit
+    """
+    return [dict(r) for r in get_db().execute(sql, {"start": start, "end": end, "limit": limit})]
+
+@app.cli.command("price-history")
+@click.option("--product-id", type=int)
+@click.option("--brand")
+@click.option("--from", "start")
+@click.option("--to", "end")
+@click.option("--agg", type=click.Choice(HISTORY_AGGREGATIONS), default="raw", show_default=True)
+@click.option("--channel", type=click.Choice(sorted(HISTORY_CHANNELS)), default="web", show_default=True)
+@click.option("--movers", is_flag=True, help="Top de variaciones de todo el catálogo entre --from y --to.")
+@click.option("--limit", default=50, show_default=True)
+def price_history_command(product_id, brand, start, end, agg, channel, movers, limit):
+    """Consulta el historial de precios (una fila JSON por línea)."""
+    start, end = parse_history_range(start, end)
+    if movers:
+        rows = top_movers(start, end, channel, limit)
+    elif product_id is None and not brand:
+        raise click.UsageError("Indicá --product-id, --brand o --movers.")
+    else:
+        rows = price_series(start, end, product_id, brand, agg, channel)
+    for row in rows:
+        print(json.dumps(row, ensure_ascii=False))
+
+def compact_job(job_id: int) -> int:
+    return compact_price_history()
+
+@app.cli.command("compact-history")
+def compact_history_command():
+    """Compacta price_history según la política de retención."""
+    print(f"Filas borradas: {compact_price_history()}")
+
+# ==============================
+# Escenarios (what-if)
+# ==============================
+# Evalúa el catálogo completo contra una grilla de valores de dólar / coeficientes ML /
+# margen sin tocar la tabla variables. Cada bloque de productos se calcula para todos los
+# escenarios a la vez: las variables van como arrays (S, 1) y numpy hace el broadcasting
+# contra las columnas (N,) de los productos.
+SCENARIO_AXES = ("dolar", "coef_ml_1", "coef_ml_3", "coef_ml_6", "coef_ml_9", "coef_ml_12", "margen")
+SCENARIO_CHANNELS = CHANNEL_FIELDS
+MAX_SCENARIOS = 500
+# escenarios x productos por request: el tiempo de CPU crece con eso (~0.45 s por millón)
+MAX_SCENARIO_CELLS = int(os.environ.get("MAX_SCENARIO_CELLS", "10000000"))
+# memoria para los arrays (S, bloque) de un bloque; el bloque se achica cuando crece S
+SCENARIO_MEMORY_BUDGET = int(os.environ.get("SCENARIO_MEMORY_MB", "64")) * 1024 * 1024
+SCENARIO_LIVE_ARRAYS = 24  # arrays (S, bloque) float64 vivos a la vez en price_scenarios y el redondeo
+LOW_MARGIN = 0.05
+
+def scenario_chunk_size(n_scenarios: int) -> int:
+    """Productos por bloque para que los intermedios de S escenarios entren en SCENARIO_MEMORY_BUDGET."""
+    return max(1, SCENARIO_MEMORY_BUDGET // (max(n_scenarios, 1) * 8 * SCENARIO_LIVE_ARRAYS))
+
+def scenario_values(spec: Any) -> List[float]:
+    """Un eje de la grilla: número, lista o rango {"from", "to", "step"} (extremos incluidos)."""
+    if isinstance(spec, dict):
+        start, stop, step = float(spec["from"]), float(spec["to"]), float(spec["step"])
+        if step <= 0:
+            raise ValueError("step debe ser positivo")
+        return [round(start + i * step, 10) for i in range(int(math.floor((stop - start) / step + 1e-9)) + 1)]
+    if isinstance(spec, list):
+        return [float(v) for v in spec]
+    return [float(spec)]
+
+def scenario_grid(spec: Mapping[str, Any], vars_map: Dict[str, float]) -> List[Dict[str, Optional[float]]]:
+    """Producto cartesiano de los ejes pedidos; los que no vienen quedan en el valor actual
+    (margen: el de cada producto)."""
+    axes = []
+    for key in SCENARIO_AXES:
+        if spec.get(key) is not None:
+            axes.append(scenario_values(spec[key]))
+        else:
+            axes.append([None] if key == "margen" else [vars_map.get(key, 1.0)])
+    n = math.prod(len(a) for a in axes)
+    if n > MAX_SCENARIOS:
+        raise ValueError(f"La grilla tiene {n} escenarios (máximo {MAX_SCENARIOS}).")
+    return [dict(zip(SCENARIO_AXES, combo)) for combo in itertools.product(*axes)]
+
+def price_scenarios(vars_map: Dict[str, float], cols: Dict[str, np.ndarray], scenarios: Sequence[Mapping[str, Optional[float]]]) -> PriceBatch:
+    """Precios de N productos en S escenarios: arrays (S, N) (o (N,) si no dependen del escenario)."""
+    column = lambda key: np.array([sc[key] for sc in scenarios], dtype=np.float64)[:, np.newaxis]
+    grid_vars = dict(vars_map)
+    for key in SCENARIO_AXES[:-1]:
+        grid_vars[key] = column(key)
+    margins = np.array([np.nan if sc["margen"] is None else sc["margen"] for sc in scenarios])[:, np.newaxis]
+    cols = dict(cols, margen_neto=np.where(np.isnan(margins), cols["margen_neto"], margins))
+    return calculate_prices_arrays(grid_vars, cols)
+
+def run_scenarios(
+    spec: Mapping[str, Any], channel: str = "web", drill: Optional[int] = None, drill_limit: int = 100,
+) -> Dict[str, Any]:
+    """Agregados por escenario: margen promedio, SKUs con margen < LOW_MARGIN y variación de
+    precio ponderada por el precio actual del canal (sum(nuevo - actual) / sum(actual))."""
+    vars_map = get_variables()
+    scenarios = scenario_grid(spec, vars_map)
+    price_field = SCENARIO_CHANNELS[channel]
+    products = get_db().execute(
+        f"SELECT id, brand, name, sku, {', '.join(PRICE_INPUT_COLUMNS)}, precio_manual_ars FROM products ORDER BY id"
+    ).fetchall()
+    n_products, n_scenarios = len(products), len(scenarios)
+    if n_products * n_scenarios > MAX_SCENARIO_CELLS:
+        raise ValueError(
+            f"{n_scenarios} escenarios x {n_products} productos es demasiado para una consulta "
+            f"(máximo {MAX_SCENARIO_CELLS // max(n_products, 1)} escenarios con este catálogo)."
+        )
+    chunk_size = scenario_chunk_size(n_scenarios)
+    margin_sum = np.zeros(n_scenarios)
+    low_margin = np.zeros(n_scenarios, dtype=np.int64)
+    new_total = np.zeros(n_scenarios)
+    base_total = 0.0
+    for start in range(0, n_products, chunk_size):
+        cols = product_arrays(products[start:start + chunk_size])
+        base = getattr(calculate_prices_arrays(vars_map, cols), price_field)
+        grid = price_scenarios(vars_map, cols, scenarios)
+        margins = np.broadcast_to(grid.margen_neto, (n_scenarios, len(base)))
+        margin_sum += np.nansum(margins, axis=1)
+        low_margin += (margins < LOW_MARGIN).sum(axis=1)
+        new_total += np.broadcast_to(getattr(grid, price_field), margins.shape).sum(axis=1)
+        base_total += float(base.sum())
+
+    result: Dict[str, Any] = {
+        "products": n_products,
+        "channel": channel,
+        "scenarios": [
+            {
+                "index": i,
+                **sc,
+                "avg_margin": float(margin_sum[i] / n_products) if n_products else None,
+                "skus_low_margin": int(low_margin[i]),
+                "price_change_pct": float((new_total[i] - base_total) * 100 / base_total) if base_total else None,
+            }
+            for i, sc in enumerate(scenarios)
+        ],
+    }
+    if drill is not None:
+        if not 0 <= drill < n_scenarios:
+            raise ValueError(f"drill fuera de rango (0..{n_scenarios - 1}).")
+        cols = product_arrays(products)
+        base = getattr(calculate_prices_arrays(vars_map, cols), price_field)
+        grid = price_scenarios(vars_map, cols, [scenarios[drill]])
+        margins = np.broadcast_to(grid.margen_neto, (1, n_products))[0]
+        prices = np.broadcast_to(getattr(grid, price_field), (1, n_products))[0]
+        # primero los de menor margen: son los que hay que mirar
+        order = np.argsort(margins, kind="stable")[:drill_limit]
+        result["drill"] = {
+            "index": drill,
+            "rows": [
+                {
+                    "id": products[i]["id"], "brand": products[i]["brand"], "name": products[i]["name"],
+                    "sku": products[i]["sku"], "price_now": float(base[i]), "price_scenario": float(prices[i]),
+                    "margin": float(margins[i]),
+                }
+                for i in order.tolist()
+            ],
+        }
+    return result
+
+# ==============================
+# Precio objetivo (cálculo inverso)
+# ==============================
+# Dado un precio objetivo por SKU y canal (p. ej. la lista de un competidor) despeja, para
+# todos a la vez, el margen que lo alcanza y el FOB máximo que lo permite con el margen del
+# producto. Se invierte la fórmula de calculate_prices: primero el redondeo (el objetivo
+# baja a la terminación válida más cercana por debajo y de ahí se saca el rango de valores
+# crudos que redondean a ese precio), después envío, coeficiente del canal, IVA y dólar.
+# El precio manual de un producto no se usa: se responde qué margen haría falta sin él.
+MAX_TARGETS = 100000
+# los márgenes despejados caen justo en el corte del redondeo: un centavo hacia adentro evita
+# que el error de punto flotante del cálculo directo los pase al precio de al lado
+TARGET_SLACK_ARS = 0.01
+
+def price_floor(targets: np.ndarray, endings: Tuple[int, ...]) -> np.ndarray:
+    """El mayor precio alcanzable (terminado en endings) que no supera cada objetivo."""
+    ends = np.array(endings, dtype=np.float64)
+    base = np.floor(targets / 1000) * 1000
+    pos = np.searchsorted(ends, targets - base, side="right") - 1
+    return np.where(pos >= 0, base + ends[np.maximum(pos, 0)], base - 1000 + ends[-1])
+
+def rounding_ceiling(prices: np.ndarray, endings: Tuple[int, ...]) -> np.ndarray:
+    """Para precios ya terminados en endings: el mayor valor crudo que redondear_array lleva a
+    un precio <= ese. Es el punto medio hasta la terminación siguiente (los empates van a la
+    menor), salvo que caiga en el mil siguiente: ahí el corte es el cambio de mil."""
+    ends = np.array(endings, dtype=np.float64)
+    base = np.floor(prices / 1000) * 1000
+    pos = np.searchsorted(ends, prices - base)
+    last = pos >= len(ends) - 1
+    upper = base + np.where(last, 1000 + ends[0], ends[np.minimum(pos + 1, len(ends) - 1)])
+    middle = (prices + upper) / 2
+    return np.where(last & (middle >= base + 1000), np.nextafter(base + 1000, -np.inf), middle)
+
+def solve_target_prices(
+    vars_map: Dict[str, float], cols: Dict[str, np.ndarray], targets: np.ndarray, channel: str, min_margin: float = 0.0,
+) -> Dict[str, np.ndarray]:
+    """Cálculo inverso de N productos contra N objetivos de un mismo canal (arrays (N,))."""
+    endings = channel_endings(channel, vars_map)
+    coef = CHANNEL_COEFS[channel]
+    current = calculate_prices_arrays(vars_map, cols)
+    reachable = price_floor(targets, endings)
+    # precio = redondeo(pv_neto_usd * dolar * (1 + iva) * coef + envio)
+    factor = vars_map.get("dolar", 1.0) * (1 + cols["iva"]) * (1.0 if coef is None else vars_map.get(coef, 1.0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pv_max = (rounding_ceiling(reachable, endings) - TARGET_SLACK_ARS - cols["envio_ars"]) / factor
+        # el precio anterior alcanzable marca desde dónde se llega justo al objetivo
+        previous = rounding_ceiling(price_floor(reachable - 1, endings), endings)
+        pv_min = (previous + TARGET_SLACK_ARS - cols["envio_ars"]) / factor
+        margin_max = pv_max / current.costo_final_usd - 1
+        margin_min = pv_min / current.costo_final_usd - 1
+        overhead = 1 + cols["arancel"] + cols["aduana"] + cols["despachante"] + cols["banco"]
+        cif_max = pv_max / (1 + cols["margen_neto"]) / overhead
+        fob_max = (cif_max - cols["costo_flete_usd_kg"] * cols["peso_kg"]) / (1 + cols["costo_financiero"])
+    feasible = pv_max > 0
+    return {
+        "target_ars": np.where(reachable > 0, reachable, np.nan),
+        "exact": reachable == targets,
+        "price_now": getattr(current, CHANNEL_FIELDS[channel]),
+        "margin_now": current.margen_neto,
+        "margin_min": np.where(feasible, margin_min, np.nan),
+        "margin_max": np.where(feasible, margin_max, np.nan),
+        "fob_now": cols["fob_usd"],
+        "fob_max": np.where(feasible, fob_max, np.nan),
+        "feasible": feasible,
+        "margin_ok": feasible & (margin_max >= min_margin),
+        "fob_ok": feasible & (fob_max >= cols["fob_usd"]),
+        "manual": cols["precio_manual_ars"] != 0,
+    }
+
+def parse_targets(items: Any, channel: str = "web") -> List[Tuple[str, str, float]]:
+    """Objetivos como (sku, canal, precio). Acepta {"SKU": precio} (todos en `channel`) o una
+    lista de {"sku", "target", "channel"?}."""
+    if isinstance(items, Mapping):
+        items = [{"sku": sku, "target": target} for sku, target in items.items()]
+    out = []
+    for item in items:
+        ch = item.get("channel") or channel
+        if ch not in CHANNEL_FIELDS:
+            raise ValueError(f"canal desconocido {ch!r} (opciones: {', '.join(CHANNELS)})")
+        target = item["target"]
+        out.append((str(item["sku"]).strip(), ch, float(target.replace(",", ".") if isinstance(target, str) else target)))
+    if len(out) > MAX_TARGETS:
+        raise ValueError(f"Demasiados objetivos: {len(out)} (máximo {MAX_TARGETS}).")
+    return out
+
+def reverse_pricing(targets: Sequence[Tuple[str, str, float]], min_margin: float = 0.0) -> List[Dict[str, Any]]:
+    """Resultado por objetivo, en el orden recibido. Los SKU inexistentes vuelven con found=False."""
+    vars_map = get_variables()
+    skus = json.dumps(sorted({sku for sku, _, _ in targets}))
+    products = {
+        p["sku"]: p for p in get_db().execute(
+            f"SELECT sku, {', '.join(PRICE_INPUT_COLUMNS)}, precio_manual_ars FROM products "
+            "WHERE sku IN (SELECT value FROM json_each(?))",
+            (skus,),
+        )
+    }
+    out: List[Dict[str, Any]] = [
+        {"sku": sku, "channel": ch, "target": target, "found": sku in products} for sku, ch, target in targets
+    ]
+    for channel in CHANNELS:
+        idx = [i for i, (sku, ch, _) in enumerate(targets) if ch == channel and sku in products]
+        if not idx:
+            continue
+        cols = product_arrays([products[targets[i][0]] for i in idx])
+        solved = solve_target_prices(vars_map, cols, np.array([targets[i][2] for i in idx]), channel, min_margin)
+        columns = {k: v.tolist() for k, v in solved.items()}
+        for j, i in enumerate(idx):
+            # NaN (objetivo inalcanzable) sale como null en el JSON
+            out[i].update((k, None if isinstance(v[j], float) and math.isnan(v[j]) else v[j]) for k, v in columns.items())
+    return out
+
+REVERSE_COLUMNS = (
+    "sku", "channel", "target", "found", "target_ars", "exact", "price_now", "margin_now", "margin_min", "margin_max",
+    "fob_now", "fob_max", "feasible", "margin_ok", "fob_ok", "manual",
 )
-    return page(body, title="Productos | " + APP_TITLE)
 
-@app.route("/about")
-def about():
-    init_db()
+@app.cli.command("reverse-price")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--channel", type=click.Choice(CHANNELS), default="web", show_default=True, help="Canal de las filas sin columna channel.")
+@click.option("--min-margin", type=float, default=0.0, show_default=True, help="Margen mínimo aceptable (margin_ok).")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="CSV de salida (por defecto stdout).")
+def reverse_price_command(path: str, channel: str, min_margin: float, output: Optional[str]):
+    """Margen y FOB máximo para los precios objetivo de PATH (CSV o XLSX con sku, target y opcional channel)."""
+    with open(path, "rb") as fh:
+        _, sheet = read_sheet(fh, path)
+        targets = parse_targets((row for _, row in sheet), channel)
+    rows = reverse_pricing(targets, min_margin)
+    out = open(output, "w", newline="", encoding="utf-8") if output else click.get_text_stream("stdout")
+    try:
+        writer = csv.DictWriter(out, fieldnames=REVERSE_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+    finally:
+        if output:
+            out.close()
+    found = [r for r in rows if r["found"]]
+    click.echo(
+        f"{len(rows)} objetivos, {len(found)} SKU encontrados, {sum(1 for r in found if r['margin_ok'])} con margen "
+        f">= {min_margin:g}, {sum(1 for r in found if r['fob_ok'])} con el FOB actual dentro del máximo.",
+        err=True,
+    )
+
+# ==============================
+# Importación masiva
+# ==============================
+IMPORT_CHUNK_SIZE = 1000  # filas por transacción
+
+@dataclass
+class ImportReport:
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    errors: List[Tuple[int, str]] = field(default_factory=list)
+
+SheetRows = Iterator[Tuple[int, Dict[str, Any]]]
+
+def read_sheet(fileobj, filename: str) -> Tuple[List[str], SheetRows]:
+    """Abre un CSV o XLSX para recorrerlo fila por fila sin cargarlo entero. Devuelve el
+    encabezado (en minúscula) y un iterador de (nro de línea, fila) con esas claves."""
+    if filename.lower().endswith(".xlsx"):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ValueError("Para importar XLSX hace falta instalar openpyxl.")
+        wb = load_workbook(fileobj, read_only=True, data_only=True)
+        sheet = wb.active.iter_rows(values_only=True)
+        header = [str(h or "").strip().lower() for h in next(sheet, ())]
+
+        def xlsx_rows() -> SheetRows:
+            try:
+                for line, values in enumerate(sheet, start=2):
+                    if any(v not in (None, "") for v in values):
+                        yield line, dict(zip(header, values))
+            finally:
+                wb.close()
+        return header, xlsx_rows()
+
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    first = text.readline()
+    # planillas exportadas en es-AR suelen venir con ; (la coma es el separador decimal)
+    delimiter = ";" if first.count(";") > first.count(",") else ","
+    reader = csv.reader(itertools.chain([first], text), delimiter=delimiter)
+    header = [h.strip().lower() for h in next(reader, [])]
+
+    def csv_rows() -> SheetRows:
+        for line, values in enumerate(reader, start=2):
+            if any(v.strip() for v in values):
+                yield line, dict(zip(header, values))
+    return header, csv_rows()
+
+def import_products(header: Sequence[str], rows: SheetRows, chunk_size: int = IMPORT_CHUNK_SIZE) -> ImportReport:
+    """Upsert por SKU de las filas de una planilla, de a chunk_size filas por transacción.
+
+    Solo se escriben las columnas que trae el encabezado (brand, name y sku son obligatorias)
+    y updated_at cambia únicamente en los productos cuyos valores cambiaron. Las filas con
+    errores se informan y se saltean sin cortar la importación."""
+    db = get_write_db()
+    report = ImportReport()
+    keys = [k for k in PRODUCT_FIELDS if k in header]
+    missing = [k for k in TEXT_FIELDS if k not in keys]
+    if missing:
+        raise ValueError(f"Faltan columnas obligatorias: {', '.join(missing)}.")
+    sql = f"""
+        INSERT INTO products ({", ".join(keys)}) VALUES ({", ".join("?" for _ in keys)})
+        ON CONFLICT(sku) DO UPDATE SET {", ".join(f"{k}=excluded.{k}" for k in keys)}, updated_at=datetime('now')
+        WHERE {" OR ".join(f"products.{k} IS NOT excluded.{k}" for k in keys)}
+    """
+
+    def write(chunk: List[Tuple[Any, ...]]):
+        skus = json.dumps([r[keys.index("sku")] for r in chunk])
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            existing = {r[0] for r in db.execute("SELECT sku FROM products WHERE sku IN (SELECT value FROM json_each(?))", (skus,))}
+            changed = db.executemany(sql, chunk).rowcount
+        inserted = len({r[keys.index("sku")] for r in chunk} - existing)
+        report.inserted += inserted
+        report.updated += changed - inserted
+        report.unchanged += len(chunk) - changed
+        ids = [r[0] for r in db.execute("SELECT id FROM products WHERE sku IN (SELECT value FROM json_each(?))", (skus,))]
+        refresh_computed_prices(ids)
+
+    chunk: List[Tuple[Any, ...]] = []
+    for line, raw in rows:
+        data = normalize_product_data(raw, keys)
+        if not (data["brand"] and data["name"] and data["sku"]):
+            report.errors.append((line, "Marca, Producto y SKU son obligatorios."))
+            continue
+        bad = None
+        values: List[Any] = []
+        for k in keys:
+            try:
+                values.append(data[k] if k in TEXT_FIELDS else float(data[k]))
+            except ValueError:
+                bad = k
+                break
+        if bad:
+            report.errors.append((line, f"Valor no numérico en {bad}: {data[bad]!r}."))
+            continue
+        chunk.append(tuple(values))
+        if len(chunk) >= chunk_size:
+            write(chunk)
+            chunk = []
+    if chunk:
+        write(chunk)
+    return report
+
+@app.cli.command("import-products")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--chunk-size", default=IMPORT_CHUNK_SIZE, show_default=True)
+def import_products_command(path: str, chunk_size: int):
+    """Importa productos desde un CSV o XLSX (upsert por SKU)."""
+    with open(path, "rb") as fh:
+        report = import_products(*read_sheet(fh, path), chunk_size=chunk_size)
+    print(f"Nuevos: {report.inserted}  Actualizados: {report.updated}  Sin cambios: {report.unchanged}  Errores: {len(report.errors)}")
+    for line, msg in report.errors:
+        print(f"  línea {line}: {msg}")
+
+# ==============================
+# Edición masiva
+# ==============================
+# Un parámetro numérico de todos los productos que cumplan los filtros (marca, patrón de SKU
+# con * y/o búsqueda), en un solo UPDATE. Antes se muestra el efecto sobre precios y márgenes,
+# calculado con el motor vectorizado sobre todas las filas afectadas.
+BULK_COLUMNS = (
+    "fob_usd", "peso_kg", "costo_flete_usd_kg", "costo_financiero", "arancel", "aduana",
+    "despachante", "banco", "iva", "envio_ars", "margen_neto",
+)
+BULK_OPS = {"set": ":value", "multiply": "{col} * :value"}  # nuevo valor de la columna, en SQL
+BULK_PREVIEW_ROWS = 500  # filas listadas en la vista previa (los totales cubren todas)
+
+@dataclass
+class BulkSelection:
+    brand: str = ""
+    sku: str = ""   # patrón con * como comodín
+    q: str = ""
+
+    def __bool__(self) -> bool:
+        return bool(self.brand or self.sku or self.q)
+
+    def where(self) -> Tuple[str, Dict[str, Any]]:
+        clauses, params = [], {}
+        if self.brand:
+            clauses.append("brand = :brand COLLATE NOCASE")
+            params["brand"] = self.brand
+        if self.sku:
+            escaped = self.sku.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            clauses.append("sku LIKE :sku ESCAPE '\\'")
+            params["sku"] = escaped.replace("*", "%")
+        if self.q:
+            clauses.append("id IN (SELECT value FROM json_each(:ids))")
+            params["ids"] = json.dumps(search_product_ids(self.q))
+        return " AND ".join(clauses) or "1", params
+
+def bulk_new_values(op: str, value: float, current: np.ndarray) -> np.ndarray:
+    return np.full_like(current, value) if op == "set" else current * value
+
+def bulk_preview(selection: BulkSelection, column: str, op: str, value: float) -> Dict[str, Any]:
+    """Precios y márgenes antes/después para todas las filas seleccionadas."""
+    where, params = selection.where()
+    products = get_db().execute(f"SELECT * FROM products WHERE {where} ORDER BY brand, name, id", params).fetchall()
+    if not products:
+        return {"count": 0, "rows": []}
     vars_map = get_variables()
-    body = render_template_string(
-        r"""
+    cols = product_arrays(products)
+    before = calculate_prices_arrays(vars_map, cols)
+    new_cols = dict(cols, **{column: bulk_new_values(op, value, cols[column])})
+    after = calculate_prices_arrays(vars_map, new_cols)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        web_change = np.where(before.precio_web_ars != 0, after.precio_web_ars / before.precio_web_ars - 1, 0.0)
+    rows = [
+        {
+            "product": products[i],
+            "old_value": float(cols[column][i]), "new_value": float(new_cols[column][i]),
+            "old_web": float(before.precio_web_ars[i]), "new_web": float(after.precio_web_ars[i]),
+            "old_margin": float(before.margen_neto[i]), "new_margin": float(after.margen_neto[i]),
+        }
+        for i in range(min(len(products), BULK_PREVIEW_ROWS))
+    ]
+    return {
+        "count": len(products),
+        "changed": int((new_cols[column] != cols[column]).sum()),
+        "avg_margin_before": float(np.nanmean(before.margen_neto)),
+        "avg_margin_after": float(np.nanmean(after.margen_neto)),
+        "low_margin_after": int((after.margen_neto < LOW_MARGIN).sum()),
+        "avg_web_change": float(np.mean(web_change)),
+        "rows": rows,
+    }
+
+def bulk_apply(selection: BulkSelection, column: str, op: str, value: float) -> int:
+    """Aplica el cambio en un único UPDATE (solo toca las filas donde el valor cambia) y
+    recalcula los precios materializados de esas filas. Devuelve las filas modificadas."""
+    if column not in BULK_COLUMNS or op not in BULK_OPS:
+        raise ValueError("Columna u operación no permitida.")
+    if not selection:
+        raise ValueError("Elegí al menos un filtro (marca, SKU o búsqueda).")
+    where, params = selection.where()
+    new_value = BULK_OPS[op].format(col=column)
+    db = get_write_db()
+    with db:
+        ids = [r[0] for r in db.execute(
+            f"UPDATE products SET {column} = {new_value}, updated_at = datetime('now') WHERE ({where}) AND {column} IS NOT {new_value} RETURNING id",
+            dict(params, value=value),
+        ).fetchall()]
+    if ids:
+        refresh_computed_prices(ids)
+    return len(ids)
+
+# ==============================
+# Exportación de precios
+# ==============================
+EXPORT_FIELDS = ("id", "brand", "name", "sku", *CALC_FIELDS, "prices_changed_at")
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+EXPORT_BUFFER = 64 * 1024  # bytes por bloque enviado
+
+def parse_since(value: Optional[str]) -> Optional[str]:
+    """Normaliza un timestamp ISO al formato de datetime('now') de SQLite (UTC). Con zona
+    (Z, +03:00, ...) se pasa a UTC; sin zona se toma como UTC."""
+    if not value:
+        return None
+    value = value.strip()
+    if value[-1:] in ("Z", "z"):
+        value = value[:-1] + "+00:00"
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+def iter_export_rows(since: Optional[str] = None) -> Iterator[sqlite3.Row]:
+    """Precios calculados de todo el catálogo, leídos del cursor de a una fila.
+
+    Con since, solo los productos cuyos precios cambiaron después de ese momento."""
+    refresh_computed_prices()
+    sql = f"""
+        SELECT p.id, p.brand, p.name, p.sku, {", ".join(f"cp.{f}" for f in CALC_FIELDS)}, cp.prices_changed_at
+        FROM computed_prices cp
+        JOIN products p ON p.id = cp.product_id
+    """
+    params: Tuple[Any, ...] = ()
+    if since:
+        sql += " WHERE cp.prices_changed_at > ?"
+        params = (since,)
+    with closing(get_db().execute(sql + " ORDER BY cp.product_id", params)) as cur:
+        yield from cur
+
+def csv_chunks(rows: Iterator[sqlite3.Row]) -> Iterator[str]:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        writer.writerow(tuple(row))
+        if buf.tell() >= EXPORT_BUFFER:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def ndjson_chunks(rows: Iterator[sqlite3.Row]) -> Iterator[str]:
+    lines: List[str] = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + "\n"
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_BUFFER:
+            yield "".join(lines)
+            lines, size = [], 0
+    yield "".join(lines)
+
+def gzip_chunks(chunks: Iterator[str]) -> Iterator[bytes]:
+    """Comprime sobre la marcha (formato gzip) sin juntar la salida completa."""
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = z.compress(chunk.encode())
+        if out:
+            yield out
+    yield z.flush()
+
+def export_chunks(fmt: str, since: Optional[str] = None) -> Iterator[str]:
+    rows = iter_export_rows(since)
+    return csv_chunks(rows) if fmt == "csv" else ndjson_chunks(rows)
+
+@app.cli.command("export-prices")
+@click.option("--format", "fmt", type=click.Choice(sorted(EXPORT_FORMATS)), default="csv", show_default=True)
+@click.option("--since", help="Solo productos con precios cambiados después de este momento (ISO, UTC).")
+@click.option("--gzip", "use_gzip", is_flag=True, help="Comprimir la salida con gzip.")
+@click.option("-o", "--output", type=click.Path(dir_okay=False), help="Archivo de salida (por defecto stdout).")
+def export_prices_command(fmt: str, since: Optional[str], use_gzip: bool, output: Optional[str]):
+    """Exporta los precios calculados en CSV o NDJSON."""
+    chunks = export_chunks(fmt, parse_since(since))
+    out = open(output, "wb") if output else click.get_binary_stream("stdout")
+    try:
+        for chunk in (gzip_chunks(chunks) if use_gzip else (c.encode() for c in chunks)):
+            out.write(chunk)
+    finally:
+        if output:
+            out.close()
+
+# ==============================
+# Feed de cotización (dólar)
+# ==============================
+# Un proceso aparte (flask fx-ingest) consume ticks de cotización y publica el dólar. Los
+# movimientos menores a FX_THRESHOLD_PCT respecto del dólar publicado se ignoran; el primero
+# que lo supera abre una ventana de FX_DEBOUNCE_SECONDS y al cerrarla se aplica el último valor
+# recibido con un solo save_variables (que recalcula los precios una vez). Los contadores van a
+# fx_feed y cada cambio aplicado a fx_updates, de donde los lee /fx/stats.
+FX_THRESHOLD_PCT = float(os.environ.get("FX_THRESHOLD_PCT", "0.5"))
+FX_DEBOUNCE_SECONDS = float(os.environ.get("FX_DEBOUNCE_SECONDS", "2"))
+FX_STATS_INTERVAL = 5.0  # segundos entre escrituras de contadores sin cambios aplicados
+
+@dataclass
+class FxTick:
+    rate: float
+    at: float  # time.time() al recibirlo
+
+def parse_fx_tick(line: str) -> Optional[float]:
+    """Acepta "1495.5" (o "1495,5"), "2026-10-17T10:00:00,1495.5" (el último campo) o {"rate": 1495.5}."""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        if line.startswith("{"):
+            return float(json.loads(line)["rate"])
+        try:
+            return float(line.replace(",", "."))  # un solo valor, quizás con coma decimal
+        except ValueError:
+            return float(re.split(r"[,;\s]+", line)[-1])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+async def file_ticks(path: str, follow: bool = True, poll: float = 0.2) -> AsyncIterator[FxTick]:
+    """Ticks de un archivo de texto, una cotización por línea; con follow sigue leyendo lo
+    que se agregue (como tail -f)."""
+    with open(path, encoding="utf-8") as fh:
+        while True:
+            line = fh.readline()
+            if not line:
+                if not follow:
+                    return
+                await asyncio.sleep(poll)
+                continue
+            rate = parse_fx_tick(line)
+            if rate is not None and rate > 0:
+                yield FxTick(rate, time.time())
+
+async def tcp_ticks(host: str, port: int) -> AsyncIterator[FxTick]:
+    """Ticks de un socket TCP, una cotización por línea; termina cuando el otro lado cierra."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while line := await reader.readline():
+            rate = parse_fx_tick(line.decode("utf-8", "replace"))
+            if rate is not None and rate > 0:
+                yield FxTick(rate, time.time())
+    finally:
+        writer.close()
+
+def fx_source(spec: str, follow: bool = True) -> AsyncIterator[FxTick]:
+    """"tcp://host:puerto" o una ruta de archivo (con o sin "file:" adelante)."""
+    if spec.startswith("tcp://"):
+        host, _, port = spec[len("tcp://"):].rpartition(":")
+        return tcp_ticks(host or "127.0.0.1", int(port))
+    return file_ticks(spec[len("file:"):] if spec.startswith("file:") else spec, follow)
+
+class FxIngester:
+    def __init__(self, source: str, threshold_pct: float = FX_THRESHOLD_PCT, debounce: float = FX_DEBOUNCE_SECONDS):
+        self.source = source
+        self.threshold = threshold_pct / 100
+        self.debounce = debounce
+        self.ticks = self.ignored = self.applied = 0
+        self.latest: Optional[FxTick] = None
+        self.window_first: Optional[FxTick] = None
+        self.window_ticks = 0
+        self.publish_lock = asyncio.Lock()
+        with app.app_context():
+            self.published = get_variables().get("dolar", 0.0)
+            db = get_write_db()
+            now = now_iso()
+            db.execute(
+                "INSERT INTO fx_feed(source, started_at, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(source) DO UPDATE SET started_at=excluded.started_at, updated_at=excluded.updated_at, "
+                "ticks=0, ignored=0, applied=0",
+                (source, now, now),
+            )
+            db.commit()
+
+    def moves(self, rate: float) -> bool:
+        return not self.published or abs(rate / self.published - 1) >= self.threshold
+
+    async def run(self, ticks: AsyncIterator[FxTick]):
+        # solo las ventanas abiertas: cada tarea sale del set al terminar
+        pending: Set[asyncio.Task] = set()
+        stats_task = asyncio.create_task(self.write_stats_periodically())
+        try:
+            async for tick in ticks:
+                self.ticks += 1
+                self.latest = tick
+                if self.window_first is None:
+                    if not self.moves(tick.rate):
+                        self.ignored += 1
+                        continue
+                    self.window_first, self.window_ticks = tick, 0
+                    task = asyncio.create_task(self.close_window())
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    task.add_done_callback(self.log_window_error)
+                self.window_ticks += 1
+            # los errores ya los registra log_window_error; el feed sigue con la próxima ventana
+            await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            stats_task.cancel()
+            await asyncio.to_thread(self.write_stats)
+
+    def log_window_error(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            app.logger.error("fx %s: no se pudo publicar el dólar", self.source, exc_info=task.exception())
+
+    async def close_window(self):
+        await asyncio.sleep(self.debounce)
+        first, tick, n = self.window_first, self.latest, self.window_ticks
+        self.window_first = None
+        async with self.publish_lock:
+            if self.moves(tick.rate):
+                await asyncio.to_thread(self.publish, tick.rate, first, n)
+            else:
+                # la ráfaga volvió adentro del umbral antes de cerrar la ventana
+                self.ignored += n
+
+    def publish(self, rate: float, first: FxTick, ticks: int):
+        with app.app_context():
+            t0 = time.perf_counter()
+            save_variables({"dolar": rate})
+            reprice_ms = (time.perf_counter() - t0) * 1000
+            applied_at = time.time()
+            get_write_db().execute(
+                "INSERT INTO fx_updates(source, previous, rate, ticks, first_tick_at, applied_at, lag_ms, reprice_ms) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.source, self.published, rate, ticks,
+                    datetime.fromtimestamp(first.at).isoformat(timespec="milliseconds"),
+                    datetime.fromtimestamp(applied_at).isoformat(timespec="milliseconds"),
+                    (applied_at - first.at) * 1000, reprice_ms,
+                ),
+            )
+            self.published = rate
+            self.applied += 1
+            self.write_stats()
+
+    def write_stats(self):
+        with app.app_context():
+            db = get_write_db()
+            db.execute(
+                "UPDATE fx_feed SET ticks=?, ignored=?, applied=?, updated_at=? WHERE source=?",
+                (self.ticks, self.ignored, self.applied, now_iso(), self.source),
+            )
+            db.commit()
+
+    async def write_stats_periodically(self):
+        while True:
+            await asyncio.sleep(FX_STATS_INTERVAL)
+            await asyncio.to_thread(self.write_stats)
+
+def fx_stats(recent: int = 20) -> List[Dict[str, Any]]:
+    """Por fuente: ticks por segundo, ticks por cambio aplicado (coalescing) y demora de tick a
+    precios publicados de los últimos cambios."""
+    db = get_db()
+    out = []
+    for feed in db.execute("SELECT * FROM fx_feed ORDER BY source").fetchall():
+        updates = db.execute(
+            "SELECT previous, rate, ticks, first_tick_at, applied_at, lag_ms, reprice_ms FROM fx_updates "
+            "WHERE source=? ORDER BY id DESC LIMIT ?",
+            (feed["source"], recent),
+        ).fetchall()
+        elapsed = (datetime.fromisoformat(feed["updated_at"]) - datetime.fromisoformat(feed["started_at"])).total_seconds()
+        lags = [u["lag_ms"] for u in updates]
+        out.append({
+            "source": feed["source"],
+            "started_at": feed["started_at"],
+            "updated_at": feed["updated_at"],
+            "ticks": feed["ticks"],
+            "ignored": feed["ignored"],
+            "applied": feed["applied"],
+            "tick_rate_per_s": round(feed["ticks"] / elapsed, 3) if elapsed > 0 else None,
+            "coalescing_ratio": round((feed["ticks"] - feed["ignored"]) / feed["applied"], 2) if feed["applied"] else None,
+            "lag_ms_p50": float(np.percentile(lags, 50)) if lags else None,
+            "lag_ms_max": max(lags) if lags else None,
+            "recent": [dict(u) for u in updates],
+        })
+    return out
+
+@app.cli.command("fx-ingest")
+@click.argument("source")
+@click.option("--threshold", type=float, default=FX_THRESHOLD_PCT, show_default=True, help="Movimiento mínimo (%) para publicar.")
+@click.option("--debounce", type=float, default=FX_DEBOUNCE_SECONDS, show_default=True, help="Segundos que se agrupan en un cambio.")
+@click.option("--no-follow", is_flag=True, help="Con un archivo: procesar lo que hay y terminar.")
+def fx_ingest_command(source: str, threshold: float, debounce: float, no_follow: bool):
+    """Consume cotizaciones de SOURCE (archivo o tcp://host:puerto) y publica el dólar."""
+    ingester = FxIngester(source, threshold, debounce)
+    try:
+        asyncio.run(ingester.run(fx_source(source, follow=not no_follow)))
+    except KeyboardInterrupt:
+        pass
+    print(f"{ingester.ticks} ticks, {ingester.ignored} ignorados, {ingester.applied} cambios aplicados.")
+
+# ==============================
+# Routes
+# ==============================
+TEMPLATES["home.html"] = r"""
+{% extends "base.html" %}
+{% block content %}
+<div class="flex items-center justify-between mb-4">
+  <form method="get">
+    <input name="q" value="{{ q }}" placeholder="Buscar por marca, modelo o SKU" class="border p-2 rounded w-72" />
+  </form>
+  <div class="flex gap-2">
+    <a href="{{ url_for('recalc_all') }}" class="px-3 py-2 bg-emerald-700 text-white rounded">Recalcular todo</a>
+    <a href="{{ url_for('import_view') }}" class="px-3 py-2 bg-white border rounded">Importar</a>
+    <a href="{{ url_for('bulk_edit') }}" class="px-3 py-2 bg-white border rounded">Edición masiva</a>
+    <a href="{{ url_for('new_product') }}" class="px-3 py-2 bg-slate-900 text-white rounded">+ Nuevo producto</a>
+  </div>
+</div>
+
+<div class="overflow-x-auto">
+<table class="min-w-full bg-white rounded shadow">
+  <thead class="bg-slate-100 text-left text-sm">
+    <tr>
+      <th class="p-2">Marca</th>
+      <th class="p-2">Producto</th>
+      <th class="p-2">SKU</th>
+      <th class="p-2 text-right">FOB (USD)</th>
+      <th class="p-2 text-right">Costo Final USD</th>
+      <th class="p-2 text-right">Margen Neto %</th>
+      <th class="p-2 text-right">Web (ARS)</th>
+      <th class="p-2 text-right">ML 1</th>
+      <th class="p-2 text-right">ML 3</th>
+      <th class="p-2 text-right">ML 6</th>
+      <th class="p-2 text-right">ML 9</th>
+      <th class="p-2 text-right">ML 12</th>
+      <th class="p-2"></th>
+    </tr>
+  </thead>
+  <tbody class="text-sm">
+    {% include "product_rows.html" %}
+  </tbody>
+</table>
+</div>
+{% if next_cursor %}
+<div class="mt-3 flex justify-end">
+  <a href="{{ url_for('home', q=q or None, after=next_cursor, per_page=per_page) }}" class="px-3 py-2 bg-white border rounded">Siguiente &rarr;</a>
+</div>
+{% endif %}
+{% endblock %}
+"""
+
+# Caché de filas renderizadas: el <tr> de cada producto se guarda por (id, version,
+# vars_version), que es lo mismo que decide si sus precios materializados siguen valiendo.
+# Una edición o un cambio de variables cambia la clave; las entradas viejas salen por LRU.
+ROW_CACHE_SIZE = int(os.environ.get("ROW_CACHE_SIZE", "20000"))  # filas (~1.5 KB c/u)
+
+class RowFragmentCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Tuple[Any, ...], Markup]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key: Tuple[Any, ...]) -> Optional[Markup]:
+        with self.lock:
+            html = self.entries.get(key)
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return html
+
+    def put(self, key: Tuple[Any, ...], html: Markup):
+        with self.lock:
+            self.entries[key] = html
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def render_metrics(self) -> str:
+        with self.lock:
+            return "".join([
+                "# TYPE pricing_row_cache_requests_total counter\n",
+                f'pricing_row_cache_requests_total{{result="hit"}} {self.hits}\n',
+                f'pricing_row_cache_requests_total{{result="miss"}} {self.misses}\n',
+                "# TYPE pricing_row_cache_evictions_total counter\n",
+                f"pricing_row_cache_evictions_total {self.evictions}\n",
+                "# TYPE pricing_row_cache_entries gauge\n",
+                f"pricing_row_cache_entries {len(self.entries)}\n",
+            ])
+
+row_cache = RowFragmentCache(ROW_CACHE_SIZE)
+
+def product_row(p: Mapping[str, Any], c: CalcResult, vars_version: int) -> Markup:
+    """El <tr> de un producto, de la caché o renderizado con product_row.html."""
+    key = (p["id"], p["version"], vars_version)
+    html = row_cache.get(key)
+    if html is None:
+        html = Markup(app.jinja_env.get_template("product_row.html").render(p=p, c=c))
+        row_cache.put(key, html)
+    return html
+
+TEMPLATES["product_rows.html"] = r"""
+{% for p, c in rows %}{{ product_row(p, c, vars_version) }}{% endfor %}
+"""
+
+TEMPLATES["product_row.html"] = r"""
+<tr class="border-t hover:bg-slate-50">
+  <td class="p-2">{{ p['brand'] }}</td>
+  <td class="p-2">{{ p['name'] }}</td>
+  <td class="p-2 font-mono">{{ p['sku'] }}</td>
+  <td class="p-2 text-right">{{ '%.2f' % p['fob_usd'] }}</td>
+  <td class="p-2 text-right">{{ '%.2f' % c.costo_final_usd }}</td>
+  <td class="p-2 text-right {% if c.margen_neto < 0.05 %}text-red-600{% elif c.margen_neto < 0.1 %}text-yellow-600{% else %}text-emerald-700{% endif %}">
+    {{ '%.2f' % (c.margen_neto * 100) }}%
+  </td>
+  <td class="p-2 text-right money">{{ money(c.precio_web_ars) }}</td>
+  <td class="p-2 text-right money">{{ money(c.precio_ml_1_ars) }}</td>
+  <td class="p-2 text-right money">{{ money(c.precio_ml_3_ars) }}</td>
+  <td class="p-2 text-right money">{{ money(c.precio_ml_6_ars) }}</td>
+  <td class="p-2 text-right money">{{ money(c.precio_ml_9_ars) }}</td>
+  <td class="p-2 text-right money">{{ money(c.precio_ml_12_ars) }}</td>
+  <td class="p-2 text-right">
+    <a href="{{ url_for('edit_product', pid=p['id']) }}" class="text-blue-700 hover:underline">Editar</a>
+  </td>
+</tr>
+"""
+
+@app.route("/")
+@login_required
+def home():
+    q = (request.args.get("q") or "").strip().lower()
+    after = decode_cursor(request.args.get("after") or "")
+    try:
+        per_page = min(max(int(request.args.get("per_page", PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        per_page = PAGE_SIZE
+    product_ids = search_product_ids(q) if q else None
+
+    if request.args.get("stream"):
+        return stream_products(q, product_ids, after)
+
+    # una fila de más para saber si hay página siguiente; con búsqueda se pagina igual que el
+    # listado completo, en orden (brand, name, id) restringido a los ids encontrados
+    snap = catalog_snapshot()
+    if snap.rows is not None:
+        rows = snap.page(after, per_page + 1, matching=product_ids)
+    else:
+        rows = load_priced_products(after=after, limit=per_page + 1, matching=product_ids)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    next_cursor = encode_cursor(rows[-1][0]) if has_more else None
+
+    return render_template(
+        "home.html", title="Productos | " + APP_TITLE,
+        rows=rows, q=q, per_page=per_page, next_cursor=next_cursor, vars_version=snap.version[0],
+    )
+
+def stream_products(q: str, product_ids: Optional[List[int]], after: Optional[Tuple[str, str, int]]):
+    """Variante de home() que manda la tabla completa mientras la va leyendo: las filas
+    salen del cursor de a STREAM_CHUNK_SIZE y la salida se despacha de a bloques."""
+    vars_version = get_vars_version()
+    rows = itertools.chain.from_iterable(iter_priced_products(after=after, chunk_size=STREAM_CHUNK_SIZE, matching=product_ids))
+    context = dict(title="Productos | " + APP_TITLE, rows=rows, q=q, next_cursor=None, vars_version=vars_version)
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template("home.html").stream(context)
+    stream.enable_buffering(STREAM_CHUNK_SIZE)
+    return Response(stream_with_context(stream), mimetype="text/html")
+
+TEMPLATES["about.html"] = r"""
+{% extends "base.html" %}
+{% block content %}
         <h1 class="text-xl font-semibold mb-3">Ayuda rápida</h1>
         <ol class="list-decimal ml-6 space-y-1">
           <li>Primero, cargá o ajustá las <a href="{{ url_for('variables') }}" class="text-blue-700 underline">Variables</a> (dólar, costos, coeficientes).</li>
@@ -444,15 +2927,37 @@ Precio ML (ARS)  = redondear_599_999( PV Neto USD * dolar * coef_ml_X + envio_ml
           <div class="p-2 bg-white rounded border"><strong>{{ k }}</strong>: {{ v }}</div>
           {% endfor %}
         </div>
-        """,
-        vars_map=vars_map,
-    )
-    return page(body, title="Ayuda | " + APP_TITLE)
+{% endblock %}
+"""
+
+@app.route("/about")
+def about():
+    vars_map = catalog_snapshot().variables
+    return render_template("about.html", title="Ayuda | " + APP_TITLE, vars_map=vars_map)
+
+TEMPLATES["variables.html"] = r"""
+{% extends "base.html" %}
+{% block content %}
+<h1 class="text-xl font-semibold mb-3">Variables globales</h1>
+<form method="post" class="grid gap-3 max-w-3xl">
+  <div class="grid md:grid-cols-2 gap-2">
+    {% for key, label in order %}
+    <label class="flex items-center justify-between gap-2 bg-white p-2 rounded border">
+      <span class="text-sm">{{ label }}</span>
+      <input name="{{ key }}" value="{{ '%.6f' % vars_map.get(key, 0.0) }}" class="border p-1 rounded w-40 text-right" />
+    </label>
+    {% endfor %}
+  </div>
+  <div>
+    <button class="px-3 py-2 bg-slate-900 text-white rounded">Guardar</button>
+  </div>
+</form>
+{% endblock %}
+"""
 
 @app.route("/variables", methods=["GET", "POST"])
 @login_required
 def variables():
-    init_db()
     if request.method == "POST":
         # Guardar cada campo enviado
         payload = dict(request.form)
@@ -483,40 +2988,52 @@ def variables():
         ("envio_ml", "Envío ML (ARS, opcional)"),
     ]
 
-    # Construir form
-    body = render_template_string(
-        r"""
-        <h1 class="text-xl font-semibold mb-3">Variables globales</h1>
-        <form method="post" class="grid gap-3 max-w-3xl">
-          <div class="grid md:grid-cols-2 gap-2">
-            {% for key, label in order %}
-            <label class="flex items-center justify-between gap-2 bg-white p-2 rounded border">
-              <span class="text-sm">{{ label }}</span>
-              <input name="{{ key }}" value="{{ '%.6f' % vars_map.get(key, 0.0) }}" class="border p-1 rounded w-40 text-right" />
-            </label>
-            {% endfor %}
-          </div>
-          <div>
-            <button class="px-3 py-2 bg-slate-900 text-white rounded">Guardar</button>
-          </div>
-        </form>
-        """,
-        vars_map=vars_map, order=order,
-    )
-    return page(body, title="Variables | " + APP_TITLE)
+    return render_template("variables.html", title="Variables | " + APP_TITLE, vars_map=vars_map, order=order)
+
+TEMPLATES["new_product.html"] = r"""
+{% extends "base.html" %}
+{% block content %}
+<h1 class="text-xl font-semibold mb-3">Nuevo producto</h1>
+<form method="post" class="grid gap-3 max-w-4xl bg-white p-4 rounded border">
+  <div class="grid md:grid-cols-3 gap-3">
+    <input name="brand" placeholder="Marca" class="border p-2 rounded" />
+    <input name="name" placeholder="Nombre / Modelo" class="border p-2 rounded" />
+    <input name="sku" placeholder="SKU" class="border p-2 rounded" />
+  </div>
+
+  <div class="grid md:grid-cols-4 gap-3 text-sm">
+    <input name="fob_usd" placeholder="FOB (USD)" class="border p-2 rounded" />
+    <input name="peso_kg" placeholder="Peso (kg)" class="border p-2 rounded" />
+    <input name="costo_flete_usd_kg" placeholder="Flete USD/kg" class="border p-2 rounded" />
+    <input name="costo_financiero" placeholder="% Financiero (ej. 0.04)" class="border p-2 rounded" />
+  </div>
+
+  <div class="grid md:grid-cols-4 gap-3 text-sm">
+    <input name="arancel" placeholder="Arancel (ej. 0.16)" class="border p-2 rounded" />
+    <input name="aduana" placeholder="Aduana / Estadística (ej. 0.0053)" class="border p-2 rounded" />
+    <input name="despachante" placeholder="Despachante (ej. 0.0095)" class="border p-2 rounded" />
+    <input name="banco" placeholder="Banco (ej. 0.004)" class="border p-2 rounded" />
+  </div>
+
+  <div class="grid md:grid-cols-3 gap-3 text-sm">
+    <input name="iva" placeholder="IVA (0.105 o 0.21)" class="border p-2 rounded" />
+    <input name="envio_ars" placeholder="Costo Envío (ARS)" class="border p-2 rounded" />
+    <input name="margen_neto" placeholder="% Margen Neto (ej. 0.06)" class="border p-2 rounded" />
+  </div>
+
+  <div class="grid md:grid-cols-1 gap-3 text-sm">
+    <input name="precio_manual_ars" placeholder="Precio manual (ARS, opcional)" class="border p-2 rounded" />
+  </div>
+
+  <button class="px-3 py-2 bg-slate-900 text-white rounded mt-2">Guardar</button>
+</form>
+{% endblock %}
+"""
 
 @app.route("/product/new", methods=["GET", "POST"])
 def new_product():
-    init_db()
     if request.method == "POST":
-        data = {k: (request.form.get(k) or "").strip() for k in [
-            "brand", "name", "sku", "fob_usd", "peso_kg", "costo_flete_usd_kg", "costo_financiero",
-            "arancel", "aduana", "despachante", "banco", "iva", "envio_ars", "margen_neto", "precio_manual_ars"
-        ]}
-        # normalizar numéricos
-        for k in data:
-            if k not in ("brand", "name", "sku"):
-                data[k] = data[k].replace(",", ".") or "0"
+        data = normalize_product_data(request.form)
 
         if not (data["brand"] and data["name"] and data["sku"]):
             flash("Marca, Producto y SKU son obligatorios.")
@@ -533,66 +3050,147 @@ def new_product():
             db.commit()
             flash("Producto creado.")
             pid = db.execute("SELECT last_insert_rowid() AS id").fetchone()["id"]
+            refresh_computed_prices([pid])
             return redirect(url_for("edit_product", pid=pid))
         except sqlite3.IntegrityError:
             flash("Ese SKU ya existe.")
             return redirect(url_for("new_product"))
 
-    body = r"""
-    <h1 class="text-xl font-semibold mb-3">Nuevo producto</h1>
-    <form method="post" class="grid gap-3 max-w-4xl bg-white p-4 rounded border">
-      <div class="grid md:grid-cols-3 gap-3">
-        <input name="brand" placeholder="Marca" class="border p-2 rounded" />
-        <input name="name" placeholder="Nombre / Modelo" class="border p-2 rounded" />
-        <input name="sku" placeholder="SKU" class="border p-2 rounded" />
-      </div>
-
-      <div class="grid md:grid-cols-4 gap-3 text-sm">
-        <input name="fob_usd" placeholder="FOB (USD)" class="border p-2 rounded" />
-        <input name="peso_kg" placeholder="Peso (kg)" class="border p-2 rounded" />
-        <input name="costo_flete_usd_kg" placeholder="Flete USD/kg" class="border p-2 rounded" />
-        <input name="costo_financiero" placeholder="% Financiero (ej. 0.04)" class="border p-2 rounded" />
-      </div>
-
-      <div class="grid md:grid-cols-4 gap-3 text-sm">
-        <input name="arancel" placeholder="Arancel (ej. 0.16)" class="border p-2 rounded" />
-        <input name="aduana" placeholder="Aduana / Estadística (ej. 0.0053)" class="border p-2 rounded" />
-        <input name="despachante" placeholder="Despachante (ej. 0.0095)" class="border p-2 rounded" />
-        <input name="banco" placeholder="Banco (ej. 0.004)" class="border p-2 rounded" />
-      </div>
-
-      <div class="grid md:grid-cols-3 gap-3 text-sm">
-        <input name="iva" placeholder="IVA (0.105 o 0.21)" class="border p-2 rounded" />
-        <input name="envio_ars" placeholder="Costo Envío (ARS)" class="border p-2 rounded" />
-        <input name="margen_neto" placeholder="% Margen Neto (ej. 0.06)" class="border p-2 rounded" />
-      </div>
-
-      <div class="grid md:grid-cols-1 gap-3 text-sm">
-        <input name="precio_manual_ars" placeholder="Precio manual (ARS, opcional)" class="border p-2 rounded" />
-      </div>
-
-      <button class="px-3 py-2 bg-slate-900 text-white rounded mt-2">Guardar</button>
-    </form>
-    """
-    return page(body, title="Nuevo producto | " + APP_TITLE)
+    return render_template("new_product.html", title="Nuevo producto | " + APP_TITLE)
+
+TEMPLATES["edit_product.html"] = r"""
+{% extends "base.html" %}
+{% block content %}
+<h1 class="text-xl font-semibold mb-3">Editar producto</h1>
+<form method="post" class="grid gap-3 max-w-4xl bg-white p-4 rounded border">
+  <div class="grid md:grid-cols-3 gap-3">
+    <input name="brand" value="{{ p['brand'] }}" class="border p-2 rounded" />
+    <input name="name" value="{{ p['name'] }}" class="border p-2 rounded" />
+    <input name="sku" value="{{ p['sku'] }}" class="border p-2 rounded" />
+  </div>
+
+  <div class="grid md:grid-cols-4 gap-3 text-sm">
+    <input name="fob_usd" value="{{ p['fob_usd'] }}" class="border p-2 rounded" />
+    <input name="peso_kg" value="{{ p['peso_kg'] }}" class="border p-2 rounded" />
+    <input name="costo_flete_usd_kg" value="{{ p['costo_flete_usd_kg'] }}" class="border p-2 rounded" />
+    <input name="costo_financiero" value="{{ p['costo_financiero'] }}" class="border p-2 rounded" />
+  </div>
+
+  <div class="grid md:grid-cols-4 gap-3 text-sm">
+    <input name="arancel" value="{{ p['arancel'] }}" class="border p-2 rounded" />
+    <input name="aduana" value="{{ p['aduana'] }}" class="border p-2 rounded" />
+    <input name="despachante" value="{{ p['despachante'] }}" class="border p-2 rounded" />
+    <input name="banco" value="{{ p['banco'] }}" class="border p-2 rounded" />
+  </div>
+
+  <div class="grid md:grid-cols-3 gap-3 text-sm">
+    <input name="iva" value="{{ p['iva'] }}" class="border p-2 rounded" />
+    <input name="envio_ars" value="{{ p['envio_ars'] }}" class="border p-2 rounded" />
+    <input name="margen_neto" value="{{ p['margen_neto'] }}" class="border p-2 rounded" />
+  </div>
+
+  <div class="grid md:grid-cols-1 gap-3 text-sm">
+    <input name="precio_manual_ars" value="{{ p['precio_manual_ars'] or '' }}" class="border p-2 rounded" />
+  </div>
+
+  <button class="px-3 py-2 bg-slate-900 text-white rounded mt-2">Guardar</button>
+</form>
+
+<div id="price-panels" class="grid md:grid-cols-2 gap-4 mt-6">
+  {% include "price_panels.html" %}
+</div>
+
+<script>
+// vista previa: cada cambio en el formulario pide los paneles recalculados (sin guardar nada)
+(function () {
+  const form = document.querySelector("form[method=post]");
+  const panels = document.getElementById("price-panels");
+  let timer = null, inflight = null, enabled = true;
+  form.addEventListener("input", function () {
+    if (!enabled) return;
+    clearTimeout(timer);
+    timer = setTimeout(function () {
+      if (inflight) inflight.abort();
+      inflight = new AbortController();
+      const params = new URLSearchParams(new FormData(form));
+      fetch("{{ url_for('product_preview') }}?" + params, {signal: inflight.signal})
+        .then(function (r) {
+          // sin sesión responde 401: quedan los paneles del servidor y no se vuelve a pedir
+          if (r.status === 401) enabled = false;
+          return r.ok ? r.text() : null;
+        })
+        .then(function (html) { if (html !== null) panels.innerHTML = html; })
+        .catch(function () {});
+    }, 120);
+  });
+})();
+</script>
+{% endblock %}
+"""
+
+TEMPLATES["price_panels.html"] = r"""
+  <div class="p-4 bg-white rounded border">
+    <h2 class="font-semibold mb-2">Resumen de cálculo</h2>
+    <div class="text-sm space-y-1">
+      <div>CIF (USD): <strong>{{ '%.2f' % calc.cif_usd }}</strong></div>
+      <div>Costo Final USD: <strong>{{ '%.2f' % calc.costo_final_usd }}</strong></div>
+      <div>PV Neto USD: <strong>{{ '%.2f' % calc.pv_neto_usd }}</strong></div>
+      <div>Margen Neto: <strong>{{ '%.2f' % (calc.margen_neto * 100) }}%</strong></div>
+    </div>
+  </div>
+
+  <div class="p-4 bg-white rounded border">
+    <h2 class="font-semibold mb-2">Precios sugeridos (IVA incluido)</h2>
+    <div class="grid grid-cols-2 gap-2 text-sm">
+      <div>WEB</div><div class="text-right"><strong>{{ money(calc.precio_web_ars) }}</strong></div>
+      <div>ML 1</div><div class="text-right"><strong>{{ money(calc.precio_ml_1_ars) }}</strong></div>
+      <div>ML 3</div><div class="text-right"><strong>{{ money(calc.precio_ml_3_ars) }}</strong></div>
+      <div>ML 6</div><div class="text-right"><strong>{{ money(calc.precio_ml_6_ars) }}</strong></div>
+      <div>ML 9</div><div class="text-right"><strong>{{ money(calc.precio_ml_9_ars) }}</strong></div>
+      <div>ML 12</div><div class="text-right"><strong>{{ money(calc.precio_ml_12_ars) }}</strong></div>
+    </div>
+  </div>
+"""
+
+@app.route("/product/preview")
+@compress(enabled=False)  # fragmento chico: la latencia importa más que los bytes
+def product_preview():
+    """Paneles de cálculo para los valores del formulario (query string), sin escribir nada.
+
+    Las variables salen del snapshot si está vigente; con ?format=json devuelve el CalcResult.
+    Lo pide el JS del editor: sin sesión responde 401 en JSON en vez de redirigir al login
+    (la redirección terminaba con el HTML del login dentro de los paneles)."""
+    if "user" not in session:
+        return jsonify(error="Iniciá sesión para ver la vista previa."), 401
+    data = normalize_product_data(request.args, PRICE_INPUT_COLUMNS + ("precio_manual_ars",))
+    try:
+        candidate = {k: float(v) for k, v in data.items()}
+    except ValueError:
+        return jsonify(error="Valores no numéricos."), 400
+    # float() acepta "nan", "inf" y "1e400": money() no los puede formatear
+    if not all(math.isfinite(v) for v in candidate.values()):
+        return jsonify(error="Valores no numéricos."), 400
+    snap = catalog_snapshot(build=False)
+    calc = calculate_prices(snap.variables if snap is not None else get_variables(), candidate)
+    if request.args.get("format") == "json":
+        return jsonify(asdict(calc))
+    return render_template("price_panels.html", calc=calc)
 
 @app.route("/product/<int:pid>", methods=["GET", "POST"])
 def edit_product(pid: int):
-    init_db()
     db = get_db()
-    p = db.execute("SELECT * FROM products WHERE id=?", (pid,)).fetchone()
+    # recién editado, la foto está vieja: no vale la pena rehacerla para mostrar un producto
+    snap = catalog_snapshot(build=False) if request.method == "GET" else None
+    if snap is not None and snap.rows is not None:
+        p, calc = snap.by_id.get(pid, (None, None))
+    else:
+        p, calc = db.execute("SELECT * FROM products WHERE id=?", (pid,)).fetchone(), None
     if not p:
         flash("Producto no encontrado.")
         return redirect(url_for("home"))
 
     if request.method == "POST":
-        data = {k: (request.form.get(k) or "").strip() for k in [
-            "brand", "name", "sku", "fob_usd", "peso_kg", "costo_flete_usd_kg", "costo_financiero",
-            "arancel", "aduana", "despachante", "banco", "iva", "envio_ars", "margen_neto", "precio_manual_ars"
-        ]}
-        for k in data:
-            if k not in ("brand", "name", "sku"):
-                data[k] = data[k].replace(",", ".") or "0"
+        data = normalize_product_data(request.form)
         try:
             db.execute("""
                 UPDATE products SET
@@ -601,108 +3199,362 @@ def edit_product(pid: int):
                 WHERE id=?
             """, (*data.values(), pid))
             db.commit()
+            refresh_computed_prices([pid])
             flash("Producto actualizado.")
             return redirect(url_for("edit_product", pid=pid))
         except sqlite3.IntegrityError:
             flash("Ese SKU ya existe.")
             return redirect(url_for("edit_product", pid=pid))
 
-    vars_map = get_variables()
-    calc = calculate_prices(vars_map, p)
-
-    body = render_template_string(
-        r"""
-        <h1 class="text-xl font-semibold mb-3">Editar producto</h1>
-        <form method="post" class="grid gap-3 max-w-4xl bg-white p-4 rounded border">
-          <div class="grid md:grid-cols-3 gap-3">
-            <input name="brand" value="{{ p['brand'] }}" class="border p-2 rounded" />
-            <input name="name" value="{{ p['name'] }}" class="border p-2 rounded" />
-            <input name="sku" value="{{ p['sku'] }}" class="border p-2 rounded" />
-          </div>
-
-          <div class="grid md:grid-cols-4 gap-3 text-sm">
-            <input name="fob_usd" value="{{ p['fob_usd'] }}" class="border p-2 rounded" />
-            <input name="peso_kg" value="{{ p['peso_kg'] }}" class="border p-2 rounded" />
-            <input name="costo_flete_usd_kg" value="{{ p['costo_flete_usd_kg'] }}" class="border p-2 rounded" />
-            <input name="costo_financiero" value="{{ p['costo_financiero'] }}" class="border p-2 rounded" />
-          </div>
-
-          <div class="grid md:grid-cols-4 gap-3 text-sm">
-            <input name="arancel" value="{{ p['arancel'] }}" class="border p-2 rounded" />
-            <input name="aduana" value="{{ p['aduana'] }}" class="border p-2 rounded" />
-            <input name="despachante" value="{{ p['despachante'] }}" class="border p-2 rounded" />
-            <input name="banco" value="{{ p['banco'] }}" class="border p-2 rounded" />
-          </div>
-
-          <div class="grid md:grid-cols-3 gap-3 text-sm">
-            <input name="iva" value="{{ p['iva'] }}" class="border p-2 rounded" />
-            <input name="envio_ars" value="{{ p['envio_ars'] }}" class="border p-2 rounded" />
-            <input name="margen_neto" value="{{ p['margen_neto'] }}" class="border p-2 rounded" />
-          </div>
-
-          <div class="grid md:grid-cols-1 gap-3 text-sm">
-            <input name="precio_manual_ars" value="{{ p['precio_manual_ars'] or '' }}" class="border p-2 rounded" />
-          </div>
-
-          <button class="px-3 py-2 bg-slate-900 text-white rounded mt-2">Guardar</button>
-        </form>
-
-        <div class="grid md:grid-cols-2 gap-4 mt-6">
-          <div class="p-4 bg-white rounded border">
-            <h2 class="font-semibold mb-2">Resumen de cálculo</h2>
-            <div class="text-sm space-y-1">
-              <div>CIF (USD): <strong>{{ '%.2f' % calc.cif_usd }}</strong></div>
-              <div>Costo Final USD: <strong>{{ '%.2f' % calc.costo_final_usd }}</strong></div>
-              <div>PV Neto USD: <strong>{{ '%.2f' % calc.pv_neto_usd }}</strong></div>
-              <div>Margen Neto: <strong>{{ '%.2f' % (calc.margen_neto * 100) }}%</strong></div>
-            </div>
-          </div>
-
-          <div class="p-4 bg-white rounded border">
-            <h2 class="font-semibold mb-2">Precios sugeridos (IVA incluido)</h2>
-            <div class="grid grid-cols-2 gap-2 text-sm">
-              <div>WEB</div><div class="text-right"><strong>{{ money(calc.precio_web_ars) }}</strong></div>
-              <div>ML 1</div><div class="text-right"><strong>{{ money(calc.precio_ml_1_ars) }}</strong></div>
-              <div>ML 3</div><div class="text-right"><strong>{{ money(calc.precio_ml_3_ars) }}</strong></div>
-              <div>ML 6</div><div class="text-right"><strong>{{ money(calc.precio_ml_6_ars) }}</strong></div>
-              <div>ML 9</div><div class="text-right"><strong>{{ money(calc.precio_ml_9_ars) }}</strong></div>
-              <div>ML 12</div><div class="text-right"><strong>{{ money(calc.precio_ml_12_ars) }}</strong></div>
-            </div>
-          </div>
-        </div>
-        """,
-        p=p, calc=calc, money=money,
-    )
-    return page(body, title=f"Editar {p['sku']} | " + APP_TITLE)
+    if calc is None:
+        calc = calculate_prices(get_variables(), p)
+
+    return render_template("edit_product.html", title=f"Editar {p['sku']} | " + APP_TITLE, p=p, calc=calc)
 
 @app.route("/recalc-all")
 @login_required
 def recalc_all():
-    init_db()
-    db = get_db()
-    vars_map = get_variables()
-    products = db.execute("SELECT * FROM products").fetchall()
-    for p in products:
-        c = calculate_prices(vars_map, p["fob_usd"], p["weight_kg"])
-        db.execute(
-            """
-            INSERT INTO price_history(product_id, price_web_ars, price_ml1_ars, price_ml3_ars, price_ml6_ars, price_ml9_ars, price_ml12_ars, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                p["id"], c.precio_web_ars, c.precio_ml_1_ars, c.precio_ml_3_ars, c.precio_ml_6_ars, c.precio_ml_9_ars, c.precio_ml_12_ars,
-                datetime.now().isoformat(timespec="seconds"),
-            ),
-        )
-    db.commit()
-    flash("Recalculado y guardado en historial para todos los productos.")
+    total = get_db().execute("SELECT count(*) FROM products").fetchone()[0]
+    job_id = start_job("recalc", recalc_job, total)
+    if job_id is None:
+        flash("Ya hay un recálculo en curso.")
+    else:
+        flash(f"Recálculo iniciado en segundo plano (trabajo {job_id}). Progreso: {url_for('job_status', job_id=job_id)}")
     return redirect(url_for("home"))
 
+@app.route("/jobs/<int:job_id>")
+@login_required
+def job_status(job_id: int):
+    job = get_db().execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+    if not job:
+        return jsonify(error="Trabajo no encontrado."), 404
+    started = datetime.fromisoformat(job["started_at"])
+    ended = datetime.fromisoformat(job["finished_at"]) if job["finished_at"] else datetime.now()
+    elapsed = max((ended - started).total_seconds(), 0.0)
+    return jsonify(
+        id=job["id"],
+        kind=job["kind"],
+        status=job["status"],
+        total=job["total"],
+        done=job["done"],
+        progress=round(job["done"] / job["total"], 4) if job["total"] else 1.0,
+        rows_written=job["rows_written"],
+        elapsed_s=round(elapsed, 3),
+        rows_per_s=round(job["done"] / elapsed, 1) if elapsed else None,
+        error=job["error"],
+        started_at=job["started_at"],
+        finished_at=job["finished_at"],
+    )
+
+@app.route("/fx/stats")
+@login_required
+def fx_stats_view():
+    return jsonify(feeds=fx_stats(request.args.get("recent", 20, type=int)))
+
+@app.route("/metrics")
+def metrics_view():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return Response("no autorizado\n", status=401, mimetype="text/plain")
+    return Response(metrics.render() + row_cache.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/export/prices.<fmt>")
+@login_required
+def export_prices(fmt: str):
+    if fmt not in EXPORT_FORMATS:
+        return jsonify(error="Formato no soportado (csv o ndjson)."), 404
+    try:
+        since = parse_since(request.args.get("since"))
+    except ValueError:
+        return jsonify(error="since debe ser una fecha ISO, p. ej. 2025-01-31T12:00:00."), 400
+
+    # la compresión (gzip/brotli) la aplica compress_response sobre el stream
+    headers = {"Content-Disposition": f"attachment; filename=precios.{fmt}"}
+    return Response(stream_with_context(export_chunks(fmt, since)), mimetype=EXPORT_FORMATS[fmt], headers=headers)
+
+# ---------- API JSON (solo lectura) ----------
+def catalog_etag() -> str:
+    vars_version, products_version = catalog_version()
+    return f"v{vars_version}-p{products_version}"
+
+def not_modified(etag: str) -> Optional[Response]:
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+    return None
+
+def product_json(p: Mapping[str, Any], calc: CalcResult) -> Dict[str, Any]:
+    out = {"id": p["id"], **{k: p[k] for k in PRODUCT_FIELDS}, "updated_at": p["updated_at"]}
+    out["prices"] = asdict(calc)
+    return out
+
+@app.route("/api/products")
+@login_required
+def api_products():
+    etag = catalog_etag()
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    def generate():
+        yield '{"etag": %s, "products": [' % json.dumps(etag)
+        sep = ""
+        for chunk in iter_priced_products(chunk_size=STREAM_CHUNK_SIZE):
+            yield sep + ",".join(json.dumps(product_json(p, c), ensure_ascii=False) for p, c in chunk)
+            sep = ","
+        yield "]}"
+
+    resp = Response(stream_with_context(generate()), mimetype="application/json")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.route("/api/products/<int:pid>")
+@login_required
+def api_product(pid: int):
+    etag = catalog_etag()
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    rows = load_priced_products([pid])
+    if not rows:
+        return jsonify(error="Producto no encontrado."), 404
+    resp = jsonify(product_json(*rows[0]))
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.route("/history")
+@login_required
+def history():
+    args = request.args
+    agg, channel = args.get("agg", "raw"), args.get("channel", "web")
+    if agg not in HISTORY_AGGREGATIONS or channel not in HISTORY_CHANNELS:
+        return jsonify(error=f"agg: {', '.join(HISTORY_AGGREGATIONS)}; channel: {', '.join(HISTORY_CHANNELS)}."), 400
+    product_id = args.get("product_id", type=int)
+    brand = args.get("brand")
+    if product_id is None and not brand:
+        return jsonify(error="Indicá product_id o brand."), 400
+    try:
+        start, end = parse_history_range(args.get("from"), args.get("to"))
+    except ValueError:
+        return jsonify(error="from/to deben ser fechas ISO."), 400
+    return jsonify(
+        product_id=product_id, brand=brand, start=start, end=end, agg=agg, channel=channel,
+        rows=price_series(start, end, product_id, brand, agg, channel),
+    )
+
+@app.route("/history/movers")
+@login_required
+def history_movers():
+    args = request.args
+    channel = args.get("channel", "web")
+    if channel not in HISTORY_CHANNELS:
+        return jsonify(error=f"channel: {', '.join(HISTORY_CHANNELS)}."), 400
+    try:
+        start, end = parse_history_range(args.get("from"), args.get("to"))
+    except ValueError:
+        return jsonify(error="from/to deben ser fechas ISO."), 400
+    limit = min(max(args.get("limit", 50, type=int), 1), 1000)
+    return jsonify(start=start, end=end, channel=channel, rows=top_movers(start, end, channel, limit))
+
+@app.route("/scenarios", methods=["POST"])
+@login_required
+def scenarios():
+    """Body JSON, p. ej.: {"dolar": {"from": 1400, "to": 1800, "step": 20}, "coef_ml_6": [1.40, 1.45],
+    "margen": [0.05, 0.08], "channel": "ml6", "drill": 3}."""
+    spec = request.get_json(silent=True) or {}
+    if not isinstance(spec, dict):
+        return jsonify(error="Escenario inválido: se esperaba un objeto JSON."), 400
+    channel = spec.get("channel", "web")
+    if not isinstance(channel, str) or channel not in SCENARIO_CHANNELS:
+        return jsonify(error=f"channel: {', '.join(SCENARIO_CHANNELS)}."), 400
+    try:
+        return jsonify(run_scenarios(spec, channel, spec.get("drill"), int(spec.get("drill_limit", 100))))
+    except (ValueError, TypeError, KeyError) as exc:
+        return jsonify(error=f"Escenario inválido: {exc}"), 400
+
+@app.route("/reverse-pricing", methods=["POST"])
+@login_required
+def reverse_pricing_view():
+    """Body JSON, p. ej.: {"channel": "ml6", "targets": {"HP-15DY-2045": 1850999}, "min_margin": 0.05}
+    o {"targets": [{"sku": "HP-15DY-2045", "channel": "web", "target": 1500000}, ...]}."""
+    spec = request.get_json(silent=True) or {}
+    try:
+        targets = parse_targets(spec.get("targets") or {}, spec.get("channel", "web"))
+        rows = reverse_pricing(targets, float(spec.get("min_margin", 0.0)))
+    except (ValueError, TypeError, KeyError, AttributeError) as exc:
+        return jsonify(error=f"Objetivos inválidos: {exc}"), 400
+    found = [r for r in rows if r["found"]]
+    return jsonify(
+        rows=rows,
+        summary={
+            "targets": len(rows),
+            "found": len(found),
+            "margin_ok": sum(1 for r in found if r["margin_ok"]),
+            "fob_ok": sum(1 for r in found if r["fob_ok"]),
+        },
+    )
+
+TEMPLATES["import.html"] = r"""
+{% extends "base.html" %}
+{% block content %}
+<h1 class="text-xl font-semibold mb-3">Importar productos</h1>
+<form method="post" enctype="multipart/form-data" class="grid gap-3 max-w-3xl bg-white p-4 rounded border">
+  <p class="text-sm text-slate-600">
+    CSV o XLSX con encabezado. Obligatorias: <code>brand</code>, <code>name</code>, <code>sku</code>; opcionales:
+    <code>fob_usd</code>, <code>peso_kg</code>, <code>margen_neto</code>, etc. (mismos nombres que el formulario).
+    Los SKU existentes se actualizan; las columnas que no vengan no se tocan.
+  </p>
+  <input type="file" name="file" accept=".csv,.xlsx" class="border p-2 rounded" />
+  <div>
+    <button class="px-3 py-2 bg-slate-900 text-white rounded">Importar</button>
+  </div>
+</form>
+
+{% if report %}
+<div class="mt-6 p-4 bg-white rounded border text-sm">
+  <h2 class="font-semibold mb-2">Resultado</h2>
+  <div>Nuevos: <strong>{{ report.inserted }}</strong> · Actualizados: <strong>{{ report.updated }}</strong> ·
+    Sin cambios: <strong>{{ report.unchanged }}</strong> · Con errores: <strong>{{ report.errors|length }}</strong></div>
+  {% if report.errors %}
+  <ul class="mt-2 list-disc ml-6">
+    {% for line, msg in report.errors %}
+    <li>Línea {{ line }}: {{ msg }}</li>
+    {% endfor %}
+  </ul>
+  {% endif %}
+</div>
+{% endif %}
+{% endblock %}
+"""
+
+@app.route("/import", methods=["GET", "POST"])
+@login_required
+def import_view():
+    report = None
+    if request.method == "POST":
+        upload = request.files.get("file")
+        if not upload or not upload.filename:
+            flash("Elegí un archivo CSV o XLSX.")
+            return redirect(url_for("import_view"))
+        try:
+            report = import_products(*read_sheet(upload.stream, upload.filename))
+        except ValueError as exc:
+            flash(str(exc))
+            return redirect(url_for("import_view"))
+    return render_template("import.html", title="Importar | " + APP_TITLE, report=report)
+
+TEMPLATES["bulk_edit.html"] = r"""
+{% extends "base.html" %}
+{% block content %}
+<h1 class="text-xl font-semibold mb-3">Edición masiva</h1>
+<form method="post" class="grid gap-3 max-w-4xl bg-white p-4 rounded border">
+  <div class="grid md:grid-cols-3 gap-3 text-sm">
+    <input name="brand" value="{{ selection.brand }}" placeholder="Marca (exacta)" class="border p-2 rounded" />
+    <input name="sku" value="{{ selection.sku }}" placeholder="SKU (ej. HP-15*)" class="border p-2 rounded" />
+    <input name="q" value="{{ selection.q }}" placeholder="Búsqueda (como en Productos)" class="border p-2 rounded" />
+  </div>
+  <div class="grid md:grid-cols-3 gap-3 text-sm">
+    <select name="column" class="border p-2 rounded">
+      {% for col in columns %}<option value="{{ col }}" {% if col == column %}selected{% endif %}>{{ col }}</option>{% endfor %}
+    </select>
+    <select name="op" class="border p-2 rounded">
+      <option value="set" {% if op == 'set' %}selected{% endif %}>Fijar en</option>
+      <option value="multiply" {% if op == 'multiply' %}selected{% endif %}>Multiplicar por</option>
+    </select>
+    <input name="value" value="{{ value_raw }}" placeholder="Valor (ej. 0.08 o 1.05)" class="border p-2 rounded" />
+  </div>
+  <div class="flex gap-2">
+    <button name="action" value="preview" class="px-3 py-2 bg-white border rounded">Vista previa</button>
+    {% if preview and preview.count %}
+    <button name="action" value="apply" class="px-3 py-2 bg-slate-900 text-white rounded">Aplicar a {{ preview.count }} productos</button>
+    {% endif %}
+  </div>
+</form>
+
+{% if preview %}
+<div class="mt-6 p-4 bg-white rounded border text-sm">
+  {% if not preview.count %}
+  Ningún producto cumple los filtros.
+  {% else %}
+  <div>Productos: <strong>{{ preview.count }}</strong> (cambian {{ preview.changed }}) ·
+    Margen promedio: <strong>{{ '%.2f' % (preview.avg_margin_before * 100) }}% &rarr; {{ '%.2f' % (preview.avg_margin_after * 100) }}%</strong> ·
+    Con margen &lt; 5%: <strong>{{ preview.low_margin_after }}</strong> ·
+    Precio web promedio: <strong>{{ '%+.2f' % (preview.avg_web_change * 100) }}%</strong></div>
+  {% if preview.count > preview.rows|length %}
+  <p class="mt-1 text-slate-600">Se listan los primeros {{ preview.rows|length }}.</p>
+  {% endif %}
+  <div class="overflow-x-auto mt-3">
+  <table class="min-w-full">
+    <thead class="bg-slate-100 text-left">
+      <tr>
+        <th class="p-2">SKU</th>
+        <th class="p-2">Producto</th>
+        <th class="p-2 text-right">{{ column }}</th>
+        <th class="p-2 text-right">Web (ARS)</th>
+        <th class="p-2 text-right">Margen Neto %</th>
+      </tr>
+    </thead>
+    <tbody>
+      {% for r in preview.rows %}
+      <tr class="border-t">
+        <td class="p-2 font-mono">{{ r.product['sku'] }}</td>
+        <td class="p-2">{{ r.product['brand'] }} {{ r.product['name'] }}</td>
+        <td class="p-2 text-right">{{ '%g' % r.old_value }} &rarr; {{ '%g' % r.new_value }}</td>
+        <td class="p-2 text-right">{{ money(r.old_web) }} &rarr; {{ money(r.new_web) }}</td>
+        <td class="p-2 text-right {% if r.new_margin < 0.05 %}text-red-600{% endif %}">
+          {{ '%.2f' % (r.old_margin * 100) }}% &rarr; {{ '%.2f' % (r.new_margin * 100) }}%
+        </td>
+      </tr>
+      {% endfor %}
+    </tbody>
+  </table>
+  </div>
+  {% endif %}
+</div>
+{% endif %}
+{% endblock %}
+"""
+
+@app.route("/bulk-edit", methods=["GET", "POST"])
+@login_required
+def bulk_edit():
+    form = request.form
+    selection = BulkSelection(*(form.get(k, "").strip() for k in ("brand", "sku", "q")))
+    column = form.get("column", "margen_neto")
+    op = form.get("op", "set")
+    value_raw = form.get("value", "").strip()
+    preview = None
+    if request.method == "POST":
+        try:
+            value = float(value_raw.replace(",", "."))
+        except ValueError:
+            flash("El valor tiene que ser numérico.")
+            value = None
+        if value is not None and (column not in BULK_COLUMNS or op not in BULK_OPS):
+            flash("Columna u operación no permitida.")
+            value = None
+        elif value is not None and not selection:
+            flash("Elegí al menos un filtro (marca, SKU o búsqueda).")
+            value = None
+        if value is not None and form.get("action") == "apply":
+            changed = bulk_apply(selection, column, op, value)
+            flash(f"{column}: {changed} productos actualizados.")
+            return redirect(url_for("home"))
+        if value is not None:
+            preview = bulk_preview(selection, column, op, value)
+    return render_template(
+        "bulk_edit.html", title="Edición masiva | " + APP_TITLE, selection=selection, columns=BULK_COLUMNS,
+        column=column, op=op, value_raw=value_raw, preview=preview,
+    )
+
 @app.route("/product/<int:pid>/delete")
 def delete_product(pid: int):
-    init_db()
-    db = get_db()
+    db = get_write_db()
     db.execute("DELETE FROM products WHERE id=?", (pid,))
+    db.execute("DELETE FROM computed_prices WHERE product_id=?", (pid,))
     db.commit()
     flash("Producto eliminado.")
     return redirect(url_for("home"))
@@ -713,6 +3565,29 @@ home.methods = ["GET"]
 about.methods = ["GET"]
 variables.methods = ["GET", "POST"]
 
+# ==============================
+# Arranque
+# ==============================
+# Importar el módulo no escribe nada: los procesos del pool de price_shards lo importan solo
+# para correr price_shard y no tienen que migrar ni sembrar ninguna base. El esquema, las
+# variables por defecto, el CSS y las plantillas se preparan en create_app(), que es lo que
+# usa gunicorn ("app_precios_v2:create_app()", ver Procfile). Si igual se carga el `app` del
+# módulo, corre antes del primer request (ensure_started) y de cada comando de la CLI
+# (StartupAppGroup). Corre una vez por proceso y base (DB_PATH).
+_started_db: Optional[str] = None
+_startup_lock = threading.Lock()
+
+def create_app() -> Flask:
+    global _started_db
+    if _started_db == DB_PATH:
+        return app
+    with _startup_lock:
+        if _started_db != DB_PATH:
+            with app.app_context():
+                init_db()
+            precompile_templates()
+            _started_db = DB_PATH
+    return app
+
 if __name__ == "__main__":
-    init_db()
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    create_app().run(host="0.0.0.0", port=5000, debug=True)
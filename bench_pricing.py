@@ -0,0 +1,386 @@
+"""
+Benchmarks de la app de precios sobre catálogos sintéticos.
+
+    python bench_pricing.py run --sizes 1k,10k,100k --out bench.json
+    python bench_pricing.py run --sizes 10k --compare bench.json    # marca regresiones
+    python bench_pricing.py compare base.json nuevo.json
+    python bench_pricing.py run --sizes 100k --scenarios recalc_sharded --workers 1,2,4,8
+
+Cada tamaño de catálogo se genera una sola vez (con semilla fija) en --workdir y se reutiliza
+entre corridas. Cada escenario corre en un proceso aparte sobre una copia de ese catálogo, así
+el pico de RSS es el del escenario y ninguno ve los cambios que dejó otro.
+
+recalc_sharded corre el recálculo total una vez por cada cantidad de --workers (1 = camino de
+un solo proceso) y reporta cada punto como recalc_sharded_w<N>, con la aceleración contra w1.
+Cada punto guarda effective_workers (recalc_workers): si la app lo bajó (una sola CPU o un
+catálogo debajo de RECALC_POOL_MIN_PRODUCTS) se marca "clamped" y no lleva speedup.
+"""
+from __future__ import annotations
+import functools
+import itertools
+import json
+import os
+import pathlib
+import platform
+import re
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+import click
+import numpy as np
+
+HERE = pathlib.Path(__file__).resolve().parent
+SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+SCENARIOS = ("calculate_prices", "home", "home_q", "recalc_all", "edit_product", "save_variables", "recalc_sharded")
+HEAVY_SCENARIOS = ("recalc_all", "save_variables", "recalc_sharded")  # recorren todo el catálogo: menos repeticiones
+METRICS = ("p50_ms", "p95_ms", "peak_rss_mb")
+HOME_PAGES = 5  # "home" recorre las primeras páginas siguiendo el cursor y vuelve a empezar
+NEXT_CURSOR_RE = re.compile(r'href="[^"]*[?&;]after=([A-Za-z0-9_-]+)')
+
+BRANDS = (
+    "HP", "Lenovo", "Dell", "Asus", "Acer", "Apple", "Samsung", "LG", "Sony", "Philips", "Logitech",
+    "Kingston", "Corsair", "Gigabyte", "MSI", "Xiaomi", "Motorola", "TP-Link", "Epson", "Brother",
+)
+MODELS = ("Pavilion", "ThinkPad", "Inspiron", "Vivobook", "Aspire", "MacBook", "Galaxy", "UltraGear",
+          "Bravia", "Evnia", "Signature", "Fury", "Vengeance", "Aorus", "Katana", "Redmi", "Edge", "Archer")
+KINDS = ("Notebook", "Monitor", "Teclado", "Mouse", "Impresora", "Tablet", "Auricular", "Router", "SSD", "Memoria")
+
+# ==============================
+# Generador de catálogos
+# ==============================
+def generate_catalog(db_path: str, n: int, seed: int, history_per_sku: int):
+    """Llena products y price_history con un catálogo sintético reproducible.
+
+    Los costos siguen una lognormal (muchos accesorios baratos, pocos equipos caros), ~5% de
+    los productos tiene precio manual y cada SKU trae `history_per_sku` cambios de precio
+    repartidos en el último año."""
+    os.environ["PRICING_DB"] = db_path
+    sys.path.insert(0, str(HERE))
+    import app_precios_v2 as appmod
+    appmod.create_app()
+
+    rng = np.random.default_rng(seed)
+    fob = np.round(rng.lognormal(mean=4.5, sigma=1.1, size=n).clip(2, 20_000), 2)
+    peso = np.round(rng.lognormal(mean=0.0, sigma=0.9, size=n).clip(0.05, 60), 3)
+    margen = np.round(rng.uniform(0.03, 0.25, size=n), 4)
+    manual = rng.random(n) < 0.05
+    brand = rng.integers(0, len(BRANDS), size=n)
+    model = rng.integers(0, len(MODELS), size=n)
+    kind = rng.integers(0, len(KINDS), size=n)
+
+    with appmod.app.app_context():
+        db = appmod.get_write_db()
+        vars_map = appmod.get_variables()
+        rows = (
+            (
+                BRANDS[brand[i]], f"{KINDS[kind[i]]} {MODELS[model[i]]} {i % 997}", f"{BRANDS[brand[i]][:3].upper()}-{i:07d}",
+                float(fob[i]), float(peso[i]), float(margen[i]),
+                float(round(fob[i] * vars_map["dolar"] * 1.6, -3) + 999) if manual[i] else None,
+            )
+            for i in range(n)
+        )
+        while True:
+            chunk = list(itertools.islice(rows, 10_000))
+            if not chunk:
+                break
+            db.executemany(
+                "INSERT INTO products(brand, name, sku, fob_usd, peso_kg, margen_neto, precio_manual_ars) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                chunk,
+            )
+            db.commit()
+
+        # historial: el precio actual hacia atrás con un paseo aleatorio por cambio de dólar
+        now = datetime.now().replace(microsecond=0)
+        last_id = 0
+        while True:
+            products = db.execute("SELECT * FROM products WHERE id > ? ORDER BY id LIMIT 10000", (last_id,)).fetchall()
+            if not products:
+                break
+            last_id = products[-1]["id"]
+            batch = appmod.calculate_prices_batch(vars_map, products)
+            prices = np.column_stack([getattr(batch, f) for f in appmod.PRICE_FIELDS])
+            history = []
+            for k in range(history_per_sku, 0, -1):
+                factor = rng.normal(1 - 0.04 * k, 0.01, size=(len(products), 1))
+                days = rng.integers(0, 365 // (history_per_sku + 1), size=len(products)) + (365 * k) // (history_per_sku + 1)
+                for p, row, d in zip(products, np.round(prices * factor, -2) + 99, days.tolist()):
+                    history.append((p["id"], *row.tolist(), (now - timedelta(days=d)).isoformat()))
+            db.executemany(appmod.INSERT_HISTORY_SQL, history)
+            db.commit()
+
+        # los precios materializados arrancan al día, como en un catálogo en uso
+        appmod.refresh_computed_prices()
+        db.execute("ANALYZE")
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.commit()
+
+# ==============================
+# Escenarios (corren en un proceso hijo)
+# ==============================
+def measure(scenario: str, db_path: str, repeat: int, seed: int, workers: int = 1) -> Dict[str, Any]:
+    os.environ["PRICING_DB"] = db_path
+    sys.path.insert(0, str(HERE))
+    import app_precios_v2 as appmod
+
+    app = appmod.create_app()
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s["user"] = next(iter(appmod.USERS))
+    headers = {"X-Forwarded-Proto": "https"}
+
+    with app.app_context():
+        db = appmod.get_write_db()
+        n = db.execute("SELECT max(id) FROM products").fetchone()[0] or 0
+        vars_map = appmod.get_variables()
+        sample = db.execute("SELECT * FROM products ORDER BY random() LIMIT ?", (max(repeat, 1),)).fetchall()
+        brand = db.execute("SELECT brand FROM products LIMIT 1").fetchone()[0]
+
+    def timed(fn: Callable[[], Any]) -> float:
+        t0 = time.perf_counter()
+        fn()
+        return (time.perf_counter() - t0) * 1000
+
+    def get(url: str) -> Callable[[], Any]:
+        def run():
+            r = client.get(url, headers=headers)
+            assert r.status_code == 200, (url, r.status_code)
+            return r.data
+        return run
+
+    home_walk = {"after": None, "depth": 0}
+
+    def home_page():
+        # la paginación es por keyset: la página siguiente sale del link after= de la anterior
+        url = "/" if home_walk["after"] is None else f"/?after={home_walk['after']}"
+        match = NEXT_CURSOR_RE.search(get(url)().decode())
+        home_walk["depth"] += 1
+        if match is None or home_walk["depth"] >= HOME_PAGES:
+            home_walk.update(after=None, depth=0)
+        else:
+            home_walk["after"] = match.group(1)
+
+    def recalc(job=appmod.recalc_job):
+        # cada corrida mueve el dólar directo en la tabla: así el recálculo escribe historial
+        with app.app_context():
+            w = appmod.get_write_db()
+            w.execute("UPDATE variables SET value = value + 1 WHERE key='dolar'")
+            w.commit()
+            appmod.bump_vars_version()
+            job_id = appmod.start_job("recalc", job, n)
+            while w.execute("SELECT status FROM jobs WHERE id=?", (job_id,)).fetchone()[0] == "running":
+                time.sleep(0.005)
+
+    def edit(i: int) -> Callable[[], Any]:
+        p = dict(sample[i % len(sample)])
+        p["margen_neto"] = round(p["margen_neto"] + 0.001, 4)
+        p["precio_manual_ars"] = p["precio_manual_ars"] or ""
+        def run():
+            r = client.post(f"/product/{p['id']}", data={k: str(p[k]) for k in appmod.PRODUCT_FIELDS}, headers=headers)
+            assert r.status_code == 302, r.status_code
+        return run
+
+    def save(i: int) -> Callable[[], Any]:
+        def run():
+            with app.app_context():
+                appmod.save_variables({"dolar": vars_map["dolar"] + i + 1})
+        return run
+
+    samples: List[float] = []
+    for i in range(repeat):
+        if scenario == "calculate_prices":
+            p = sample[i % len(sample)]
+            samples.append(timed(lambda: appmod.calculate_prices(vars_map, p)))
+        elif scenario == "home":
+            samples.append(timed(home_page))
+        elif scenario == "home_q":
+            samples.append(timed(get(f"/?q={brand.lower()}")))
+        elif scenario == "recalc_all":
+            samples.append(timed(recalc))
+        elif scenario == "recalc_sharded":
+            samples.append(timed(lambda: recalc(functools.partial(appmod.recalc_job, workers=workers))))
+        elif scenario == "edit_product":
+            samples.append(timed(edit(i)))
+        elif scenario == "save_variables":
+            samples.append(timed(save(i)))
+        else:
+            raise click.UsageError(f"escenario desconocido: {scenario}")
+
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # en macOS ru_maxrss viene en bytes
+        rss_kb //= 1024
+    result = {
+        "repeat": repeat,
+        "p50_ms": round(float(np.percentile(samples, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples, 95)), 3),
+        "mean_ms": round(float(np.mean(samples)), 3),
+        "peak_rss_mb": round(rss_kb / 1024, 1),
+    }
+    if scenario == "recalc_sharded":
+        # recalc_catalog baja a menos procesos con pocas CPUs o un catálogo chico
+        with app.app_context():
+            result["workers"] = workers
+            result["effective_workers"] = appmod.recalc_workers(workers)
+    return result
+
+# ==============================
+# Comparación contra un baseline
+# ==============================
+def compare_results(base: Dict[str, Any], new: Dict[str, Any], threshold: float, min_ms: float) -> List[str]:
+    """Devuelve una línea por métrica que empeoró más de `threshold` (relativo). En latencias
+    se ignoran diferencias menores a `min_ms`: debajo de eso domina el ruido."""
+    regressions = []
+    for size, scenarios in new["results"].items():
+        for scenario, metrics in scenarios.items():
+            old = base.get("results", {}).get(size, {}).get(scenario)
+            if not old or not isinstance(metrics, dict):
+                continue
+            for metric in METRICS:
+                a, b = old.get(metric), metrics.get(metric)
+                if a is None or b is None or a <= 0:
+                    continue
+                floor = min_ms if metric.endswith("_ms") else 0
+                if b > a * (1 + threshold) and b - a > floor:
+                    regressions.append(f"{size:>6} {scenario:<17} {metric:<12} {a:>10} -> {b:<10} (+{(b / a - 1) * 100:.0f}%)")
+    return regressions
+
+
+def report_comparison(base: Dict[str, Any], new: Dict[str, Any], threshold: float, min_ms: float) -> bool:
+    regressions = compare_results(base, new, threshold, min_ms)
+    if regressions:
+        click.echo(f"Regresiones (> {threshold:.0%}):")
+        for line in regressions:
+            click.echo("  " + line)
+    else:
+        click.echo(f"Sin regresiones (umbral {threshold:.0%}).")
+    return not regressions
+
+# ==============================
+# CLI
+# ==============================
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--sizes", default="1k,10k", show_default=True, help="Tamaños: 1k, 10k, 100k, 1m o un número.")
+@click.option("--scenarios", default=",".join(SCENARIOS), show_default=True)
+@click.option("--repeat", default=30, show_default=True, help="Repeticiones por escenario.")
+@click.option("--heavy-repeat", default=3, show_default=True, help="Repeticiones de recalc_all y save_variables.")
+@click.option("--seed", default=42, show_default=True)
+@click.option("--history-per-sku", default=3, show_default=True)
+@click.option("--workdir", type=click.Path(file_okay=False), default=os.path.join(tempfile.gettempdir(), "bench_pricing"), show_default=True)
+@click.option("--out", type=click.Path(dir_okay=False), default=None, help="Archivo JSON de resultados.")
+@click.option("--compare", "baseline", type=click.Path(exists=True, dir_okay=False), default=None)
+@click.option("--threshold", default=0.15, show_default=True, help="Empeoramiento relativo que cuenta como regresión.")
+@click.option("--min-ms", default=1.0, show_default=True, help="Diferencia mínima de latencia a considerar.")
+@click.option("--workers", default="1,2,4", show_default=True, help="Cantidades de procesos para recalc_sharded.")
+def run(sizes, scenarios, repeat, heavy_repeat, seed, history_per_sku, workdir, out, baseline, threshold, min_ms, workers):
+    """Genera (o reutiliza) los catálogos y corre cada escenario en un proceso aparte."""
+    os.makedirs(workdir, exist_ok=True)
+    results: Dict[str, Dict[str, Any]] = {}
+    for label in sizes.lower().split(","):
+        n = SIZES.get(label) or int(label)
+        catalog = os.path.join(workdir, f"catalog-{n}-{seed}-{history_per_sku}.db")
+        if not os.path.exists(catalog):
+            t0 = time.perf_counter()
+            subprocess.run(
+                [sys.executable, __file__, "generate", catalog, "--size", str(n), "--seed", str(seed),
+                 "--history-per-sku", str(history_per_sku)],
+                check=True,
+            )
+            click.echo(f"{label}: catálogo generado en {time.perf_counter() - t0:.1f}s", err=True)
+        results[label] = {}
+        runs = [
+            (f"{scenario}_w{w}" if scenario == "recalc_sharded" else scenario, scenario, w)
+            for scenario in scenarios.split(",")
+            for w in ([int(x) for x in workers.split(",")] if scenario == "recalc_sharded" else [1])
+        ]
+        for name, scenario, w in runs:
+            scratch = os.path.join(workdir, f"run-{os.getpid()}.db")
+            shutil.copyfile(catalog, scratch)
+            try:
+                proc = subprocess.run(
+                    [sys.executable, __file__, "measure", scenario, scratch, "--seed", str(seed), "--workers", str(w),
+                     "--repeat", str(heavy_repeat if scenario in HEAVY_SCENARIOS else repeat)],
+                    check=True, capture_output=True, text=True,
+                )
+            finally:
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(scratch + suffix):
+                        os.remove(scratch + suffix)
+            results[label][name] = m = json.loads(proc.stdout.strip().splitlines()[-1])
+            line = f"{label:>6} {name:<17} p50 {m['p50_ms']:>10.2f} ms  p95 {m['p95_ms']:>10.2f} ms  rss {m['peak_rss_mb']:>7.1f} MB"
+            single = results[label].get("recalc_sharded_w1")
+            if scenario == "recalc_sharded" and m["effective_workers"] != w:
+                # no es un punto de la curva: corrió con otra cantidad de procesos
+                m["clamped"] = True
+                line += f"  (corrió con {m['effective_workers']} proceso/s, sin speedup)"
+            elif scenario == "recalc_sharded" and single:
+                m["speedup"] = round(single["p50_ms"] / m["p50_ms"], 2)
+                line += f"  x{m['speedup']:.2f}"
+            click.echo(line, err=True)
+
+    doc = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "seed": seed,
+            "history_per_sku": history_per_sku,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+    text = json.dumps(doc, indent=2, ensure_ascii=False)
+    if out:
+        pathlib.Path(out).write_text(text + "\n", encoding="utf-8")
+    else:
+        click.echo(text)
+    if baseline:
+        base = json.loads(pathlib.Path(baseline).read_text(encoding="utf-8"))
+        if not report_comparison(base, doc, threshold, min_ms):
+            sys.exit(1)
+
+
+@cli.command()
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False))
+@click.argument("current", type=click.Path(exists=True, dir_okay=False))
+@click.option("--threshold", default=0.15, show_default=True)
+@click.option("--min-ms", default=1.0, show_default=True)
+def compare(baseline, current, threshold, min_ms):
+    """Compara dos archivos de resultados; sale con código 1 si hay regresiones."""
+    base = json.loads(pathlib.Path(baseline).read_text(encoding="utf-8"))
+    new = json.loads(pathlib.Path(current).read_text(encoding="utf-8"))
+    if not report_comparison(base, new, threshold, min_ms):
+        sys.exit(1)
+
+
+@cli.command(hidden=True)
+@click.argument("db_path")
+@click.option("--size", type=int, required=True)
+@click.option("--seed", type=int, required=True)
+@click.option("--history-per-sku", type=int, required=True)
+def generate(db_path, size, seed, history_per_sku):
+    generate_catalog(db_path, size, seed, history_per_sku)
+
+
+@cli.command("measure", hidden=True)
+@click.argument("scenario", type=click.Choice(SCENARIOS))
+@click.argument("db_path")
+@click.option("--repeat", type=int, required=True)
+@click.option("--seed", type=int, required=True)
+@click.option("--workers", type=int, default=1)
+def measure_command(scenario, db_path, repeat, seed, workers):
+    click.echo(json.dumps(measure(scenario, db_path, repeat, seed, workers)))
+
+if __name__ == "__main__":
+    cli()
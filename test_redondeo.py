@@ -0,0 +1,145 @@
+"""
+Equivalencia del motor de redondeo (redondear_array) con las implementaciones que reemplazó:
+el argmin de cuatro candidatos que usaba calculate_prices (redondear_batch) y end_599_999. También
+que el camino escalar (redondear, calculate_prices) da exactamente lo mismo que el de arrays.
+
+    python -m pytest -q test_redondeo.py
+"""
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from app_precios_v2 import (
+    CALC_FIELDS, calculate_prices, calculate_prices_batch, channel_endings, redondear,
+    redondear_array,
+)
+
+
+# --- implementaciones anteriores, copiadas tal cual como referencia ---
+def redondear_batch(valores: np.ndarray, redondeo: int) -> np.ndarray:
+    miles = np.floor_divide(np.trunc(valores), 1000)
+    candidatos = np.stack([
+        miles * 1000 + 599,
+        miles * 1000 + redondeo,
+        (miles + 1) * 1000 + 599,
+        (miles + 1) * 1000 + redondeo,
+    ])
+    idx = np.argmin(np.abs(candidatos - valores), axis=0)
+    return np.take_along_axis(candidatos, idx[np.newaxis], axis=0)[0]
+
+
+def end_599_999(value: float) -> float:
+    base = int(value)
+    thousands = base // 1000
+    candidates = [
+        thousands * 1000 + 599,
+        thousands * 1000 + 999,
+        (thousands + 1) * 1000 + 599,
+        (thousands + 1) * 1000 + 999,
+        max(0, (thousands - 1) * 1000 + 999),
+        max(0, (thousands - 1) * 1000 + 599),
+    ]
+    candidates = sorted(set([c for c in candidates if c >= 0]))
+    best = None
+    best_dist = None
+    for c in candidates:
+        dist = abs(c - value)
+        if best is None or dist < best_dist or (dist == best_dist and c % 1000 == 999):
+            best = c
+            best_dist = dist
+    return float(best if best is not None else value)
+
+
+def sweep() -> np.ndarray:
+    """Enteros y medios en los primeros 20 mil (incluye todos los empates exactos) más valores
+    al azar en varios órdenes de magnitud, como los precios ARS reales."""
+    rng = np.random.default_rng(599)
+    grid = np.arange(0, 20_000, 0.5)
+    random = rng.lognormal(mean=12, sigma=2, size=200_000)
+    return np.concatenate([grid, random, [0.0, 599.0, 999.0, 1599.0, 123_456_789.25]])
+
+
+def resto(valores: np.ndarray) -> np.ndarray:
+    return valores - np.floor_divide(np.trunc(valores), 1000) * 1000
+
+
+@pytest.mark.parametrize("redondeo", [599, 650, 799, 899, 950, 999])
+def test_igual_al_argmin_de_cuatro_candidatos(redondeo):
+    valores = sweep()
+    endings = channel_endings("web", {"redondeo": redondeo})
+    np.testing.assert_array_equal(redondear_array(valores, endings), redondear_batch(valores, redondeo))
+
+
+@pytest.mark.parametrize("redondeo", [0, 99, 299, 598])
+def test_redondeo_menor_a_599_solo_cambia_el_desempate(redondeo):
+    # con redondeo < 599 la lista vieja no estaba ordenada y en un empate ganaba 599; ahora
+    # gana la terminación menor, como en el resto de los casos
+    valores = sweep()
+    nuevo = redondear_array(valores, channel_endings("web", {"redondeo": redondeo}))
+    viejo = redondear_batch(valores, redondeo)
+    empate = resto(valores) == (599 + redondeo) / 2
+    np.testing.assert_array_equal(nuevo[~empate], viejo[~empate])
+    np.testing.assert_array_equal(nuevo[empate], viejo[empate] - (599 - redondeo))
+
+
+def test_igual_a_end_599_999_salvo_en_lo_documentado():
+    valores = sweep()
+    nuevo = redondear_array(valores, (599, 999))
+    viejo = np.array([end_599_999(v) for v in valores.tolist()])
+    r = resto(valores)
+    # end_599_999 podía bajar al 999 del mil anterior (en el primer mil, a 0, que además ganaba
+    # el empate de 299.5) y en empate prefería 999
+    baja_de_mil = (r <= 299) | (valores <= 299.5)
+    empate = r == 799
+    iguales = ~(baja_de_mil | empate)
+    np.testing.assert_array_equal(nuevo[iguales], viejo[iguales])
+    base = valores - r
+    np.testing.assert_array_equal(nuevo[baja_de_mil], base[baja_de_mil] + 599)
+    np.testing.assert_array_equal(nuevo[empate], base[empate] + 599)
+
+
+def test_grilla_de_escenarios_igual_que_por_fila():
+    # (S, N) como en price_scenarios: cada fila se redondea igual que sola
+    valores = sweep()[:50_000].reshape(5, -1)
+    endings = (599, 999)
+    np.testing.assert_array_equal(
+        redondear_array(valores, endings), np.stack([redondear_array(fila, endings) for fila in valores])
+    )
+
+
+def test_no_finitos_pasan_sin_cambios():
+    valores = np.array([np.nan, np.inf, -np.inf, 1234.0])
+    out = redondear_array(valores, (599, 999))
+    assert np.isnan(out[0]) and out[1] == np.inf and out[2] == -np.inf and out[3] == 1599.0
+
+
+@pytest.mark.parametrize("endings", [(599,), (599, 999), (99, 599), (0, 250, 500, 750)])
+def test_escalar_igual_que_array(endings):
+    valores = np.concatenate([sweep(), [np.nan, np.inf, -np.inf, -1.0, -1500.5]])
+    escalar = np.array([redondear(v, endings) for v in valores.tolist()])
+    np.testing.assert_array_equal(escalar, redondear_array(valores, endings))
+
+
+@pytest.mark.filterwarnings("ignore:invalid value:RuntimeWarning")
+def test_calculate_prices_escalar_igual_que_batch():
+    rng = np.random.default_rng(1)
+    n = 20_000
+    products = [
+        {
+            "fob_usd": float(rng.lognormal(4.5, 1.1)), "peso_kg": float(rng.lognormal(0, 0.9)),
+            "costo_flete_usd_kg": 4.2, "costo_financiero": 0.04, "arancel": float(rng.choice([0, 0.16, 0.35])),
+            "aduana": 0.0053, "despachante": 0.0095, "banco": 0.004, "iva": float(rng.choice([0.105, 0.21])),
+            "envio_ars": float(rng.choice([0, 4999])), "margen_neto": float(rng.uniform(-0.1, 0.3)),
+            "precio_manual_ars": float(rng.uniform(1e4, 5e6)) if i % 10 == 0 else None,
+        }
+        for i in range(n)
+    ]
+    # costo cero con precio manual: la división por cero tiene que dar lo mismo que numpy
+    products.append(dict(products[0], fob_usd=0.0, peso_kg=0.0, precio_manual_ars=150_000.0))
+    products.append(dict(products[1], fob_usd=0.0, peso_kg=0.0, precio_manual_ars=None))
+    for vars_map in ({"dolar": 1480, "redondeo": 999, "coef_ml_3": 1.2698}, {"dolar": 0.0, "redondeo": 599}):
+        batch = calculate_prices_batch(vars_map, products)
+        escalar = [calculate_prices(vars_map, p) for p in products]
+        for f in CALC_FIELDS:
+            np.testing.assert_array_equal(np.array([getattr(c, f) for c in escalar]), getattr(batch, f), err_msg=f)